@@ -0,0 +1,178 @@
+import numpy as np
+
+import metrics
+
+# iRacing always hands out 64 CarIdx slots, no matter how many cars are in the session
+MAX_CARS = 64
+# two cars are in a battle if the one behind needs less than this many seconds to the one in front
+BATTLE_GAP = 1.0
+# a battle has to go on for this long before it is worth showing
+BATTLE_MIN_DURATION = 5.0
+# CarIdxTrackSurface of the cars which are racing (off track still counts, pit lane does not)
+OFF_TRACK = 0
+ON_TRACK = 3
+# laps per second below which a car counts as standing still
+MIN_LAP_SPEED = 1e-4
+
+
+class Battle:
+    __slots__ = ("id", "cars", "spread", "started")
+
+    def __init__(self, id, cars, spread, started):
+        self.id = id
+        # CarIdx of the cars, from the last one of the group to the one in front
+        self.cars = cars
+        # seconds from the last car of the group to the first one
+        self.spread = spread
+        # epoch of the tick the group came together
+        self.started = started
+
+    @property
+    def size(self):
+        return len(self.cars)
+
+    def duration(self, now):
+        return now - self.started
+
+
+class BattleIndex:
+    # finds every group of cars running close together anywhere on track.
+    # once per tick all cars get sorted by CarIdxLapDistPct and every car is only compared
+    # to the next one in front, so it is a sort and one sweep instead of all pairs of cars.
+    # a group keeps its id (and the time it started) as long as it shares cars with the
+    # group of the tick before
+
+    def __init__(self, max_cars=MAX_CARS, gap=BATTLE_GAP, min_duration=BATTLE_MIN_DURATION):
+        self.max_cars = max_cars
+        self.gap = gap
+        self.min_duration = min_duration
+        # cars which should never count (pace car, spectators, ...)
+        self.ignore = np.zeros(max_cars, dtype=bool)
+        self.ignore[0] = True
+        # whatever the ignore mask was built from, so callers know when to rebuild it
+        self.ignore_key = None
+        # id of the battle every car is in, -1 for none
+        self.membership = np.full(max_cars, -1)
+        self.battles = []
+        self.epoch = 0
+        self._next_id = 0
+        self._active = np.zeros(max_cars, dtype=bool)
+        self._scratch = np.zeros(max_cars, dtype=bool)
+        self.gauge = metrics.gauge("irtcpr_battles", "groups of cars running close together",
+                                   fn=lambda: len(self.battles))
+
+    def set_ignore(self, car_idxs, key=None):
+        self.ignore_key = key
+        self.ignore[:] = False
+        self.ignore[0] = True
+        for i in car_idxs:
+            if 0 <= i < self.max_cars:
+                self.ignore[i] = True
+
+    def clear(self):
+        self.membership[:] = -1
+        self.battles = []
+
+    def update(self, lap_dist_pct, laps, track_surface, lap_speed, now):
+        self.epoch = now
+        n = min(len(lap_dist_pct), self.max_cars)
+        active = self._active
+        active[n:] = False
+        np.greater_equal(lap_dist_pct[:n], 0, out=active[:n])
+        active &= ~self.ignore
+        scratch = self._scratch
+        scratch[n:] = False
+        np.equal(track_surface[:n], ON_TRACK, out=scratch[:n])
+        np.logical_or(scratch[:n], track_surface[:n] == OFF_TRACK, out=scratch[:n])
+        active &= scratch
+
+        idx = np.flatnonzero(active)
+        if len(idx) < 2:
+            self.clear()
+            return self.battles
+
+        # the field in track order, from the line around the lap
+        pct = lap_dist_pct[idx].astype(np.float64)
+        order = np.argsort(pct, kind="stable")
+        cars = idx[order]
+        pct = pct[order]
+
+        # lap fraction from every car to the next one in front, the first car
+        # after the line is in front of the last one before the line
+        ahead = np.empty_like(pct)
+        ahead[:-1] = pct[1:]
+        ahead[-1] = pct[0] + 1.0
+        dist = ahead - pct
+        seconds = dist / np.maximum(lap_speed[cars], MIN_LAP_SPEED)
+        close = seconds < self.gap
+        # a car lapping another one is no battle: the car in front must be on the same lap,
+        # or one lap further if it already crossed the line
+        lap = laps[cars]
+        close[:-1] &= lap[1:] == lap[:-1]
+        close[-1] &= lap[0] - 1 == lap[-1]
+
+        if not close.any():
+            self.clear()
+            return self.battles
+        # start the sweep right after a gap, so no group is cut in two at the end of the lists.
+        # the groups are short, from here on plain python is faster than numpy on tiny arrays
+        if close.all():
+            # the whole field in one group (formation lap), it ends at the biggest gap
+            close[np.argmax(seconds)] = False
+        first = int(np.argmin(close)) + 1
+        cars = cars.tolist()
+        close = close.tolist()
+        seconds = seconds.tolist()
+        cars = cars[first:] + cars[:first]
+        close = close[first:] + close[:first]
+        seconds = seconds[first:] + seconds[:first]
+        # a new group starts after every gap
+        breaks = [i for i, c in enumerate(close) if not c]
+        previous = self.membership.tolist()
+        membership = np.full(self.max_cars, -1)
+        started = {b.id: b.started for b in self.battles}
+        taken = set()
+        battles = []
+        start = 0
+        for end in breaks:
+            # cars[start:end + 1] run close together, the link behind cars[end] is a gap
+            if end > start:
+                members = cars[start:end + 1]
+                # the battle of the last tick this group shares the most cars with
+                counts = {}
+                for c in members:
+                    if previous[c] >= 0 and previous[c] not in taken:
+                        counts[previous[c]] = counts.get(previous[c], 0) + 1
+                if counts:
+                    battle_id = max(counts, key=lambda k: (counts[k], -k))
+                else:
+                    battle_id = self._next_id
+                    self._next_id += 1
+                taken.add(battle_id)
+                membership[members] = battle_id
+                battles.append(Battle(battle_id, tuple(members), sum(seconds[start:end]),
+                                      started.get(battle_id, now)))
+            start = end + 1
+        self.membership = membership
+        self.battles = battles
+        return battles
+
+    def battle_of(self, car_idx):
+        battle_id = self.membership[car_idx]
+        if battle_id < 0:
+            return None
+        for b in self.battles:
+            if b.id == battle_id:
+                return b
+        return None
+
+    def best(self, now=None):
+        # the most cars, then the closest group, then the one going on for the longest time.
+        # groups which just came together only count if there is nothing else
+        if now is None:
+            now = self.epoch
+        battles = self.battles
+        if not battles:
+            return None
+        return max(battles, key=lambda b: (b.duration(now) >= self.min_duration, b.size,
+                                           -b.spread / (b.size - 1), b.duration(now)))
@@ -0,0 +1,411 @@
+import gc
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+import yaml
+
+import iRTCPR
+from iRTCPR import state, roster, session, car_state, speed_estimator
+from rewards import RewardReconciler
+from redeemqueue import RedeemQueue
+from telemetry import read_frame
+
+logger = logging.getLogger("iRTCPR")
+
+# micro benchmarks of everything that runs per tick or per redeem.
+# python bench.py --json now.json                       measure and store the results
+# python bench.py --baseline before.json                 measure and compare, exit code 1 on a regression
+# baseline and comparison belong on the same, otherwise idle machine
+
+FIELDS = (10, 30, 64)
+# a minute of telemetry at 10 Hz, every repeat runs through all of it
+FRAMES = 600
+TRACK_LENGTH_KM = 5.79
+CAMERAS = ("TV1", "Chase", "Far Chase", "Gyro", "Rear Chase", "Gearbox", "Chopper", "Nose", "Scenic")
+SPEC_USER_ID = 1005
+SPEC_TEAM_ID = 2005
+TOLERANCE = 0.25
+REPEAT = 10
+# allocations may grow this much before it counts as a regression
+ALLOC_SLACK = 1024
+
+
+class SyntheticIR:
+    # a field of cars going round, served through the parts of the IRSDK interface we use
+
+    def __init__(self, cars, team, update):
+        self.session_info_update = update
+        self.switches = 0
+        self.vars = {"SessionNum": 0}
+        drivers = []
+        for i in range(cars):
+            drivers.append({
+                "CarIdx": i,
+                "CarNumber": str(i),
+                "UserName": "Driver %s" % (i, ),
+                # CarIdx 0 is the pace car
+                "UserID": -1 if i == 0 else 1000 + i,
+                "TeamID": 2000 + i if team and i else 0,
+                "TeamName": "Team %s" % (i, ),
+                "CarScreenName": "Car",
+                "IRating": 1500,
+                "LicString": "A 4.99",
+                "IsSpectator": 0,
+            })
+        self.info = {
+            "WeekendInfo": {
+                "TrackLength": "%s km" % (TRACK_LENGTH_KM, ),
+                "TrackDisplayName": "Synthetic",
+                "TrackCity": "Nowhere",
+                "TrackCountry": "Nowhere",
+                "Category": "Road",
+                "TeamRacing": 1 if team else 0,
+                "SessionID": update,
+                "SubSessionID": update,
+                "WeekendOptions": {"StandingStart": 0},
+            },
+            "SessionInfo": {"Sessions": [{"SessionName": "RACE", "SessionType": "Race"}]},
+            "CameraInfo": {"Groups": [{"GroupNum": i + 1, "GroupName": c} for i, c in enumerate(CAMERAS)]},
+            "DriverInfo": {"Drivers": drivers},
+        }
+
+    def __getitem__(self, key):
+        if key in self.vars:
+            return self.vars[key]
+        return self.info.get(key)
+
+    def cam_switch_num(self, car_number="1", group=1, camera=0):
+        self.switches += 1
+
+    def frames(self, cars, count):
+        # the cars bunch up close enough for the gap logic to have something to decide
+        rng = np.random.default_rng(cars)
+        speed = np.zeros(64)
+        speed[:cars] = 0.0115 + rng.random(cars) * 0.0015
+        pct = np.zeros(64)
+        pct[:cars] = rng.random(cars) * 0.05
+        frames = []
+        for n in range(count):
+            t = n * 0.1
+            pos = pct + speed * t
+            self.vars.update({
+                "SessionTick": n,
+                "SessionTime": t,
+                "CamCarIdx": 5,
+                "CamGroupNumber": 1,
+                "CarIdxLapDistPct": list(np.where(np.arange(64) < cars, pos % 1, -1)),
+                "CarIdxLap": list(np.where(np.arange(64) < cars, pos.astype(int), -1)),
+                "CarIdxTrackSurface": [3] * cars + [-1] * (64 - cars),
+                "CarIdxEstTime": list(np.where(np.arange(64) < cars, (pos % 1) * 90, 0)),
+            })
+            frames.append(read_frame(self, n + 1, speed_estimator, 1000.0 + t))
+        return frames
+
+
+class FakeHelix:
+    # keeps the rewards in memory and answers like helix does, in the interface of HelixClient
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.loop = asyncio.new_event_loop()
+        self.rewards = {}
+        self.calls = 0
+        self._next_id = 0
+
+    def run(self, coro, timeout=None):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self.loop.close()
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_rewards(self, broadcaster_id, only_manageable_rewards=True):
+        await self._call()
+        return {"data": [dict(r) for r in self.rewards.values()]}
+
+    async def create_reward(self, broadcaster_id, reward):
+        await self._call()
+        self._next_id += 1
+        created = {
+            "id": "reward-%s" % (self._next_id, ),
+            "title": reward["title"],
+            "prompt": reward.get("prompt", ""),
+            "cost": reward.get("cost", 1),
+            "is_paused": reward.get("is_paused", False),
+            "global_cooldown_setting": {
+                "is_enabled": reward.get("is_global_cooldown_enabled", False),
+                "global_cooldown_seconds": reward.get("global_cooldown_seconds", 0),
+            },
+        }
+        self.rewards[created["id"]] = created
+        return {"data": [dict(created)]}
+
+    async def update_reward(self, broadcaster_id, reward_id, changes):
+        await self._call()
+        reward = self.rewards[reward_id]
+        for k in changes:
+            if k == "is_global_cooldown_enabled":
+                reward["global_cooldown_setting"]["is_enabled"] = changes[k]
+            elif k == "global_cooldown_seconds":
+                reward["global_cooldown_setting"]["global_cooldown_seconds"] = changes[k]
+            else:
+                reward[k] = changes[k]
+        return {"data": [dict(reward)]}
+
+    async def delete_reward(self, broadcaster_id, reward_id):
+        await self._call()
+        del self.rewards[reward_id]
+
+    async def gather(self, coros):
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+
+def setup_session(cars, team, update):
+    # a new session in the sim, everything of iRTCPR starts over
+    ir = SyntheticIR(cars, team, update)
+    iRTCPR.ir = ir
+    roster.clear()
+    session.clear()
+    car_state.reset()
+    speed_estimator.reset()
+    state.ir_connected = True
+    state.camswitch_epoch = -1
+    state.camera_hold_until = -1
+    state.REDEEM_IS_ACTIVE = False
+    iRTCPR.camera.reset()
+    session.refresh(ir)
+    roster.refresh(ir)
+    iRTCPR.cameras()
+    return ir
+
+
+def reset_camera():
+    state.camswitch_epoch = -1
+    state.camera_hold_until = -1
+    state.last_epoch = -1
+    iRTCPR.camera.reset()
+
+
+def measure(prepare, step, number, repeat):
+    # per call: the best and the median time of all repeats, and how many bytes one call
+    # keeps alive at its peak (numpy arrays included)
+    times = []
+    for _ in range(repeat):
+        prepare()
+        # like timeit, the garbage collector must not end up in a random measurement
+        gc.disable()
+        started = time.perf_counter()
+        for i in range(number):
+            step(i)
+        times.append((time.perf_counter() - started) / number)
+        gc.enable()
+
+    prepare()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(min(number, 50)):
+        step(i)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "us_min": times[0] * 1e6,
+        "us_median": times[len(times) // 2] * 1e6,
+        "alloc_peak_bytes": max(0, peak),
+    }
+
+
+def bench_tick(results, cars, team, update, repeat):
+    kind = "team" if team else "solo"
+    ir = setup_session(cars, team, update)
+    frames = ir.frames(cars, FRAMES)
+
+    # finddriver() / findteam() on the roster of this session
+    if team:
+        results["findteam/%s/%s" % (kind, cars)] = measure(
+            reset_camera, lambda i: iRTCPR.findteam(SPEC_TEAM_ID), 1000, repeat)
+        iRTCPR.findteam(SPEC_TEAM_ID)
+    else:
+        results["finddriver/%s/%s" % (kind, cars)] = measure(
+            reset_camera, lambda i: iRTCPR.finddriver(SPEC_USER_ID), 1000, repeat)
+        iRTCPR.finddriver(SPEC_USER_ID)
+    state.SEARCH_FOR_DRIVER = False
+    state.SEARCH_FOR_TEAM = False
+
+    # DriverOrTeamsWorker with a new roster: every car gets added
+    def new_roster(i):
+        car_state.reset()
+        iRTCPR.updateDrivers(frames[i])
+    results["updateDrivers/roster/%s/%s" % (kind, cars)] = measure(car_state.reset, new_roster, 100, repeat)
+
+    # DriverOrTeamsWorker on every tick: position and speed of the field
+    def known_roster():
+        car_state.reset()
+        iRTCPR.updateDrivers(frames[0])
+    results["updateDrivers/tick/%s/%s" % (kind, cars)] = measure(
+        known_roster, lambda i: iRTCPR.updateDrivers(frames[i]), FRAMES, repeat)
+
+    # the battle index of iRacingWorker on every tick, the whole field at once
+    results["battles/%s/%s" % (kind, cars)] = measure(
+        iRTCPR.battle_index.clear, lambda i: iRTCPR.battle_index.update(
+            frames[i].CarIdxLapDistPct, frames[i].CarIdxLap, frames[i].CarIdxTrackSurface,
+            frames[i].lap_speed, frames[i].epoch), FRAMES, repeat)
+
+    # the camera decision of iRacingWorker on every tick
+    results["autocamswitcher/%s/%s" % (kind, cars)] = measure(
+        reset_camera, lambda i: iRTCPR.autocamswitcher(frames[i]), FRAMES, repeat)
+
+
+def bench_callback(results, repeat):
+    payload = {
+        "type": "reward-redeemed",
+        "data": {"redemption": {
+            "id": "redemption-1",
+            "channel_id": "4711",
+            "user": {"login": "viewer"},
+            "reward": {"id": "reward-1", "title": "Chase", "cost": 100,
+                       "prompt": "Schaltet die Kamera auf Chase. Automatisch erstellt durch %s"
+                                 % (iRTCPR.SCRIPTNAME, )},
+        }},
+    }
+    other = {
+        "type": "reward-redeemed",
+        "data": {"redemption": {
+            "id": "redemption-2",
+            "channel_id": "4711",
+            "user": {"login": "viewer"},
+            "reward": {"id": "reward-2", "title": "Hydrate", "cost": 100, "prompt": "Drink something"},
+        }},
+    }
+
+    def new_queue():
+        iRTCPR.redeems = RedeemQueue()
+    results["callback/ours"] = measure(new_queue, lambda i: iRTCPR.callback(None, payload), 1000, repeat)
+    results["callback/foreign"] = measure(new_queue, lambda i: iRTCPR.callback(None, other), 1000, repeat)
+
+
+def bench_rewards(results, repeat, latency):
+    cache_dir = tempfile.mkdtemp()
+    cache_file = os.path.join(cache_dir, "rewards.json")
+    desired = iRTCPR.desiredrewards()
+    keep = iRTCPR.knownrewardtitles()
+    holder = {}
+
+    def fresh():
+        # nothing at twitch, nothing in the cache
+        if "helix" in holder:
+            holder["helix"].close()
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        holder["helix"] = FakeHelix(latency)
+        holder["reconciler"] = RewardReconciler(holder["helix"], "4711", iRTCPR.SCRIPTNAME, cache_file)
+
+    def provisioned():
+        fresh()
+        holder["reconciler"].reconcile(desired, keep)
+
+    results["rewards/provision"] = measure(
+        fresh, lambda i: holder["reconciler"].reconcile(desired, keep), 1, repeat)
+    results["rewards/provision"]["helix_calls"] = holder["helix"].calls
+    results["rewards/unchanged"] = measure(
+        provisioned, lambda i: holder["reconciler"].reconcile(desired, keep), 10, repeat)
+    results["rewards/pause"] = measure(
+        provisioned, lambda i: holder["reconciler"].reconcile([], keep), 1, repeat)
+
+    holder["helix"].close()
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    os.rmdir(cache_dir)
+
+
+def compare(results, baseline, tolerance):
+    # returns the names of everything which got slower or allocates more than the baseline
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        now = results[name]
+        before = baseline[name]
+        # the best run is the one least disturbed by everything else on the machine
+        if now["us_min"] > before["us_min"] * (1 + tolerance):
+            regressions.append("%s: %.1fus -> %.1fus" % (name, before["us_min"], now["us_min"], ))
+        if now["alloc_peak_bytes"] > before["alloc_peak_bytes"] * (1 + tolerance) + ALLOC_SLACK:
+            regressions.append("%s: %s -> %s bytes allocated"
+                               % (name, before["alloc_peak_bytes"], now["alloc_peak_bytes"], ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro benchmarks of the per tick code of %s"
+                                                 % (iRTCPR.SCRIPTNAME, ))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the results of an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="how much slower than the baseline is still fine (default %s)" % (TOLERANCE, ))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--helix-latency", type=float, default=0,
+                        help="seconds the fake helix takes per request (default 0)")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_example.yaml")) as fl:
+        config = yaml.load(fl, Loader=yaml.FullLoader)
+    config["IRACING_ID"] = SPEC_USER_ID
+    config["IRACING_TEAM_ID"] = SPEC_TEAM_ID
+    config["OVERLAY_FILES_ENABLED"] = False
+    config["OVERLAY_SERVER_ENABLED"] = False
+    iRTCPR.configure(config)
+
+    results = {}
+    update = 0
+    for team in (False, True):
+        for cars in FIELDS:
+            update += 1
+            bench_tick(results, cars, team, update, args.repeat)
+    bench_callback(results, args.repeat)
+    bench_rewards(results, args.repeat, args.helix_latency)
+
+    print("%-36s %12s %12s %14s" % ("benchmark", "median us", "min us", "peak alloc B"))
+    for name in sorted(results):
+        r = results[name]
+        print("%-36s %12.2f %12.2f %14d" % (name, r["us_median"], r["us_min"], r["alloc_peak_bytes"]))
+
+    if args.json:
+        with open(args.json, "w") as fl:
+            fl.write(json.dumps({
+                "version": iRTCPR.VERSION,
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.platform(),
+                "created": time.time(),
+                "results": results,
+            }, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as fl:
+            baseline = json.loads(fl.read())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("regressions against %s:" % (args.baseline, ))
+            for r in regressions:
+                print("  %s" % (r, ))
+            sys.exit(1)
+        print("no regressions against %s" % (args.baseline, ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+from threading import Lock
+
+import metrics
+
+# if the sim shows something else than we asked for, we ask again at most this often
+RESEND_INTERVAL = 1.0
+
+
+class CameraCommander:
+    # the only way camera commands get to the sim.
+    # it remembers what we asked for last and what the sim actually shows (CamCarIdx and
+    # CamGroupNumber of the telemetry), so a command is only broadcast if something changes.
+    # a new target has to wait until the current one was on screen for min_dwell seconds,
+    # unless the caller forces it (redemptions, spotting our car)
+
+    def __init__(self, send, min_dwell=0):
+        # send(car_number, group) broadcasts the command to the sim
+        self.send = send
+        self.min_dwell = min_dwell
+        self._lock = Lock()
+        self.reset()
+        self.sent_count = metrics.counter("irtcpr_camera_commands_total", "camera commands sent to the sim")
+        self.duplicate_count = metrics.counter("irtcpr_camera_commands_skipped_total",
+                                               "camera commands we did not send", reason="duplicate")
+        self.dwell_count = metrics.counter("irtcpr_camera_commands_skipped_total",
+                                           "camera commands we did not send", reason="dwell")
+
+    def reset(self):
+        # nothing known about the sim anymore, the next request goes out in any case
+        with self._lock:
+            self.car_number = None
+            self.car_idx = None
+            self.group = None
+            self.changed_at = -1
+            self.sent_at = -1
+            self.sim_car_idx = None
+            self.sim_group = None
+
+    def observe(self, cam_car_idx, cam_group):
+        # what the sim shows right now, from the telemetry frame
+        self.sim_car_idx = cam_car_idx
+        self.sim_group = cam_group
+
+    def _sim_shows(self, car_idx, group):
+        if self.sim_group is None:
+            return True
+        if self.sim_group != group:
+            return False
+        return car_idx is None or self.sim_car_idx is None or self.sim_car_idx == car_idx
+
+    def request(self, car_number, car_idx, group, now, force=False):
+        # returns True if the command was sent
+        with self._lock:
+            if car_number == self.car_number and group == self.group:
+                if self._sim_shows(car_idx, group) or now - self.sent_at < RESEND_INTERVAL:
+                    self.duplicate_count.inc()
+                    return False
+            elif not force and now - self.changed_at < self.min_dwell:
+                self.dwell_count.inc()
+                return False
+            else:
+                self.car_number = car_number
+                self.car_idx = car_idx
+                self.group = group
+                self.changed_at = now
+            self.sent_at = now
+        self.send(car_number, group)
+        self.sent_count.inc()
+        return True
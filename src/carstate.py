@@ -0,0 +1,59 @@
+import numpy as np
+
+from gaps import MAX_CARS
+
+
+class CarState:
+    # per CarIdx state of every car in the session.
+    # the static roster fields are stored once when a car shows up,
+    # the fields which change every tick live in preallocated arrays and are updated in place
+
+    def __init__(self, max_cars=MAX_CARS):
+        self.max_cars = max_cars
+        # static fields, CarIdx -> roster record
+        self.static = {}
+        self.known = np.zeros(max_cars, dtype=bool)
+        # roster.update the static fields were taken from
+        self.roster_update = -1
+
+        self.prev_pct = np.full(max_cars, -1.0)
+        self.pct = np.full(max_cars, -1.0)
+        self.prev_epoch = np.zeros(max_cars)
+        self.epoch = np.zeros(max_cars)
+        self.speed_ms = np.zeros(max_cars)
+
+        self._mask = np.zeros(max_cars, dtype=bool)
+
+    def reset(self):
+        self.static = {}
+        self.known[:] = False
+        self.roster_update = -1
+        self.prev_pct[:] = -1.0
+        self.pct[:] = -1.0
+        self.prev_epoch[:] = 0
+        self.epoch[:] = 0
+        self.speed_ms[:] = 0
+
+    def add(self, car_idx, record, pct, epoch):
+        self.static[car_idx] = record
+        self.known[car_idx] = True
+        self.prev_pct[car_idx] = pct
+        self.pct[car_idx] = pct
+        self.prev_epoch[car_idx] = epoch
+        self.epoch[car_idx] = epoch
+        self.speed_ms[car_idx] = 0
+
+    def update(self, lap_dist_pct, epoch, lap_speed, track_length):
+        n = min(len(lap_dist_pct), self.max_cars)
+        self.prev_pct[:] = self.pct
+        self.prev_epoch[:] = self.epoch
+        self.pct[:n] = lap_dist_pct[:n]
+        self.epoch[:] = epoch
+
+        # the speed estimator already did the hard work, we only need meters per second
+        np.multiply(lap_speed[:n], track_length, out=self.speed_ms[:n])
+        np.logical_not(self.known, out=self._mask)
+        self.speed_ms[self._mask] = 0
+
+    def speed_kmh(self, car_idx):
+        return int(self.speed_ms[car_idx] * 3.6)
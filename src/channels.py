@@ -0,0 +1,79 @@
+import os
+import json
+import logging
+from threading import Lock
+
+logger = logging.getLogger("iRTCPR")
+
+# what a channel in CHANNELS may set for itself, everything else comes from the main config
+CHANNEL_KEYS = ("USERNAME", "IRACING_ID", "IRACING_TEAM_ID",
+                "CAMERA_SWITCH_ENABLED", "CAMERAS", "CAMERA_SWITCH_COST", "CAMERA_SWITCH_COOLDOWN_ENABLED",
+                "CAMERA_SWITCH_COOLDOWN", "FRIENDS_SWITCH_ENABLED", "FRIENDS_SWITCH_COST",
+                "FRIENDS_SWITCH_COOLDOWN_ENABLED", "FRIENDS_SWITCH_COOLDOWN")
+
+
+def channel_config(base, profile):
+    # the main config with the settings of one channel on top
+    cfg = dict(base)
+    cfg.pop("CHANNELS", None)
+    cfg.update(profile)
+    return cfg
+
+
+class Channel:
+    # one more twitch channel whose viewers switch the camera of the same sim.
+    # it has its own login, rewards, pubsub listener and spotted car. the telemetry,
+    # the camera and the queue of camera windows are shared with the main channel
+
+    def __init__(self, base, profile):
+        self.config = channel_config(base, profile)
+        self.name = self.config["USERNAME"]
+        self.secrets_file = "twitch_secrets_%s.json" % (self.name.lower(), )
+        self.rewards_file = "twitch_rewards_%s.json" % (self.name.lower(), )
+        self.secrets = {"TOKEN": None, "REFRESH_TOKEN": None}
+        if os.path.exists(self.secrets_file):
+            with open(self.secrets_file) as fl:
+                self.secrets = json.loads(fl.read())
+        self.twitch = None
+        self.user_id = None
+        self.helix = None
+        self.reward_reconciler = None
+        self.pubsub = None
+        self.uuid = None
+        self._lock = Lock()
+
+    def save_secrets(self, secrets):
+        with open(self.secrets_file, "w+") as fl:
+            fl.write(json.dumps(secrets))
+
+    def update(self, base, profile):
+        # a reload of config.yaml, same channel with other settings
+        self.config = channel_config(base, profile)
+
+    def spotted_car(self, roster, team_session):
+        # CarNumber of the driver or team of this channel, None if they are not in the session.
+        # two dict lookups, only done when a camera window of this channel starts
+        if team_session:
+            car_idx = roster.by_team_id.get(int(self.config["IRACING_TEAM_ID"]))
+        else:
+            car_idx = roster.by_user_id.get(int(self.config["IRACING_ID"]))
+        if car_idx is None:
+            return None
+        d = roster.drivers.get(car_idx)
+        return None if d is None else d["CarNumber"]
+
+    def reconcile(self, desired, keep):
+        with self._lock:
+            if self.reward_reconciler is None:
+                return
+            try:
+                self.reward_reconciler.reconcile(desired, keep)
+            except Exception as e:
+                logger.critical("TWITCH - %s - cannot set up the rewards: %s" % (self.name, e, ))
+
+    def close(self):
+        if self.pubsub is not None:
+            self.pubsub.unlisten(self.uuid)
+            self.pubsub.stop()
+        if self.helix is not None:
+            self.helix.close()
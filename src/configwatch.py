@@ -0,0 +1,165 @@
+import os
+import asyncio
+import logging
+
+import yaml
+
+from channels import CHANNEL_KEYS, channel_config
+
+logger = logging.getLogger("iRTCPR")
+
+# how often we look at the modification time of config.yaml
+RELOAD_INTERVAL = 2
+# twitch does not take longer reward titles
+MAX_TITLE_LENGTH = 45
+# and no cooldown longer than a week
+MAX_COOLDOWN = 7 * 24 * 3600
+
+
+def _number(cfg, key, errors, minimum=0, integer=False, required=True):
+    if key not in cfg:
+        if required:
+            errors.append("%s is missing" % (key, ))
+        return
+    value = cfg[key]
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) or value < minimum:
+        errors.append("%s must be a%s number of at least %s, not %r"
+                      % (key, "n integer" if integer else "", minimum, value, ))
+
+
+def _title(title, key, errors):
+    if not isinstance(title, str) or not title.strip():
+        errors.append("%s must be a title, not %r" % (key, title, ))
+    elif len(title) > MAX_TITLE_LENGTH:
+        errors.append("%s %r is longer than %s characters" % (key, title, MAX_TITLE_LENGTH, ))
+
+
+def validate(cfg, channel=False):
+    # everything wrong with a config, an empty list if it can be used
+    if not isinstance(cfg, dict):
+        return ["the config is not a mapping of keys to values"]
+    errors = []
+    if not channel:
+        _validate_channels(cfg, errors)
+    for key in ("IRACING_ID", "IRACING_TEAM_ID"):
+        _number(cfg, key, errors, integer=True)
+    for key in ("CLIENT_ID", "CLIENT_SECRET", "USERNAME", "CAMERA_DEFAULT"):
+        if not isinstance(cfg.get(key), str) or not cfg[key]:
+            errors.append("%s is missing" % (key, ))
+    _number(cfg, "CAMERA_SWITCH_TIME", errors, minimum=1)
+    _number(cfg, "CAMERA_SWITCH_MINIMUM_BETWEEN_REDEEMS", errors, required=False)
+    _number(cfg, "CAMERA_SWITCH_COST", errors, minimum=1, integer=True)
+    _number(cfg, "FRIENDS_SWITCH_COST", errors, minimum=1, integer=True)
+    for key in ("CAMERA_SWITCH_COOLDOWN", "FRIENDS_SWITCH_COOLDOWN"):
+        _number(cfg, key, errors, integer=True)
+        if isinstance(cfg.get(key), int) and cfg[key] > MAX_COOLDOWN:
+            errors.append("%s must not be longer than %s seconds" % (key, MAX_COOLDOWN, ))
+    for key in ("CAMERA_MIN_DWELL", "CAMERA_GAP_HYSTERESIS", "BATTLE_GAP", "TELEMETRY_RATE"):
+        _number(cfg, key, errors, required=False)
+
+    # every reward title only once, twitch refuses duplicates
+    titles = {}
+    cameras = cfg.get("CAMERAS")
+    if not isinstance(cameras, list):
+        errors.append("CAMERAS must be a list of camera names")
+        cameras = []
+    for c in cameras:
+        _title(c, "CAMERAS", errors)
+        titles.setdefault(c, []).append("CAMERAS")
+    _title(cfg.get("REWARD_TITLE_RANDOMCAM"), "REWARD_TITLE_RANDOMCAM", errors)
+    titles.setdefault(cfg.get("REWARD_TITLE_RANDOMCAM"), []).append("REWARD_TITLE_RANDOMCAM")
+    if cfg.get("REWARD_TITLE_BATTLECAM"):
+        _title(cfg["REWARD_TITLE_BATTLECAM"], "REWARD_TITLE_BATTLECAM", errors)
+        titles.setdefault(cfg["REWARD_TITLE_BATTLECAM"], []).append("REWARD_TITLE_BATTLECAM")
+    friends = cfg.get("FRIENDS")
+    if friends is None and not cfg.get("FRIENDS_SWITCH_ENABLED"):
+        friends = {"DRIVERS": {}, "TEAMS": {}}
+    if not isinstance(friends, dict) or not isinstance(friends.get("DRIVERS") or {}, dict) \
+            or not isinstance(friends.get("TEAMS") or {}, dict):
+        errors.append("FRIENDS must have DRIVERS and TEAMS, each a mapping of id to nickname")
+    else:
+        for group in ("DRIVERS", "TEAMS"):
+            for i, nickname in (friends.get(group) or {}).items():
+                if not isinstance(i, int):
+                    errors.append("FRIENDS %s: %r is not an iRacing id" % (group, i, ))
+                _title(nickname, "FRIENDS %s %s" % (group, i, ), errors)
+                titles.setdefault(nickname, []).append("FRIENDS %s" % (group, ))
+    for title, keys in titles.items():
+        if len(keys) > 1 and isinstance(title, str):
+            errors.append("the reward title %r is used more than once (%s)" % (title, ", ".join(keys), ))
+    return errors
+
+
+def _validate_channels(cfg, errors):
+    profiles = cfg.get("CHANNELS") or []
+    if not isinstance(profiles, list):
+        errors.append("CHANNELS must be a list of channels")
+        return
+    names = [str(cfg.get("USERNAME", "")).lower()]
+    for n, profile in enumerate(profiles):
+        if not isinstance(profile, dict) or not isinstance(profile.get("USERNAME"), str):
+            errors.append("CHANNELS %s needs at least a USERNAME" % (n + 1, ))
+            continue
+        name = profile["USERNAME"]
+        if name.lower() in names:
+            errors.append("CHANNELS %s: %s is there more than once" % (n + 1, name, ))
+        names.append(name.lower())
+        for k in profile:
+            if k not in CHANNEL_KEYS:
+                errors.append("CHANNELS %s: %s can't be set per channel" % (name, k, ))
+        for e in validate(channel_config(cfg, profile), channel=True):
+            errors.append("CHANNELS %s: %s" % (name, e, ))
+
+
+def changed_keys(old, new):
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+class ConfigWatcher:
+    # looks at the modification time of the config file every few seconds, that's one stat()
+    # and nothing else as long as nobody touches it. a changed file is loaded and validated,
+    # apply(new) only gets configs without errors
+
+    def __init__(self, filename, apply, interval=RELOAD_INTERVAL):
+        self.filename = filename
+        self.apply = apply
+        self.interval = interval
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.filename)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def check(self):
+        # returns True if a new config was applied
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return False
+        # editors write in more than one step, whatever is there now is the next try
+        self.stamp = stamp
+        try:
+            with open(self.filename) as fl:
+                cfg = yaml.load(fl, Loader=yaml.FullLoader)
+        except Exception as e:
+            logger.critical("ConfigWatcher - cannot read %s, keeping the old config: %s" % (self.filename, e, ))
+            return False
+        errors = validate(cfg)
+        if errors:
+            for e in errors:
+                logger.critical("ConfigWatcher - %s: %s" % (self.filename, e, ))
+            logger.critical("ConfigWatcher - keeping the old config")
+            return False
+        self.apply(cfg)
+        return True
+
+    async def run(self, blocking):
+        # blocking(fn) runs fn next to the event loop, reading and applying may take a while
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await blocking(self.check)
+            except Exception as e:
+                logger.critical("ConfigWatcher - an exception occured %s" % (e,))
@@ -0,0 +1,75 @@
+import numpy as np
+
+from gaps import MAX_CARS
+
+# how many telemetry samples we keep per car to smooth the speed
+HISTORY = 16
+
+
+class SpeedEstimator:
+    # keeps a small ring buffer of (SessionTime, CarIdxLap + CarIdxLapDistPct) for all cars
+    # and calculates the speed of every car in laps per second over the whole buffer.
+    # SessionTime is the sim's clock, so a late wake-up of our thread does not cause spikes,
+    # and Lap + LapDistPct keeps counting up across the start/finish line
+
+    def __init__(self, history=HISTORY, max_cars=MAX_CARS):
+        self.history = history
+        self.max_cars = max_cars
+        self.times = np.zeros(history)
+        self.progress = np.full((history, max_cars), np.nan)
+        self.speed = np.zeros(max_cars)
+        self._invalid = np.zeros(max_cars, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        self.head = -1
+        self.count = 0
+        self.progress[:] = np.nan
+        self.speed[:] = 0
+
+    def push(self, session_time, car_idx_lap, car_idx_lap_dist_pct):
+        # returns the smoothed speed of every car in laps per second
+        if self.count > 0:
+            last = self.times[self.head]
+            if session_time == last:
+                # still the same sim tick
+                return self.speed
+            if session_time < last:
+                # a new session or a jump in the replay, the history is worthless now
+                self.reset()
+
+        n = min(len(car_idx_lap_dist_pct), self.max_cars)
+        head = (self.head + 1) % self.history
+        self.times[head] = session_time
+        row = self.progress[head]
+        row[:] = np.nan
+        np.add(car_idx_lap[:n], car_idx_lap_dist_pct[:n], out=row[:n])
+        # cars which are not in the world report -1
+        invalid = self._invalid
+        invalid[:] = True
+        np.less(car_idx_lap_dist_pct[:n], 0, out=invalid[:n])
+        row[invalid] = np.nan
+        self.head = head
+        if self.count < self.history:
+            self.count += 1
+
+        speed = self.speed
+        if self.count < 2:
+            speed[:] = 0
+            return speed
+
+        oldest = (head - self.count + 1) % self.history
+        dt = session_time - self.times[oldest]
+        with np.errstate(invalid="ignore"):
+            np.subtract(row, self.progress[oldest], out=speed)
+            # CarIdxLap and CarIdxLapDistPct do not always flip in the same tick at the line,
+            # nobody drives half a lap within the history, so wrap these glitches away
+            speed += 0.5
+            np.mod(speed, 1.0, out=speed)
+            speed -= 0.5
+            speed /= dt
+            # cars which were not on track during the whole history, or are rolling backwards
+            np.nan_to_num(speed, copy=False, nan=0.0)
+            np.less(speed, 0, out=invalid)
+        speed[invalid] = 0
+        return speed
@@ -0,0 +1,149 @@
+import numpy as np
+
+# iRacing always hands out 64 CarIdx slots, no matter how many cars are in the session
+MAX_CARS = 64
+
+# time gap windows (seconds) used by the camera logic
+# positive gap = opponent is in front of the spotted car, negative = behind
+GAP_FRONT_MAX = 0.6
+GAP_FRONT_MIN = -0.1
+GAP_BEHIND_MIN = -0.4
+# default extra seconds a car which is already close may drop back before it stops counting
+GAP_HYSTERESIS = 0.0
+
+
+class GapResult:
+    __slots__ = ("gaps", "in_front", "behind", "driversindistance", "switch_cam", "switch_cam_idx")
+
+    def __init__(self, gaps, in_front, behind, driversindistance, switch_cam, switch_cam_idx):
+        self.gaps = gaps
+        self.in_front = in_front
+        self.behind = behind
+        self.driversindistance = driversindistance
+        # 0 = nobody close, 1 = someone close in front, 2 = someone close behind
+        self.switch_cam = switch_cam
+        # CarIdx of the car we should look at if switch_cam is 2, else -1
+        self.switch_cam_idx = switch_cam_idx
+
+
+class GapEngine:
+    # computes the gap of every car to the spotted car in a handful of array operations,
+    # so the cost per tick does not grow with the size of the field
+
+    def __init__(self, max_cars=MAX_CARS, hysteresis=GAP_HYSTERESIS):
+        self.max_cars = max_cars
+        # a car inside a window stays there until it is this many seconds beyond its edge,
+        # so a car sitting right on the edge does not flip the camera back and forth
+        self.hysteresis = hysteresis
+        self.pct = np.full(max_cars, -1.0)
+        self.gaps = np.zeros(max_cars)
+        self.in_front = np.zeros(max_cars, dtype=bool)
+        self.behind = np.zeros(max_cars, dtype=bool)
+        # cars which should never count as opponents (pace car, spotted car itself, ...)
+        self.ignore = np.zeros(max_cars, dtype=bool)
+        self.ignore[0] = True
+        # whatever the ignore mask was built from, so callers know when to rebuild it
+        self.ignore_key = None
+        self._active = np.zeros(max_cars, dtype=bool)
+        self._scratch = np.zeros(max_cars, dtype=bool)
+        self.est = np.zeros(max_cars)
+        self._est_gaps = np.zeros(max_cars)
+        # cars which were in_front or behind after the last update, for the spotted car in _close_spec
+        self._close = np.zeros(max_cars, dtype=bool)
+        self._close_spec = -1
+        self._limit = np.zeros(max_cars)
+
+    def set_ignore(self, car_idxs, key=None):
+        self.ignore_key = key
+        self.ignore[:] = False
+        self.ignore[0] = True
+        for i in car_idxs:
+            if 0 <= i < self.max_cars:
+                self.ignore[i] = True
+
+    def update(self, lap_dist_pct, spec_idx, track_length_m, speed_ms, est_time=None):
+        pct = self.pct
+        n = min(len(lap_dist_pct), self.max_cars)
+        pct[:n] = lap_dist_pct[:n]
+        pct[n:] = -1.0
+
+        # cars which are not in the world report -1
+        active = self._active
+        np.not_equal(pct, -1.0, out=active)
+        active &= ~self.ignore
+        active[spec_idx] = False
+
+        # lap fraction between opponent and spotted car, wrapped into [-0.5, 0.5)
+        # so cars on the other side of the start/finish line are not a full lap away
+        gaps = self.gaps
+        scratch = self._scratch
+        np.subtract(pct, pct[spec_idx], out=gaps)
+        gaps += 0.5
+        np.mod(gaps, 1.0, out=gaps)
+        gaps -= 0.5
+
+        # distance in meters divided by speed is the time gap in seconds
+        if speed_ms <= 0:
+            speed_ms = 0.1
+        gaps *= track_length_m / speed_ms
+
+        # CarIdxEstTime is the time the sim expects a car to need from the line to its position,
+        # so the difference to the spotted car is a much better time gap than distance / speed.
+        # we only use the rough lap time from above to wrap it around the line
+        if est_time is not None and est_time[spec_idx] > 0:
+            est = self.est
+            est[:n] = est_time[:n]
+            est[n:] = 0
+            lap_time = track_length_m / speed_ms
+            est_gaps = self._est_gaps
+            np.subtract(est, est[spec_idx], out=est_gaps)
+            est_gaps += lap_time / 2
+            np.mod(est_gaps, lap_time, out=est_gaps)
+            est_gaps -= lap_time / 2
+            np.greater(est, 0, out=scratch)
+            np.copyto(gaps, est_gaps, where=scratch)
+
+        in_front = self.in_front
+        behind = self.behind
+        close = self._close
+        if self._close_spec != spec_idx:
+            # another car is spotted now, nothing was close to it yet
+            close[:] = False
+            self._close_spec = spec_idx
+        if self.hysteresis > 0:
+            # the outer edges of both windows move out for the cars which were close already
+            limit = self._limit
+            np.multiply(close, self.hysteresis, out=limit)
+            limit += GAP_FRONT_MAX
+            np.less(gaps, limit, out=in_front)
+            np.multiply(close, -self.hysteresis, out=limit)
+            limit += GAP_BEHIND_MIN
+            np.greater(gaps, limit, out=behind)
+        else:
+            np.less(gaps, GAP_FRONT_MAX, out=in_front)
+            np.greater(gaps, GAP_BEHIND_MIN, out=behind)
+        np.greater(gaps, GAP_FRONT_MIN, out=scratch)
+        in_front &= scratch
+        in_front &= active
+        np.less_equal(gaps, GAP_FRONT_MIN, out=scratch)
+        behind &= scratch
+        behind &= active
+        np.logical_or(in_front, behind, out=close)
+
+        n_front = int(np.count_nonzero(in_front))
+        n_behind = int(np.count_nonzero(behind))
+        driversindistance = n_front + n_behind
+
+        switch_cam = 0
+        switch_cam_idx = -1
+        if driversindistance == 1:
+            if n_front == 1:
+                switch_cam = 1
+            else:
+                switch_cam = 2
+                switch_cam_idx = int(np.flatnonzero(behind)[0])
+        elif driversindistance > 1:
+            # the camera logic only cares that there is a group around us
+            switch_cam = 1 if n_front > 0 else 2
+
+        return GapResult(gaps, in_front, behind, driversindistance, switch_cam, switch_cam_idx)
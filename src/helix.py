@@ -0,0 +1,139 @@
+import time
+import asyncio
+import logging
+from threading import Thread
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger("iRTCPR")
+
+HELIX_URL = "https://api.twitch.tv/helix"
+# how many requests to twitch may be in flight at the same time
+CONCURRENCY = 8
+
+
+class HelixError(Exception):
+    def __init__(self, status, message):
+        super().__init__("%s: %s" % (status, message))
+        self.status = status
+        self.message = message
+
+
+class HelixClient:
+    # small asyncio based client for the helix endpoints we need over and over again.
+    # it runs on the event loop it is given (or its own in a background thread) with one pooled
+    # aiohttp session. tasks on that loop await the requests, threads fire many requests at once
+    # through run() and wait for all of them
+
+    def __init__(self, client_id, token, refresh=None, concurrency=CONCURRENCY, base_url=HELIX_URL, loop=None):
+        self.client_id = client_id
+        # token() returns the current user access token
+        self.token = token
+        # refresh() gets a new user access token, called once if twitch answers 401
+        self.refresh = refresh
+        self.concurrency = concurrency
+        self.base_url = base_url
+        self.calls = 0
+        self.errors = 0
+        self.session = None
+        self._semaphore = None
+        self._refresh_lock = None
+        self._thread = None
+        self.loop = loop
+        if loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._thread = Thread(target=self._run_loop, daemon=True)
+            self._thread.start()
+        self.run(self._open())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _open(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # one token refresh at a time, each one makes the token before it invalid
+        self._refresh_lock = asyncio.Lock()
+
+    def run(self, coro, timeout=None):
+        # runs a coroutine on our loop and waits for the result, from any thread but the loop's own
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def close(self):
+        if self.session is not None:
+            self.run(self.session.close())
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+    def _headers(self, token):
+        return {
+            "Client-ID": self.client_id,
+            "Authorization": "Bearer %s" % (token, ),
+            "Content-Type": "application/json",
+        }
+
+    async def request(self, method, path, params=None, json=None):
+        async with self._semaphore:
+            for attempt in range(2):
+                self.calls += 1
+                started = time.perf_counter()
+                token = self.token()
+                async with self.session.request(method, self.base_url + path, params=params,
+                                                json=json, headers=self._headers(token)) as resp:
+                    metrics.histogram("irtcpr_helix_request_seconds", "latency of the helix requests",
+                                      method=method, path=path).since(started)
+                    if resp.status == 401 and attempt == 0 and self.refresh is not None:
+                        async with self._refresh_lock:
+                            # another request may have refreshed it while we waited, then we retry with that
+                            if self.token() == token:
+                                await self.loop.run_in_executor(None, self.refresh)
+                        continue
+                    if resp.status >= 400:
+                        self.errors += 1
+                        metrics.counter("irtcpr_helix_errors_total", "failed helix requests",
+                                        method=method, path=path, status=resp.status).inc()
+                        try:
+                            message = (await resp.json()).get("message", "")
+                        except Exception:
+                            message = await resp.text()
+                        raise HelixError(resp.status, message)
+                    if resp.status == 204:
+                        return None
+                    return await resp.json()
+
+    async def get_rewards(self, broadcaster_id, only_manageable_rewards=True):
+        params = {"broadcaster_id": broadcaster_id,
+                  "only_manageable_rewards": "true" if only_manageable_rewards else "false"}
+        return await self.request("GET", "/channel_points/custom_rewards", params=params)
+
+    async def create_reward(self, broadcaster_id, reward):
+        return await self.request("POST", "/channel_points/custom_rewards",
+                                  params={"broadcaster_id": broadcaster_id}, json=reward)
+
+    async def update_reward(self, broadcaster_id, reward_id, changes):
+        return await self.request("PATCH", "/channel_points/custom_rewards",
+                                  params={"broadcaster_id": broadcaster_id, "id": reward_id}, json=changes)
+
+    async def delete_reward(self, broadcaster_id, reward_id):
+        return await self.request("DELETE", "/channel_points/custom_rewards",
+                                  params={"broadcaster_id": broadcaster_id, "id": reward_id})
+
+    async def update_redemption_status(self, broadcaster_id, reward_id, redemption_ids, status):
+        params = [("broadcaster_id", broadcaster_id), ("reward_id", reward_id)]
+        params += [("id", i) for i in redemption_ids]
+        return await self.request("PATCH", "/channel_points/custom_rewards/redemptions",
+                                  params=params, json={"status": status})
+
+    async def gather(self, coros):
+        # runs everything concurrently (limited by the semaphore), exceptions are returned, not raised
+        return await asyncio.gather(*coros, return_exceptions=True)
+
+    def create_rewards(self, broadcaster_id, rewards):
+        return self.run(self.gather([self.create_reward(broadcaster_id, r) for r in rewards]))
+
+    def delete_rewards(self, broadcaster_id, reward_ids):
+        return self.run(self.gather([self.delete_reward(broadcaster_id, i) for i in reward_ids]))
@@ -1,22 +1,45 @@
 from twitchAPI.pubsub import PubSub
 from twitchAPI.twitch import Twitch
 from twitchAPI.types import AuthScope, InvalidRefreshTokenException, CustomRewardRedemptionStatus
-from twitchAPI.oauth import UserAuthenticator, refresh_access_token
+from twitchAPI.oauth import UserAuthenticator, refresh_access_token, validate_token
 from uuid import UUID
 
 import traceback
 
-import re
 import json
+import copy
 import os
 
 import yaml
-import aiohttp
+import asyncio
 
 import irsdk
 import time
+from gaps import GapEngine
+from battles import BattleIndex, BATTLE_GAP
+from roster import Roster
+from carstate import CarState
+from estimator import SpeedEstimator
+from redeemqueue import RedeemQueue, ORDER_FIFO
+from scheduler import Scheduler
+from statusbatcher import StatusBatcher
+from journal import RedeemJournal, JOURNAL_FILE, RESUME_MAX_AGE
+from helix import HelixClient
+from rewards import RewardReconciler
+from overlay import Overlay
+from telemetry import TelemetryReader
+from recorder import Recorder
+from startup import Startup
+from channels import Channel
+from configwatch import ConfigWatcher, changed_keys, RELOAD_INTERVAL, validate as validate_config
+from camera import CameraCommander
+from runtime import Runtime
+from supervisor import SimSupervisor
+import metrics
+from session import SessionContext, SESSION_NUM_CHANGED, SESSION_CHANGED, CAMERAS_CHANGED
 import random
-from threading import Thread
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
@@ -26,8 +49,25 @@ CONFIG_FILE = "config.yaml"
 secrets_fn = "twitch_secrets.json"
 redeem_cam_file = "redeem_cam.txt"
 redeem_user_file = "redeem_user.txt"
-redeems = []
 DEBUG = False
+# twitch wants us to validate our token at least once an hour, until then the last
+# validation in twitch_secrets.json is good enough for a restart
+TOKEN_VALIDATE_INTERVAL = 3600
+# a token which expires sooner than this gets refreshed right away
+TOKEN_EXPIRY_MARGIN = 300
+# the next redemption is taken from the queue this many seconds before its camera window
+# can start, until then it waits in the queue in the order of REDEEM_QUEUE_ORDER
+BOOK_AHEAD = 0.2
+
+# these only take effect with a restart, everything else in config.yaml is applied while we run
+RESTART_KEYS = ("CLIENT_ID", "CLIENT_SECRET", "USERNAME", "TELEMETRY_RATE", "TELEMETRY_RECORD_FILE",
+                "METRICS_PORT", "METRICS_LOG_INTERVAL", "OVERLAY_FILES_ENABLED", "OVERLAY_SERVER_ENABLED",
+                "OVERLAY_PORT", "TWITCH_CONCURRENCY", "REDEEM_QUEUE_ORDER", "CONFIG_RELOAD_INTERVAL",
+                "REDEEM_JOURNAL_FILE")
+# a change of these means other rewards on twitch
+REWARD_KEYS = ("CAMERA_SWITCH_ENABLED", "CAMERAS", "CAMERA_SWITCH_COST", "CAMERA_SWITCH_COOLDOWN_ENABLED",
+               "CAMERA_SWITCH_COOLDOWN", "REWARD_TITLE_RANDOMCAM", "REWARD_TITLE_BATTLECAM", "FRIENDS_SWITCH_ENABLED",
+               "FRIENDS_SWITCH_COST", "FRIENDS_SWITCH_COOLDOWN_ENABLED", "FRIENDS_SWITCH_COOLDOWN", "FRIENDS", "CHANNELS")
 
 # initate everything we need for thread safe logging to stdout
 logger = logging.getLogger(SCRIPTNAME)
@@ -40,26 +80,33 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-logger.info("---------------------------------------------")
-logger.info("%s" % (SCRIPTNAME, ))
-logger.info("Version: %s" % (VERSION))
-logger.info("---------------------------------------------")
-
-file_list = os.listdir()
-if CONFIG_FILE not in file_list:
-    logger.info("There is no config.yaml config file.")
-    logger.info("Please copy the config_example.yaml to config.yaml")
-    logger.info("and edit it.")
-    logger.info("--------------------------------------------------")
-    input("Press return key to end!")
-    exit(0)
-else:
-    with open("config.yaml") as fl:
-        config = yaml.load(fl, Loader=yaml.FullLoader)
-
-CLIENT_ID = config["CLIENT_ID"]
-CLIENT_SECRET = config["CLIENT_SECRET"]
-USERNAME = config["USERNAME"]
+# everything below is set up by configure() and main(), so the module can be imported
+# without a sim or twitch, e.g. by replay.py
+config = {}
+# the pubsub callback puts the redemptions in here, redeemFulfiller takes them out
+redeems = None
+# everything OBS shows about the redeems, as text files and as browser source
+overlay = None
+# camera windows of the redemptions start and end on this one
+redeem_scheduler = Scheduler("RedeemScheduler")
+ir = None
+twitch = None
+target_scope = [
+    AuthScope.CHANNEL_READ_REDEMPTIONS,
+    AuthScope.CHANNEL_MANAGE_REDEMPTIONS
+]
+helix = None
+reward_reconciler = None
+# the telemetry threads and the startup all reconcile the rewards
+reward_lock = Lock()
+# only one twitch login in the browser at a time, they share the redirect port
+auth_lock = Lock()
+# the other twitch channels of CHANNELS, their viewers switch the same camera
+channels = []
+# reward id -> channel (None for the main channel), so the status goes to the right broadcaster
+reward_channels = {}
+# every redemption is on disk before it goes into the queue, None in replays and tests
+journal = None
 
 twitch_secrets = {
     "TOKEN": None,
@@ -92,13 +139,12 @@ class State:
     DEFAULT_CAMERA = None
     REDEEM_IS_ACTIVE = False
     last_epoch = -1
-    prev_epoch = -1
     camswitch_epoch = -1
-    prev_pctspecon = 0
-    all_drivers_dict = {}
-    all_teams_dict = {}
+    camera_hold_until = -1
     track_length = 0
     currentCamera = "TV1"
+    # the roster we last logged that the driver or team to spot isn't in
+    missed_roster = -1
     global CAMERAS
     global RELOAD_CAMERAS
     global RELOAD_DRIVERS
@@ -129,13 +175,135 @@ def update_twitch_secrets(new_data):
 
 
 def update_cam_file(camname):
-    with open(redeem_cam_file, "w+") as fl:
-        fl.write(camname)
+    overlay.set(cam=camname)
 
 
 def update_username_file(twitch_user):
-    with open(redeem_user_file, "w+") as fl:
-        fl.write(twitch_user)
+    overlay.set(user=twitch_user)
+
+
+def refreshToken(tw, secrets, save):
+    token, refresh_token = refresh_access_token(secrets["REFRESH_TOKEN"],
+                                                config["CLIENT_ID"], config["CLIENT_SECRET"])
+    tw.set_user_authentication(token, target_scope, refresh_token)
+    secrets["TOKEN"] = token
+    secrets["REFRESH_TOKEN"] = refresh_token
+    # set_user_authentication() just validated it
+    secrets["VALID_UNTIL"] = time.time() + TOKEN_VALIDATE_INTERVAL
+    save(secrets)
+
+
+def refreshTwitchToken():
+    # the helix client calls this if twitch does not like our token anymore
+    refreshToken(twitch, twitch_secrets, update_twitch_secrets)
+
+
+def tokenExpiresIn(validation):
+    # seconds until the validated token expires, twitch says 0 for tokens which never expire
+    if validation.get("status", 200) != 200 or "expires_in" not in validation:
+        return 0
+    return validation["expires_in"] or TOKEN_VALIDATE_INTERVAL + TOKEN_EXPIRY_MARGIN
+
+
+def twitchLogin(username, secrets, save):
+    # sets up the user token of a channel, returns the twitch client and the user id of username.
+    # as long as the last validation is recent enough this needs no request at all,
+    # otherwise one validation (and a refresh only if the token is about to expire)
+    # pubsub and helix only need the user token, no app token round-trip
+    tw = Twitch(config["CLIENT_ID"], config["CLIENT_SECRET"], authenticate_app=False)
+    tw.session = None
+    auth = UserAuthenticator(tw, target_scope, force_verify=True)
+    login = username.lower()
+
+    token = secrets.get("TOKEN")
+    refresh_token = secrets.get("REFRESH_TOKEN")
+    if token and refresh_token and secrets.get("VALID_UNTIL", 0) > time.time() \
+            and secrets.get("LOGIN") == login and secrets.get("USER_ID"):
+        logger.info("TWITCH - %s - token needs no validation for another %.0f minutes"
+                    % (username, (secrets["VALID_UNTIL"] - time.time()) / 60, ))
+        tw.set_user_authentication(token, target_scope, refresh_token, validate=False)
+        return tw, secrets["USER_ID"]
+
+    validation = {}
+    if token and refresh_token:
+        validation = validate_token(token)
+        if validation.get("client_id") != config["CLIENT_ID"] \
+                or tokenExpiresIn(validation) < TOKEN_EXPIRY_MARGIN \
+                or any(s not in validation.get("scopes", []) for s in target_scope):
+            logger.info("TWITCH - %s - token is not valid anymore, refreshing it" % (username, ))
+            try:
+                token, refresh_token = refresh_access_token(refresh_token, config["CLIENT_ID"],
+                                                            config["CLIENT_SECRET"])
+                validation = validate_token(token)
+            except InvalidRefreshTokenException:
+                token = None
+    if not token or validation.get("client_id") != config["CLIENT_ID"]:
+        # this will open your default browser and prompt you with the twitch verification website
+        with auth_lock:
+            logger.info("TWITCH - please log in as %s in the browser" % (username, ))
+            token, refresh_token = auth.authenticate()
+        validation = validate_token(token)
+
+    tw.set_user_authentication(token, target_scope, refresh_token, validate=False)
+    secrets["TOKEN"] = token
+    secrets["REFRESH_TOKEN"] = refresh_token
+    if validation.get("login") == login:
+        user_id = validation["user_id"]
+    else:
+        # the token belongs to somebody else, we have to look the channel up
+        user_id = tw.get_users(logins=[username])["data"][0]["id"]
+    secrets["USER_ID"] = user_id
+    secrets["LOGIN"] = login
+    secrets["VALID_UNTIL"] = time.time() + min(TOKEN_VALIDATE_INTERVAL,
+                                               tokenExpiresIn(validation) - TOKEN_EXPIRY_MARGIN)
+    save(secrets)
+    return tw, user_id
+
+
+def channelNames(cfg):
+    return [p["USERNAME"].lower() for p in cfg.get("CHANNELS") or []]
+
+
+def loginMain():
+    global twitch
+    twitch, user_id = twitchLogin(config["USERNAME"], twitch_secrets, update_twitch_secrets)
+    return user_id
+
+
+def startPubSub(tw, user_id, cb=None):
+    pubsub = PubSub(tw)
+    pubsub.start()
+    # you can either start listening before or after you started pubsub.
+    return pubsub, pubsub.listen_channel_points(user_id, cb or callback)
+
+
+def sessionRunning():
+    return state.ir_connected and state.RELOAD_CAMERAS == 0
+
+
+def startRewards(user_id):
+    # the telemetry threads may already know the cameras of the session,
+    # whatever they want right now is what twitch gets
+    global reward_reconciler
+    with reward_lock:
+        reward_reconciler = RewardReconciler(helix, user_id, SCRIPTNAME)
+        reconcileMain(sessionRunning())
+
+
+def startChannel(ch):
+    # everything the main channel gets in main(), for one channel of CHANNELS
+    ch.twitch, ch.user_id = twitchLogin(ch.name, ch.secrets, ch.save_secrets)
+    ch.helix = HelixClient(config["CLIENT_ID"], lambda: ch.secrets["TOKEN"],
+                           lambda: refreshToken(ch.twitch, ch.secrets, ch.save_secrets),
+                           config.get("TWITCH_CONCURRENCY", 8), loop=runtime.loop)
+    ch.reward_reconciler = RewardReconciler(ch.helix, ch.user_id, SCRIPTNAME, ch.rewards_file)
+    ch.pubsub, ch.uuid = startPubSub(ch.twitch, ch.user_id, lambda uuid, data: callback(uuid, data, ch))
+    active = sessionRunning()
+    ch.reconcile(desiredrewards(ch.config) if active else [], knownrewardtitles(ch.config))
+
+
+def attachSim():
+    return irsdk.IRSDK(parse_yaml_async=True)
 
 
 def load_twitch_secrets():
@@ -143,7 +311,7 @@ def load_twitch_secrets():
         return json.loads(fl.read())
 
 
-def callback(uuid: UUID, data: dict) -> None:
+def callback(uuid: UUID, data: dict, channel=None) -> None:
     try:
         if data["type"] != "reward-redeemed":
             return
@@ -165,8 +333,16 @@ def callback(uuid: UUID, data: dict) -> None:
             tmpDict["reward_id"] = reward_id
             tmpDict["redemption_id"] = redemption_id
             tmpDict["title"] = resp_data["reward"]["title"]
-
-            redeems.append(tmpDict)
+            tmpDict["cost"] = resp_data["reward"].get("cost", 0)
+            # None for the main channel
+            tmpDict["channel"] = channel
+
+            if journal is None:
+                queueRedeem(tmpDict)
+            elif not journal.received(tmpDict, None if channel is None else channel.name,
+                                      lambda: queueRedeem(tmpDict)):
+                logger.info("TWITCH - redemption %s of %s came in twice, ignoring it"
+                            % (redemption_id, initiating_user, ))
         else:
             logger.info("TWITCH - User %s redeemed %s but it's not interesting for us."
                         % (initiating_user, resp_data["reward"]["title"], ))
@@ -177,858 +353,876 @@ def callback(uuid: UUID, data: dict) -> None:
         pass
 
 
-async def callback_task(payload):
-    try:
-        if DEBUG:
-            logger.debug("Running callback task...")
-
-        if not twitch.session:
-            twitch.session = aiohttp.ClientSession()
-
-        logger.info("callback task")
-
-    except Exception as e:
-        logger.critical("".join(traceback.TracebackException.from_exception(e).format()))
-        pass
+def queueRedeem(tmpRedeem):
+    redeems.put(tmpRedeem)
+    overlay.set(queue=len(redeems))
+
+
+def recoverRedeems(unfinished):
+    # what the last run still owed the viewers: statuses twitch didn't get are sent again,
+    # recent redemptions get their camera window, older ones are refunded
+    by_name = {ch.name: ch for ch in channels}
+    for tmpRedeem, status in unfinished:
+        if tmpRedeem["channel"] is not None:
+            if tmpRedeem["channel"] not in by_name:
+                logger.critical("Journal - redemption %s is for %s, which is not in CHANNELS anymore"
+                                % (tmpRedeem["redemption_id"], tmpRedeem["channel"], ))
+                continue
+            tmpRedeem["channel"] = by_name[tmpRedeem["channel"]]
+        if status is not None:
+            updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus(status))
+        elif time.time() - tmpRedeem["time"] > RESUME_MAX_AGE:
+            logger.info("Journal - refunding %s of %s from %s, it is too late for it"
+                        % (tmpRedeem["title"], tmpRedeem["username"], time.ctime(tmpRedeem["time"]), ))
+            updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.CANCELED)
+        else:
+            logger.info("Journal - resuming %s of %s" % (tmpRedeem["title"], tmpRedeem["username"], ))
+            queueRedeem(tmpRedeem)
+
+
+def redeemCar(tmpRedeem):
+    # the spotted car of the channel the viewer redeemed in
+    channel = tmpRedeem.get("channel")
+    if channel is None:
+        return state.CARTOSPECNUMBER
+    number = channel.spotted_car(roster, state.IS_TEAM_SESSION)
+    if number is None:
+        logger.info("Internal - the car of %s is not in this session, showing our car" % (channel.name, ))
+        return state.CARTOSPECNUMBER
+    return number
+
+
+def redeemWindowStart(tmpRedeem):
+    # runs on the scheduler at the start of the camera window. the camera was there when
+    # the window was booked, a session change or a disconnect since then may have taken it away
+    redeem_wait.observe(time.time() - tmpRedeem["enqueued"])
+    car = redeemCar(tmpRedeem)
+    if tmpRedeem["title"] == config.get("REWARD_TITLE_BATTLECAM"):
+        # the car at the back of the best battle, looking at the cars it fights with
+        battle = battle_index.best()
+        camTitle = config.get("CAMERA_BATTLE", "Chase")
+        if battle is not None and battle.cars[0] in roster.drivers and camTitle in state.CAMERAS:
+            logger.info("Internal - best battle: %s cars within %.1f seconds for %.0f seconds"
+                        % (battle.size, battle.spread, battle.duration(battle_index.epoch), ))
+            car = roster.drivers[battle.cars[0]]["CarNumber"]
+        else:
+            logger.info("Internal - there is no battle right now, showing our car")
+            camTitle = state.DEFAULT_CAMERA
+    elif tmpRedeem["title"] == config["REWARD_TITLE_RANDOMCAM"]:
+        # TV1 and Scenic hardly show the car
+        candidates = [c for c in state.CAMERAS if c != "TV1" and c != "Scenic"]
+        camTitle = None
+        if candidates:
+            camTitle = random.choice(candidates)
+            logger.info("Internal - the random cam will be %s"
+                        % (camTitle,))
+    else:
+        camTitle = tmpRedeem["title"]
 
+    if camTitle not in state.CAMERAS:
+        logger.info("Internal - there is no camera for %s in this session anymore, refunding %s"
+                    % (tmpRedeem["title"], tmpRedeem["username"], ))
+        updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.CANCELED)
+        return
 
-def redeemCamSwitch(tmpRedeem):
     state.REDEEM_IS_ACTIVE = True
     logger.info("Internal - Switching redeemed cam to %s"
-                % (tmpRedeem["title"],))
-    update_cam_file(tmpRedeem["title"])
+                % (camTitle,))
     update_username_file(tmpRedeem["username"])
-    if tmpRedeem["title"] == config["REWARD_TITLE_RANDOMCAM"]:
-        randomCamTitle = "TV1"
-        while randomCamTitle == "TV1" or randomCamTitle == "Scenic":
-            randomCamTitle = random.choice(list(state.CAMERAS))
-        logger.info("Internal - the random cam will be %s"
-                    % (randomCamTitle,))
-        update_cam_file(randomCamTitle)
-        switch_camera(state.CARTOSPECNUMBER, randomCamTitle)
-    else:
-        update_cam_file(tmpRedeem["title"])
-        switch_camera(state.CARTOSPECNUMBER, tmpRedeem["title"])
+    update_cam_file(camTitle)
+    try:
+        switch_camera(car, camTitle, force=True)
+    except Exception as e:
+        logger.critical("Internal - cannot switch to %s, refunding %s: %s" % (camTitle, tmpRedeem["username"], e, ))
+        state.REDEEM_IS_ACTIVE = False
+        updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.CANCELED)
+        return
 
     logger.info("Internal - locking cam for %s seconds"
                 % (config["CAMERA_SWITCH_TIME"],))
-    time.sleep(config["CAMERA_SWITCH_TIME"])
+    overlay.set(window_end=time.time() + config["CAMERA_SWITCH_TIME"])
+    # twitch gets told while the viewers are already watching their camera
+    updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.FULFILLED)
+
+
+def redeemWindowEnd(tmpRedeem):
+    # runs on the scheduler thread exactly when the camera window is over
     logger.info("Internal - redeem time %s seconds is over"
                 % (config["CAMERA_SWITCH_TIME"],))
-    update_cam_file("")
-    update_username_file("")
+    overlay.set(cam="", user="", window_end=0)
     state.REDEEM_IS_ACTIVE = False
+    redeems.release()
+    logger.info("Internal - Done processing... %s - %s" % (tmpRedeem["username"], tmpRedeem["title"], ))
 
 
-def updateRedeemStatus(tmpRedeem, status):
-    # trying to update the redeem
-    try:
-        tmp_redeem_list = [tmpRedeem["redemption_id"], ]
-        twitch.update_redemption_status(broadcaster_id=str(state.TWITCHUSERID),
-                                        reward_id=tmpRedeem["reward_id"],
-                                        redemption_ids=tmp_redeem_list,
-                                        status=status)
-        return True
-    except Exception as e:
-        logger.critical("TWITCH - Something went wrong while updating the redeem status: %s" % (e, ))
-        return False
+async def sendRedeemStatus(reward_id, redemption_ids, status):
+    # called by the status batcher with all waiting redemptions of one reward
+    channel = reward_channels.get(reward_id)
+    if channel is None:
+        await helix.update_redemption_status(str(state.TWITCHUSERID), reward_id, redemption_ids, status.value)
+    else:
+        await channel.helix.update_redemption_status(str(channel.user_id), reward_id, redemption_ids, status.value)
+    if journal is not None:
+        journal.done(redemption_ids)
+    logger.info("TWITCH - set %s redeems to %s" % (len(redemption_ids), status, ))
 
-def redeemFulfiller(r, stop):
-    while True:
-        if (len(r) > 0):
-            tmpRedeem = r.pop()
-            logger.info("Internal - User %s redeemed %s for %s seconds"
-                        % (tmpRedeem["username"], tmpRedeem["title"], config["CAMERA_SWITCH_TIME"], ))
 
-            redeemCamSwitch(tmpRedeem)
-            updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.FULFILLED)
-            #time.sleep(int(config["CAMERA_SWITCH_TIME"]))
-            logger.info("Internal - Done processing... %s - %s" % (tmpRedeem["username"], tmpRedeem["title"], ))
-        time.sleep(1)
-        if stop():
-            break
+def forgetRedeemStatus(redemption_ids):
+    # twitch won't ever take these, no need to try again after a restart
+    if journal is not None:
+        journal.done(redemption_ids)
 
 
-def redeemListInfo(r, stop):
+def updateRedeemStatus(tmpRedeem, status):
+    # the redeem status goes out together with others of the same reward
+    reward_channels[tmpRedeem["reward_id"]] = tmpRedeem.get("channel")
+    if journal is not None:
+        journal.decided(tmpRedeem["redemption_id"], status.value)
+    status_batcher.add(tmpRedeem["reward_id"], tmpRedeem["redemption_id"], status)
+
+async def redeemFulfiller(r):
+    # validates the redemptions and books the next camera window, the scheduler starts
+    # and ends it on time. only one window is booked ahead, the others wait in the queue
+    window_start = 0
+    window_end = 0
+    while True:
+        # the booked window has started and the next one can start in BOOK_AHEAD seconds
+        wait = max(window_start,
+                   window_end + config.get("CAMERA_SWITCH_MINIMUM_BETWEEN_REDEEMS", 0) - BOOK_AHEAD) - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        # wakes up the moment a redemption comes in
+        tmpRedeem = await r.get()
+        overlay.set(queue=len(r))
+        logger.info("Internal - User %s redeemed %s for %s seconds"
+                    % (tmpRedeem["username"], tmpRedeem["title"], config["CAMERA_SWITCH_TIME"], ))
+
+        if tmpRedeem["title"] != config["REWARD_TITLE_RANDOMCAM"] \
+                and tmpRedeem["title"] != config.get("REWARD_TITLE_BATTLECAM") \
+                and tmpRedeem["title"] not in state.CAMERAS:
+            logger.info("Internal - there is no camera %s in this session, refunding %s"
+                        % (tmpRedeem["title"], tmpRedeem["username"], ))
+            updateRedeemStatus(tmpRedeem, CustomRewardRedemptionStatus.CANCELED)
+        else:
+            now = time.time()
+            start = max(now, window_end + config.get("CAMERA_SWITCH_MINIMUM_BETWEEN_REDEEMS", 0))
+            window_start = start
+            window_end = start + config["CAMERA_SWITCH_TIME"]
+            redeem_scheduler.call_at(start, redeemWindowStart, tmpRedeem)
+            redeem_scheduler.call_at(window_end, redeemWindowEnd, tmpRedeem)
+            r.book()
+            logger.info("Internal - camera window for %s starts in %.1f seconds"
+                        % (tmpRedeem["username"], start - now, ))
+
+
+async def redeemListInfo(r):
+    # a line whenever the number of waiting redeems changed, at most once a second
     a = -1
     while True:
         if not len(r) == a:
-            logger.info("Internal - currently waiting redeems %s" % (len(r), ))
+            logger.info("Internal - currently waiting redeems %s, oldest waiting %.1fs, "
+                        "average wait %.1fs, %s redeems so far"
+                        % (len(r), r.oldest_age(), r.average_wait(), r.total_in, ))
             a = len(r)
-        time.sleep(1)
-        if stop():
-            break
-
-
-# here we check if we are connected to iracing
-# so we can retrieve some data
-def check_iracing():
-    if state.ir_connected and not (ir.is_initialized and ir.is_connected):
-        state.ir_connected = False
-        # don't forget to reset your State variables
-        state.last_car_setup_tick = -1
-        # we are shutting down ir library (clearing all internal variables)
-        ir.shutdown()
-        logger.info('iRacing - irsdk disconnected')
-        removerewards()
-        state.SEARCH_FOR_DRIVER = True
-        state.RELOAD_CAMERAS = 1
-        state.RELOAD_DRIVERS = 0
-        state.CAMERAS = {}
-        state.DRIVER_DICT = {}
-        state.DRIVER_LIST = []
-        state.SUBSESSIONID = -1
-        state.SESSIONID = -1
-        state.SESSIONNUM = -1
-        state.user_friends = False
-        state.user_friend_dict = {}
-        state.user_friend_insession = []
-        state.team_friends = False
-        state.team_friend_dict = {}
-        state.team_friend_insession = []
-        state.SESSIONNAME = "NO_SESSION"
-        state.SESSIONNUM = 0
-    elif not state.ir_connected and ir.startup() and ir.is_initialized and ir.is_connected:
-        state.ir_connected = True
-        logger.info('iRacing - irsdk connected')
-        if ir['WeekendInfo']:
-            tracklength = ir["WeekendInfo"]["TrackLength"]
-            try:
-                tracklength_km = re.search('([\d\.]+?)\ km.*$', tracklength).group(1)
-            except AttributeError:
-                tracklength_km = ''
-            state.track_length = float(tracklength_km) * 1000
-            logger.info('iRacing - The next events Category: %s'
-                  % (ir['WeekendInfo']['Category'], ))
-            logger.info("iRacing - Track: %s, %s, %s"
-                  % (ir['WeekendInfo']['TrackDisplayName'],
-                  ir['WeekendInfo']['TrackCity'],
-                  ir['WeekendInfo']['TrackCountry']))
-            #logger.info("iRacing - SessionID: %s, SubSessionID: %s"
-            #            % (ir['WeekendInfo']['SessionID'],
-            #               ir['WeekendInfo']['SubSessionID'], ))
-            #state.SESSIONID = ir['WeekendInfo']['SessionID']
-            #state.SUBSESSIONID = ir['WeekendInfo']['SubSessionID']
-            #state.SESSIONNUM = ir["SessionNum"]
-            if ir['WeekendInfo']['WeekendOptions']['StandingStart'] == 1:
-                standingstart = "standing"
-            else:
-                standingstart = "rolling"
-            logger.info("iRacing - Start type is %s start" % (standingstart, ))
+        await asyncio.sleep(1)
+        await r.changed.wait()
 
 
-def cameras():
-    logger.info("iRacing - reading cameras")
+# here we connect to iracing so we can retrieve some data,
+# the sim supervisor calls these next to the event loop
+def connectIracing():
+    if not (ir.startup() and ir.is_initialized and ir.is_connected):
+        return False
+    state.ir_connected = True
+    logger.info('iRacing - irsdk connected')
+    return True
+
+
+def iracingAlive():
+    return ir.is_initialized and ir.is_connected
+
+
+def disconnectIracing():
+    # runs next to the event loop. what the telemetry reader reads is cleared right here,
+    # before its next read, everything else on the loop between two frames
+    state.ir_connected = False
+    # we are shutting down ir library (clearing all internal variables)
+    ir.shutdown()
+    roster.clear()
+    session.clear()
+    speed_estimator.reset()
+    logger.info('iRacing - irsdk disconnected')
+    runtime.soon(resetIracing)
+
+
+def resetIracing():
+    # runs on the event loop after the sim went away
+    # don't forget to reset your State variables
+    state.last_car_setup_tick = -1
+    car_state.reset()
+    camera.reset()
+    battle_index.clear()
+    removerewards()
+    state.SEARCH_FOR_DRIVER = True
+    state.DRIVERTOSPECID = -1
+    state.TEAMTOSPECID = -1
+    state.missed_roster = -1
+    state.RELOAD_CAMERAS = 1
+    state.RELOAD_DRIVERS = 0
     state.CAMERAS = {}
+    state.DRIVER_DICT = {}
+    state.DRIVER_LIST = []
+    state.SUBSESSIONID = -1
+    state.SESSIONID = -1
+    state.SESSIONNUM = -1
+    state.user_friends = False
+    state.user_friend_dict = {}
+    state.user_friend_insession = []
+    state.team_friends = False
+    state.team_friend_dict = {}
+    state.team_friend_insession = []
+    state.SESSIONNAME = "NO_SESSION"
+    state.SESSIONNUM = 0
+
+
+def telemetryCheck():
+    # runs next to the event loop before every frame,
+    # the session context fires sessionChanged() right here if something changed,
+    # the loop applies it before it gets the frame
+    return sim.check() and session.refresh(ir) and roster.refresh(ir)
+
 
-    if ir["CameraInfo"]:
-        logger.debug("cameras - found CameraInfo")
-        if ir["CameraInfo"]["Groups"]:
-            logger.debug("cameras - found CameraInfo -> Groups")
-            for c in ir["CameraInfo"]["Groups"]:
-                state.CAMERAS[c["GroupName"]] = c["GroupNum"]
-                logger.info("cameras - setting %s - %s" % (c["GroupName"], c["GroupNum"], ))
+def cameras():
+    logger.info("iRacing - reading cameras")
+    state.CAMERAS = dict(session.cameras)
+    for c in state.CAMERAS:
+        logger.info("cameras - setting %s - %s" % (c, state.CAMERAS[c], ))
     logger.info("iRacing - finished reading cameras")
 
 
-def switch_camera(number, cam):
-    # logger.info("iRacing - Switching Camera to %s" % (cam, ))
-    ir.cam_switch_num(number, state.CAMERAS[cam], 0)
+def sendCameraCommand(number, group):
+    ir.cam_switch_num(number, group, 0)
+
+
+def switch_camera(number, cam, now=None, force=False):
+    # every caller goes through the camera commander, it drops repeated commands and keeps
+    # an automatic camera on screen for CAMERA_MIN_DWELL seconds. force is for the cameras
+    # somebody asked for (redemptions, spotting our car)
+    if now is None:
+        now = time.time()
+    if not camera.request(number, roster.by_car_number.get(number), state.CAMERAS[cam], now, force):
+        return False
     if not cam == state.currentCamera:
         logger.info("switch_camera - switching cam to %s" % (cam, ))
         state.currentCamera = cam
+        metrics.counter("irtcpr_camera_switches_total", "camera changes", camera=cam).inc()
+    return True
 
 
 def findteam(uid):
-    found_driver = False
-    if ir["DriverInfo"]:
-        for i in range(len(ir["DriverInfo"]["Drivers"])):
-            if ir["DriverInfo"]["Drivers"][i]["TeamID"] == int(uid):
-                state.CARTOSPECNUMBER = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                state.TEAMTOSPECID = i
-                logger.info("iRacing - spotting Team #%s - %s"
-                            % (state.CARTOSPECNUMBER,
-                               ir["DriverInfo"]["Drivers"][i]["TeamName"]))
-                switch_camera(state.CARTOSPECNUMBER, "Rear Chase")
-                time.sleep(2)
-                switch_camera(state.CARTOSPECNUMBER, state.DEFAULT_CAMERA)
-                found_driver = True
-                return False
-    else:
+    if not roster.drivers:
         return True
 
-    if not found_driver:
+    car_idx = roster.by_team_id.get(int(uid))
+    if car_idx is not None:
+        state.CARTOSPECNUMBER = roster.drivers[car_idx]["CarNumber"]
+        state.TEAMTOSPECID = car_idx
+        overlay.set(spotted_car=state.CARTOSPECNUMBER)
+        logger.info("iRacing - spotting Team #%s - %s"
+                    % (state.CARTOSPECNUMBER,
+                       roster.drivers[car_idx]["TeamName"]))
+        switch_camera(state.CARTOSPECNUMBER, "Rear Chase", state.last_epoch, force=True)
+        # autocamswitcher takes over after 2 seconds, no need to block the loop here
+        state.camera_hold_until = state.last_epoch + 2
+        return False
+
+    if state.missed_roster != roster.update:
+        state.missed_roster = roster.update
         logger.info("was not able to find the team %s in the current session" % (uid, ))
+    # keep looking, the team may still join
+    return True
 
 
 def finddriver(uid):
-    found_driver = False
-    if ir["DriverInfo"]:
-        for i in range(len(ir["DriverInfo"]["Drivers"])):
-            if ir["DriverInfo"]["Drivers"][i]["UserID"] == int(uid):
-                state.CARTOSPECNUMBER = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                switch_camera(state.CARTOSPECNUMBER, "Rear Chase")
-                time.sleep(2)
-                switch_camera(state.CARTOSPECNUMBER, state.DEFAULT_CAMERA)
-                found_driver = True
-                state.DRIVERTOSPECID = i
-                logger.info("iRacing - spotting Driver #%s - %s"
-                            % (state.CARTOSPECNUMBER,
-                               ir["DriverInfo"]["Drivers"][i]["UserName"]))
-                return False
-    else:
+    if not roster.drivers:
         return True
 
-    if not found_driver:
+    car_idx = roster.by_user_id.get(int(uid))
+    if car_idx is not None:
+        state.CARTOSPECNUMBER = roster.drivers[car_idx]["CarNumber"]
+        switch_camera(state.CARTOSPECNUMBER, "Rear Chase", state.last_epoch, force=True)
+        # autocamswitcher takes over after 2 seconds, no need to block the loop here
+        state.camera_hold_until = state.last_epoch + 2
+        state.DRIVERTOSPECID = car_idx
+        overlay.set(spotted_car=state.CARTOSPECNUMBER)
+        logger.info("iRacing - spotting Driver #%s - %s"
+                    % (state.CARTOSPECNUMBER,
+                       roster.drivers[car_idx]["UserName"]))
+        return False
+
+    if state.missed_roster != roster.update:
+        state.missed_roster = roster.update
         logger.info("was not able to find the user %s in the current session" % (uid, ))
+    # keep looking, the driver may still join
+    return True
 
 
 def removerewards():
-    all_existing_rewards = twitch.get_custom_reward(broadcaster_id=str(state.TWITCHUSERID))
-    for k in all_existing_rewards["data"]:
-        if SCRIPTNAME in k["prompt"]:
-            twitch.delete_custom_reward(broadcaster_id=str(state.TWITCHUSERID), reward_id=k["id"])
-            logger.info('TWITCH - removing reward %s' % (k["title"], ))
+    # nothing is wanted right now, our rewards get paused instead of deleted and recreated later
+    reconcilerewardslater(False)
 
 
-def createreward(user_id, i, tmpReward):
-    reward_created = 0
+def reconcilerewardslater(active=True):
+    # the event loop and the sim must not wait for twitch,
+    # the reconciles run one after the other on their own thread
+    def reconcile():
+        try:
+            reconcilerewards(active)
+        except Exception as e:
+            logger.critical("TWITCH - cannot set up the rewards: %s" % (e, ))
     try:
-        createdreward = twitch.create_custom_reward(broadcaster_id=user_id,
-                                                    title=i,
-                                                    prompt=tmpReward["prompt"],
-                                                    cost=tmpReward["cost"],
-                                                    global_cooldown_seconds=tmpReward["global_cooldown_seconds"],
-                                                    is_global_cooldown_enabled=tmpReward["is_global_cooldown_enabled"])
-        logger.info('TWITCH - setting up reward %s' % (i, ))
-        if DEBUG:
-            print(createdreward)
-        reward_created = 1
-    except Exception as e:
-        if DEBUG:
-            logger.info("TWITCH - cannot create reward %s" % (i, ))
-            logger.info("TWITCH - Exception is %s" % (e, ))
-
-    if reward_created == 0:
-        if DEBUG:
-            logger.info("TWITCH - check if reward is still there")
-
-    state.TWITCH_REWARDS = twitch.get_custom_reward(broadcaster_id=user_id)
+        reward_runner.submit(reconcile)
+    except RuntimeError:
+        # we are shutting down, the rewards stay as they are
+        pass
 
 
-def autocamswitcher():
-    switch_cam = 0
-    DRIVER_LIST = []
-    epoch_time = time.time()
-    if ir["DriverInfo"]:
-        if not state.IS_TEAM_SESSION:
-            spec_on = state.DRIVERTOSPECID
-        else:
-            spec_on = state.TEAMTOSPECID
-        pctspecon = ir["CarIdxLapDistPct"][spec_on]
-        #print("tracklength", ir["WeekendInfo"]["TrackLength"])
-        try:
-            tracklength = ir["WeekendInfo"]["TrackLength"]
-            tracklength_km = re.search('([\d\.]+?)\ km.*$', tracklength).group(1)
-        except AttributeError:
-            tracklength_km = ''
-            pass
-        tracklength_m = float(tracklength_km) * 1000
-        #print("tracklength", tracklength_m)
-        cur_pctspecon = pctspecon
-        if state.prev_pctspecon > 0.8 and cur_pctspecon < 0.2:
-            cur_pctspecon += 1
-            #print("over the line")
-        cur_m_specon = tracklength_m * cur_pctspecon
-        prev_m_specon = tracklength_m * state.prev_pctspecon
-        diff_m_specon = cur_m_specon - prev_m_specon
-        diff_epoch = epoch_time - state.prev_epoch
-        calc_speed = diff_m_specon / diff_epoch
+def desiredrewards(cfg=None):
+    # every reward we want to offer in the current session, cfg is the one of a channel
+    if cfg is None:
+        cfg = config
+    rewards = []
+    if cfg["CAMERA_SWITCH_ENABLED"]:
+        for i in cfg["CAMERAS"]:
+            tmpReward = {}
+            tmpReward["title"] = i
+            tmpReward[
+                "prompt"] = "Schaltet die Kamera auf " + i + ". Automatisch erstellt durch " + SCRIPTNAME
+            tmpReward["cost"] = cfg["CAMERA_SWITCH_COST"]
+            tmpReward["is_global_cooldown_enabled"] = cfg["CAMERA_SWITCH_COOLDOWN_ENABLED"]
+            tmpReward["global_cooldown_seconds"] = cfg["CAMERA_SWITCH_COOLDOWN"]
+            rewards.append(tmpReward)
+        tmpReward = {}
+        tmpReward["title"] = cfg["REWARD_TITLE_RANDOMCAM"]
+        tmpReward[
+            "prompt"] = "Schaltet die Kamera per Zufall. Automatisch erstellt durch " + SCRIPTNAME
+        tmpReward["cost"] = cfg["CAMERA_SWITCH_COST"]
+        tmpReward["is_global_cooldown_enabled"] = cfg["CAMERA_SWITCH_COOLDOWN_ENABLED"]
+        tmpReward["global_cooldown_seconds"] = cfg["CAMERA_SWITCH_COOLDOWN"]
+        rewards.append(tmpReward)
+        if cfg.get("REWARD_TITLE_BATTLECAM"):
+            tmpReward = {}
+            tmpReward["title"] = cfg["REWARD_TITLE_BATTLECAM"]
+            tmpReward[
+                "prompt"] = "Zeigt das beste Duell im Feld. Automatisch erstellt durch " + SCRIPTNAME
+            tmpReward["cost"] = cfg["CAMERA_SWITCH_COST"]
+            tmpReward["is_global_cooldown_enabled"] = cfg["CAMERA_SWITCH_COOLDOWN_ENABLED"]
+            tmpReward["global_cooldown_seconds"] = cfg["CAMERA_SWITCH_COOLDOWN"]
+            rewards.append(tmpReward)
+    if cfg["FRIENDS_SWITCH_ENABLED"]:
+        for i in state.user_friend_insession:
+            tmpReward = {}
+            tmpReward["title"] = state.user_friend_dict[i]
+            tmpReward[
+                "prompt"] = "Schaltet die Kamera auf den Fahrer %s. Automatisch erstellt durch %s" % (state.user_friend_dict[i], SCRIPTNAME,)
+            tmpReward["cost"] = cfg["FRIENDS_SWITCH_COST"]
+            tmpReward["is_global_cooldown_enabled"] = cfg["FRIENDS_SWITCH_COOLDOWN_ENABLED"]
+            tmpReward["global_cooldown_seconds"] = cfg["FRIENDS_SWITCH_COOLDOWN"]
+            rewards.append(tmpReward)
+        for i in state.team_friend_insession:
+            tmpReward = {}
+            tmpReward["title"] = state.team_friend_dict[i]
+            tmpReward[
+                "prompt"] = "Schaltet die Kamera auf das Team %s. Automatisch erstellt durch %s" % (state.team_friend_dict[i], SCRIPTNAME,)
+            tmpReward["cost"] = cfg["FRIENDS_SWITCH_COST"]
+            tmpReward["is_global_cooldown_enabled"] = cfg["FRIENDS_SWITCH_COOLDOWN_ENABLED"]
+            tmpReward["global_cooldown_seconds"] = cfg["FRIENDS_SWITCH_COOLDOWN"]
+            rewards.append(tmpReward)
+    return rewards
+
+
+def knownrewardtitles(cfg=None):
+    # rewards which will be wanted again as soon as there is a session (or the friend shows up)
+    if cfg is None:
+        cfg = config
+    titles = set(cfg["CAMERAS"])
+    titles.add(cfg["REWARD_TITLE_RANDOMCAM"])
+    if cfg.get("REWARD_TITLE_BATTLECAM"):
+        titles.add(cfg["REWARD_TITLE_BATTLECAM"])
+    titles.update(state.user_friend_dict.values())
+    titles.update(state.team_friend_dict.values())
+    return titles
+
+
+def reconcileMain(active):
+    # reward_lock must be held
+    if reward_reconciler is None:
+        # not connected to twitch (yet), e.g. in a replay
+        return
+    reward_reconciler.reconcile(desiredrewards() if active else [], knownrewardtitles())
+    state.TWITCH_REWARDS = reward_reconciler.rewards
+
+
+def reconcilerewards(active=True):
+    # active: the session runs and every channel gets the rewards it wants, else they are paused.
+    # only the differences between what we want and what twitch has are sent,
+    # the channels of CHANNELS all at the same time
+    pending = [reward_pool.submit(ch.reconcile, desiredrewards(ch.config) if active else [],
+                                  knownrewardtitles(ch.config)) for ch in channels]
+    with reward_lock:
+        reconcileMain(active)
+    for p in pending:
+        p.result()
+
+
+def autocamswitcher(frame):
+    # the automatic camera stays on the spotted car and its neighbours. battles elsewhere in
+    # the field (battle_index) are shown only when a viewer redeems the battle cam
+    epoch_time = frame.epoch
+    if not state.IS_TEAM_SESSION:
+        spec_on = state.DRIVERTOSPECID
+    else:
+        spec_on = state.TEAMTOSPECID
+    # nothing to follow until finddriver or findteam spotted a car
+    if roster.drivers and spec_on >= 0:
+        tracklength_m = session.track_length
+        # smoothed over the last telemetry samples on the sim clock, see estimator.py
+        calc_speed = float(frame.lap_speed[spec_on]) * tracklength_m
         calc_speed_kmh = int((calc_speed * 3600) / 1000)
-        #print(f"\033[2J")
-        #print("\r", Fore.RED, "travelled", diff_m_specon, "meters in", diff_epoch, "seconds - speed", calc_speed_kmh, "km/h", end="")
-
 
         # Method 1: Easy but not very precise way to calculate gaps
         # * Calculate distance fraction between 2 cars by substracting their CarIdxLapDistPct
         # * Multiply by track length to get distance in m
         # * Divide by speed to get time gap
-        DRIVER_LIST = []
-        driversindistance = 0
-        for i in range(len(ir["CarIdxLapDistPct"])):
-            #print("i=%i" % (i))
-            if i != int(spec_on) and i != 0:
-                if ir["CarIdxLapDistPct"][i] != -1:
-                    try:
-                        pctdriver=(ir["CarIdxLapDistPct"][i] - pctspecon) * tracklength_m / calc_speed
-                    except ZeroDivisionError:
-                        pctdriver = (ir["CarIdxLapDistPct"][i] - pctspecon) * tracklength_m / 0.1
-                    #if pctdriver < 0:
-                    #    pctdriver += 100
-                    #print("   ", i, pctdriver)
-                    #print("Number", ir["DriverInfo"]["Drivers"][i]["CarNumber"], "UID",
-                    #      ir["DriverInfo"]["Drivers"][i]["UserID"], ", Driver",
-                    #      ir["DriverInfo"]["Drivers"][i]["UserName"])
-                    if pctdriver <= (tracklength_m + 15):
-                        tmpDict = {}
-                        tmpDict["ID"] = i
-                        tmpDict["DriverName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                        tmpDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                        tmpDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                        tmpDict["Distance"] = pctdriver
-                        DRIVER_LIST.append(tmpDict)
-                    if pctdriver < 0.6 and pctdriver > -0.1:
-                        if ir["DriverInfo"]["Drivers"][i]["CarNumber"] != state.CARTOSPECNUMBER:
-                            driversindistance += 1
-                            switch_cam = 1
-                            switch_cam_number = state.CARTOSPECNUMBER
-                            #print("opponent", ir["DriverInfo"]["Drivers"][i]["CarNumber"], "is infront     ", pctdriver, "driversindistance:", driversindistance)
-                    elif pctdriver > -0.4 and pctdriver <= -0.1:
-                        driversindistance += 1
-                        switch_cam = 2
-                        switch_cam_number = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                        #rint("opponent", switch_cam_number, "is close behind", pctdriver, "driversindistance:", driversindistance)
-            elif ir["DriverInfo"]["Drivers"][i]["CarNumber"] != state.CARTOSPECNUMBER:
-                if ir["DriverInfo"]["Drivers"][i]["CarNumber"] != "0":
-                    tmpDict = {}
-                    tmpDict["ID"] = i
-                    tmpDict["DriverName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                    tmpDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                    tmpDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                    tmpDict["Distance"] = 0
-                    DRIVER_LIST.append(tmpDict)
-
-
-        relative_dict = sorted(DRIVER_LIST, key=lambda x: x['Distance'], reverse=True)
-
-        if SESSIONNAME != 'QUALIFY':
+        # Method 2: CarIdxEstTime difference, used for every car where the sim provides it
+        # the gap engine does this for the whole field at once
+        ignore_key = (roster.update, state.CARTOSPECNUMBER)
+        if gap_engine.ignore_key != ignore_key:
+            # only real cars in the roster count, and never the spotted car itself
+            ignore = [i for i in range(gap_engine.max_cars) if not roster.is_racer(i)]
+            ignore.append(roster.by_car_number.get(state.CARTOSPECNUMBER, -1))
+            gap_engine.set_ignore(ignore, ignore_key)
+        gap_result = gap_engine.update(frame.CarIdxLapDistPct, int(spec_on), tracklength_m, calc_speed,
+                                       frame.CarIdxEstTime)
+        switch_cam = gap_result.switch_cam
+        driversindistance = gap_result.driversindistance
+        if switch_cam == 2 and driversindistance == 1:
+            switch_cam_number = roster.drivers[gap_result.switch_cam_idx]["CarNumber"]
+
+        if epoch_time < state.camera_hold_until:
+            # finddriver() or findteam() just presented the spotted car, leave the camera there
+            pass
+        elif session.session_name != 'QUALIFY':
             if calc_speed_kmh > 60:
                 if epoch_time - state.camswitch_epoch > 5:
                     if switch_cam == 1 and driversindistance == 1:
                         #print("1,1 Switch Cam to", DRIVERTOSPECNUMBER, "Chase")
                         #ir.cam_switch_num(carNum, 19, 0)
                         if not state.REDEEM_IS_ACTIVE:
-                            switch_camera(state.CARTOSPECNUMBER, "Chase")
+                            switch_camera(state.CARTOSPECNUMBER, "Chase", epoch_time)
                     elif switch_cam == 2 and driversindistance == 1:
                         #print("2,1 Switch Cam to", switch_cam_number, "Gyro")
                         #ir.cam_switch_num(carNum, 2, 0)
                         #ir.cam_switch_num(switch_cam_number, CAMERA_DICT["Gyro"], 0)
                         if not state.REDEEM_IS_ACTIVE:
-                            switch_camera(switch_cam_number, "Gyro")
+                            switch_camera(switch_cam_number, "Gyro", epoch_time)
                     elif switch_cam > 0 and driversindistance > 1:
                         #print(">0,>1 Switch Cam to", DRIVERTOSPECNUMBER, "Far Chase")
                         #ir.cam_switch_num(carNum, 16, 0)
                         #ir.cam_switch_num(DRIVERTOSPECNUMBER, CAMERA_DICT["Far Chase"], 0)
                         if not state.REDEEM_IS_ACTIVE:
-                            switch_camera(state.CARTOSPECNUMBER, "Far Chase")
+                            switch_camera(state.CARTOSPECNUMBER, "Far Chase", epoch_time)
                     else:
                         #print("e Switch Cam to", DRIVERTOSPECNUMBER, "TV1")
                         #ir.cam_switch_num(carNum, 10, 0)
                         #ir.cam_switch_num(DRIVERTOSPECNUMBER, CAMERA_DICT["TV1"], 0)
                         if not state.REDEEM_IS_ACTIVE:
-                            switch_camera(state.CARTOSPECNUMBER, state.DEFAULT_CAMERA)
+                            switch_camera(state.CARTOSPECNUMBER, state.DEFAULT_CAMERA, epoch_time)
                     state.camswitch_epoch = epoch_time
-                    state.prev_epoch = epoch_time
-                    state.prev_pctspecon = pctspecon
                     # return epoch_time, epoch_time, pctspecon, DRIVERTOSPECNUMBER, SESSIONNAME
             else:
                 if not state.REDEEM_IS_ACTIVE:
-                    switch_camera(state.CARTOSPECNUMBER, "Chase")
+                    switch_camera(state.CARTOSPECNUMBER, "Chase", epoch_time)
                     state.camswitch_epoch = epoch_time
-                    state.prev_epoch = epoch_time
-                    state.prev_pctspecon = pctspecon
 
         else:
             #ir.cam_switch_num(DRIVERTOSPECNUMBER, CAMERA_DICT["Chase"], 0)
             if not state.REDEEM_IS_ACTIVE:
-                switch_camera(state.CARTOSPECNUMBER, "Chase")
+                switch_camera(state.CARTOSPECNUMBER, "Chase", epoch_time)
             state.camswitch_epoch = epoch_time
-            state.prev_epoch = epoch_time
-            state.prev_pctspecon = pctspecon
-            # return epoch_time, epoch_time, pctspecon, DRIVERTOSPECNUMBER, SESSIONNAME
-
-    state.camswitch_epoch = state.camswitch_epoch
-    state.prev_epoch = epoch_time
-    #state.prev_pctspecon = pctspecon
-    # return last_epoch, epoch_time, pctspecon, DRIVERTOSPECNUMBER, SESSIONNAME
-
-
-def DriverOrTeamsWorker(stop):
-    logger.info("DriverOrTeamsWorker - Thread starts")
-    this_all_drivers_dict = {}
-    log_once_disconnected = 0
-    log_once_connected = 0
-    sessionnum = state.SESSIONNUM
-    while not stop():
-        # try:
-            if state.ir_connected:
-                if log_once_connected == 0:
-                    logger.info("DriverOrTeamsWorker - connected to race server")
-                    log_once_connected = 1
-                    log_once_disconnected = 0
-
-                try:
-                    if ir["WeekendInfo"] and ir["DriverInfo"] and ir["SessionNum"]:
-                        #logger.info("found WeekendInfo and DriverInfo")
-                        # ir.freeze_var_buffer_latest()
-
-                        if state.IS_TEAM_SESSION == False:
-                            #logger.info("its not a team session")
-                            for i in range(len(ir["DriverInfo"]["Drivers"])):
-                                #logger.info("looping through %s" % (i,))
-                                carIdx = ir["DriverInfo"]["Drivers"][i]["CarIdx"]
-                                #logger.info("isspec %s" % (ir["DriverInfo"]["Drivers"][i]["IsSpectator"],))
-                                #logger.info("userid %s" % (ir["DriverInfo"]["Drivers"][i]["UserID"],))
-                                if not ir["DriverInfo"]["Drivers"][i]["UserID"] == -1 \
-                                        and not carIdx in this_all_drivers_dict:
-                                    if ir["DriverInfo"]["Drivers"][i]["IsSpectator"] == 0\
-                                            and not ir["DriverInfo"]["Drivers"][i]["UserID"] == -1:
-                                        #logger.info("carIdx %s" % (carIdx,))
-                                        if ir["DriverInfo"]["Drivers"][i]["UserID"] in state.user_friend_dict:
-                                            logger.info("DriverOrTeamsWorker - found a friend driver: %s" % (ir["DriverInfo"]["Drivers"][i]["UserName"],))
-                                            state.user_friend_insession.append(ir["DriverInfo"]["Drivers"][i]["UserID"])
-                                        try:
-                                            tmpDict = {}
-                                            tmpDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                                            tmpDict["UserName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                                            tmpDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                                            tmpDict["CarScreenName"] = ir["DriverInfo"]["Drivers"][i]["CarScreenName"]
-                                            tmpDict["IRating"] = ir["DriverInfo"]["Drivers"][i]["IRating"]
-                                            tmpDict["LicString"] = ir["DriverInfo"]["Drivers"][i]["LicString"]
-                                            tmpDict["PrevLapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpDict["PrevLapDistPctEpoch"] = time.time()
-                                            tmpDict["LapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpDict["LapDistPctEpoch"] = time.time()
-                                            this_all_drivers_dict[carIdx] = tmpDict
-                                        except Exception as e:
-                                            logger.critical("DriverOrTeamsWorker - something strange occured 598 %s" % (e,))
-                                            pass
-                                            time.sleep(1)
-                                        print(this_all_drivers_dict[carIdx])
-
-                            # next is position and speed
-                            if ir["CarIdxLapDistPct"]:
-                                for i in range(len(ir["DriverInfo"]["Drivers"])):
-                                    if ir["DriverInfo"]["Drivers"][i]["IsSpectator"] == 0\
-                                            and not ir["DriverInfo"]["Drivers"][i]["UserID"] == -1:
-                                        #logger.info("carIdx %s" % (i,))
-                                        if i in this_all_drivers_dict:
-                                            tmpPosDict = {}
-                                            tmpPosDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                                            tmpPosDict["UserName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                                            tmpPosDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                                            tmpPosDict["CarScreenName"] = ir["DriverInfo"]["Drivers"][i]["CarScreenName"]
-                                            tmpPosDict["IRating"] = ir["DriverInfo"]["Drivers"][i]["IRating"]
-                                            tmpPosDict["LicString"] = ir["DriverInfo"]["Drivers"][i]["LicString"]
-                                            tmpPosDict["PrevLapDistPct"] = this_all_drivers_dict[i]["LapDistPct"]
-                                            tmpPosDict["PrevLapDistPctEpoch"] = this_all_drivers_dict[i]["LapDistPctEpoch"]
-                                            tmpPosDict["LapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpPosDict["LapDistPctEpoch"] = time.time()
-                                            # now we know how far the driver moved, so let's calculate his speed
-                                            spd_pctlap = ir["CarIdxLapDistPct"][i]
-                                            # if he crosses the line now, we need to virtually move him for the calculcation
-                                            if tmpPosDict["PrevLapDistPct"] > 0.8 and spd_pctlap < 0.2:
-                                                spd_pctlap += 1
-                                            spd_meters = state.track_length * spd_pctlap
-                                            spd_prev_meters = state.track_length * tmpPosDict["PrevLapDistPct"]
-                                            spd_diff_meters = spd_meters - spd_prev_meters
-                                            spd_diff_epoch = tmpPosDict["LapDistPctEpoch"] - tmpPosDict["PrevLapDistPctEpoch"]
-                                            if spd_diff_epoch > 0:
-                                                spd_calulated_ms = spd_diff_meters / spd_diff_epoch
-                                            else:
-                                                spd_calulated_ms = spd_diff_meters / 0.1
-                                            spd_calulated_kmh = int((spd_calulated_ms * 3600) / 1000)
-                                            tmpPosDict["Speed_ms"] = spd_calulated_ms
-                                            tmpPosDict["Speed_kmh"] = spd_calulated_kmh
-                                            this_all_drivers_dict.pop(i, None)
-                                            this_all_drivers_dict[i] = tmpPosDict
-                                            #if int(state.CARTOSPECNUMBER) > -1:
-                                            #    if ir["DriverInfo"]["Drivers"][i]["CarNumber"] == state.CARTOSPECNUMBER \
-                                            #            or ir["DriverInfo"]["Drivers"][i]["UserID"] in state.user_friend_dict:
-                                            #        print(tmpPosDict)
-                        else:
-                            for i in range(len(ir["DriverInfo"]["Drivers"])):
-                                #logger.info("looping through %s" % (i,))
-                                carIdx = ir["DriverInfo"]["Drivers"][i]["CarIdx"]
-                                #logger.info("DriverOrTeamsWorker - carIdx %s" % (carIdx,))
-                                #logger.info("isspec %s" % (ir["DriverInfo"]["Drivers"][i]["IsSpectator"],))
-                                #logger.info("TeamID %s" % (ir["DriverInfo"]["Drivers"][i]["TeamID"],))
-                                # if carIdx in this_all_drivers_dict:
-                                #     logger.info("carIdx %s in dict: %s %s" % (carIdx,
-                                #                                               this_all_drivers_dict[carIdx]["CarNumber"],
-                                #                                               ir["DriverInfo"]["Drivers"][carIdx]["TeamName"],))
-                                if not ir["DriverInfo"]["Drivers"][i]["TeamID"] == 0 \
-                                        and not carIdx in this_all_drivers_dict:
-                                    logger.info("DriverOrTeamsWorker - carIdx %s" % (carIdx,))
-                                    if ir["DriverInfo"]["Drivers"][i]["IsSpectator"] == 0\
-                                            and not ir["DriverInfo"]["Drivers"][i]["TeamID"] == 0:
-                                        logger.info("DriverOrTeamsWorker - carIdx %s" % (carIdx,))
-                                        if ir["DriverInfo"]["Drivers"][i]["TeamID"] in state.team_friend_dict:
-                                            logger.info("DriverOrTeamsWorker - found a friend team: %s" % (ir["DriverInfo"]["Drivers"][i]["TeamName"],))
-                                            state.team_friend_insession.append(ir["DriverInfo"]["Drivers"][i]["TeamID"])
-                                        try:
-                                            tmpDict = {}
-                                            tmpDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                                            tmpDict["UserName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                                            tmpDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                                            tmpDict["TeamID"] = ir["DriverInfo"]["Drivers"][i]["TeamID"]
-                                            tmpDict["CarScreenName"] = ir["DriverInfo"]["Drivers"][i]["CarScreenName"]
-                                            tmpDict["IRating"] = ir["DriverInfo"]["Drivers"][i]["IRating"]
-                                            tmpDict["LicString"] = ir["DriverInfo"]["Drivers"][i]["LicString"]
-                                            tmpDict["PrevLapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpDict["PrevLapDistPctEpoch"] = time.time()
-                                            tmpDict["LapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpDict["LapDistPctEpoch"] = time.time()
-                                            this_all_drivers_dict[carIdx] = tmpDict
-                                        except Exception as e:
-                                            logger.critical("DriverOrTeamsWorker - something strange occured %s" % (e,))
-                                            pass
-                                            time.sleep(1)
-                                        print(this_all_drivers_dict[carIdx])
-
-                            # next is position and speed
-                            if ir["CarIdxLapDistPct"]:
-                                for i in range(len(ir["DriverInfo"]["Drivers"])):
-                                    if ir["DriverInfo"]["Drivers"][i]["IsSpectator"] == 0\
-                                            and not ir["DriverInfo"]["Drivers"][i]["TeamID"] == 0:
-                                        #logger.info("carIdx %s" % (i,))
-                                        if i in this_all_drivers_dict:
-                                            tmpPosDict = {}
-                                            tmpPosDict["CarNumber"] = ir["DriverInfo"]["Drivers"][i]["CarNumber"]
-                                            tmpPosDict["UserName"] = ir["DriverInfo"]["Drivers"][i]["UserName"]
-                                            tmpPosDict["UserID"] = ir["DriverInfo"]["Drivers"][i]["UserID"]
-                                            tmpPosDict["TeamID"] = ir["DriverInfo"]["Drivers"][i]["TeamID"]
-                                            tmpPosDict["CarScreenName"] = ir["DriverInfo"]["Drivers"][i]["CarScreenName"]
-                                            tmpPosDict["IRating"] = ir["DriverInfo"]["Drivers"][i]["IRating"]
-                                            tmpPosDict["LicString"] = ir["DriverInfo"]["Drivers"][i]["LicString"]
-                                            tmpPosDict["PrevLapDistPct"] = this_all_drivers_dict[i]["LapDistPct"]
-                                            tmpPosDict["PrevLapDistPctEpoch"] = this_all_drivers_dict[i]["LapDistPctEpoch"]
-                                            tmpPosDict["LapDistPct"] = ir["CarIdxLapDistPct"][i]
-                                            tmpPosDict["LapDistPctEpoch"] = time.time()
-                                            # now we know how far the driver moved, so let's calculate his speed
-                                            spd_pctlap = ir["CarIdxLapDistPct"][i]
-                                            # if he crosses the line now, we need to virtually move him for the calculcation
-                                            if tmpPosDict["PrevLapDistPct"] > 0.8 and spd_pctlap < 0.2:
-                                                spd_pctlap += 1
-                                            spd_meters = state.track_length * spd_pctlap
-                                            spd_prev_meters = state.track_length * tmpPosDict["PrevLapDistPct"]
-                                            spd_diff_meters = spd_meters - spd_prev_meters
-                                            spd_diff_epoch = tmpPosDict["LapDistPctEpoch"] - tmpPosDict["PrevLapDistPctEpoch"]
-                                            if spd_diff_epoch > 0:
-                                                spd_calulated_ms = spd_diff_meters / spd_diff_epoch
-                                            else:
-                                                spd_calulated_ms = spd_diff_meters / 0.1
-                                            spd_calulated_kmh = int((spd_calulated_ms * 3600) / 1000)
-                                            tmpPosDict["Speed_ms"] = spd_calulated_ms
-                                            tmpPosDict["Speed_kmh"] = spd_calulated_kmh
-                                            this_all_drivers_dict.pop(i, None)
-                                            this_all_drivers_dict[i] = tmpPosDict
-                                            #if int(state.CARTOSPECNUMBER) > -1:
-                                            #    if ir["DriverInfo"]["Drivers"][i]["CarNumber"] == state.CARTOSPECNUMBER \
-                                            #            or ir["DriverInfo"]["Drivers"][i]["UserID"] in state.user_friend_dict:
-                                            #        print(tmpPosDict)
-
-
-                        #ir.unfreeze_var_buffer_latest()
-                        time.sleep(1)
-                except Exception as e:
-                    logger.critical("DriverOrTeamsWorker - an exception occured %s" % (e,))
-                    pass
-                    time.sleep(1)
 
-            else:
-                this_all_drivers_dict = {}
-                state.all_drivers_dict = this_all_drivers_dict
-                state.track_length = 0
-                if log_once_disconnected == 0:
-                    logger.info("DriverOrTeamsWorker - disconnected from race server")
-                    log_once_disconnected = 1
-                    log_once_connected = 0
-
-
-        # except Exception as e:
-        #     logger.critical("DriverOrTeamsWorker - an exception occured %s" % (e, ))
-    logger.info("DriverOrTeamsWorker - Thread ends")
-
-def iRacingSessionWatcher(stop):
-    logger.info("iRacingSessionWatcher - Thread starts")
-
-    while not stop():
-        if state.ir_connected:
-            # logger.info("iRacingSessionWatcher - state   - sessionid: %s subsessionid: %s sessionnum: %s"
-            #            % (state.SESSIONID, state.SUBSESSIONID, state.SESSIONNUM, ))
-            # logger.info("iRacingSessionWatcher - session - sessionid: %s subsessionid: %s sessionnum: %s"
-            #            % (ir['WeekendInfo']["SessionID"], ir['WeekendInfo']["SubSessionID"], ir["SessionNum"], ))
-            if ir['WeekendInfo']:
-                if ir["SessionNum"] != state.SESSIONNUM \
-                        or state.SESSIONID != ir['WeekendInfo']["SessionID"] \
-                        or state.SUBSESSIONID != ir['WeekendInfo']['SubSessionID']:
-                    initiate_reloads = 0
-                    if ir["SessionNum"] != state.SESSIONNUM:
-                        logger.info("iRacingSessionWatcher - SessionNum changes from %s (%s) to %s (%s)"
-                                    % (state.SESSIONNUM,
-                                       state.SESSIONNAME,
-                                       ir["SessionNum"],
-                                       ir["SessionInfo"]["Sessions"][ir["SessionNum"]]["SessionName"]))
-                        SESSIONNUM = ir["SessionNum"]
-                        state.SESSIONNAME = ir["SessionInfo"]["Sessions"][int(SESSIONNUM)]["SessionName"]
-                        state.SESSIONNUM = ir["SessionNum"]
-                    if state.SESSIONID != ir['WeekendInfo']["SessionID"]:
-                        logger.info("iRacingSessionWatcher - SessionID changes from %s to %s"
-                                    % (state.SESSIONID,
-                                       ir['WeekendInfo']["SessionID"]))
-                        state.SESSIONID = ir['WeekendInfo']["SessionID"]
-                        initiate_reloads = 1
-
-                    if state.SUBSESSIONID != ir['WeekendInfo']["SubSessionID"]:
-                        logger.info("iRacingSessionWatcher - SubSessionID changes from %s to %s"
-                                    % (state.SUBSESSIONID,
-                                       ir['WeekendInfo']["SubSessionID"]))
-                        state.SUBSESSIONID = ir['WeekendInfo']["SubSessionID"]
-                        initiate_reloads = 1
-
-                    if initiate_reloads == 1:
-                        state.RELOAD_CAMERAS = 1
-                        state.RELOAD_DRIVERS = 1
-
-
-        time.sleep(2)
-    logger.info("iRacingSessionWatcher - Thread ends")
-
-def iRacingWorker(r, stop):
-        logger.info("iRacingWorker - Thread starts")
-        # who are we interested in?
-        druid = config["IRACING_ID"]
-        teamid = config["IRACING_TEAM_ID"]
-        logger.info("iRacing - will watch out for Driver %s" % (druid, ))
-        logger.info("iRacing - will watch out for Team %s" % (teamid, ))
-        state.DRIVERTOSPECID = druid
-        state.TEAMTOSPECID = teamid
 
+def updateDrivers(frame):
+    # everything DriverOrTeamsWorker does with one telemetry frame
+    if not roster.drivers:
+        return
+    # new drivers or teams can only show up with a new roster
+    if car_state.roster_update != roster.update:
+        for i, d in roster.drivers.items():
+            if car_state.known[i] or d["IsSpectator"] != 0:
+                continue
+            if state.IS_TEAM_SESSION:
+                if d["TeamID"] == 0:
+                    continue
+                if d["TeamID"] in state.team_friend_dict:
+                    logger.info("DriverOrTeamsWorker - found a friend team: %s" % (d["TeamName"],))
+                    state.team_friend_insession.append(d["TeamID"])
+            else:
+                if d["UserID"] == -1:
+                    continue
+                if d["UserID"] in state.user_friend_dict:
+                    logger.info("DriverOrTeamsWorker - found a friend driver: %s" % (d["UserName"],))
+                    state.user_friend_insession.append(d["UserID"])
+            car_state.add(i, d, float(frame.CarIdxLapDistPct[i]), frame.epoch)
+            logger.info("DriverOrTeamsWorker - carIdx %s #%s %s"
+                        % (i, d["CarNumber"], d["TeamName"] if state.IS_TEAM_SESSION else d["UserName"], ))
+        car_state.roster_update = roster.update
+
+    # next is position and speed
+    car_state.update(frame.CarIdxLapDistPct, frame.epoch, frame.lap_speed, session.track_length)
+
+
+def sessionChanged(event, ctx):
+    # called by the session context the moment iRacing reports a change, next to the
+    # event loop. the loop applies it with the session as it is now, a disconnect may clear it
+    runtime.soon(applySessionChange, event, copy.copy(ctx))
+
+
+def applySessionChange(event, ctx):
+    # runs on the event loop between two frames
+    if event == SESSION_NUM_CHANGED:
+        logger.info("iRacing - SessionNum changes from %s (%s) to %s (%s)"
+                    % (state.SESSIONNUM,
+                       state.SESSIONNAME,
+                       ctx.session_num,
+                       ctx.session_name))
+        state.SESSIONNUM = ctx.session_num
+        state.SESSIONNAME = ctx.session_name
+    elif event == SESSION_CHANGED:
+        logger.info("iRacing - SessionID changes from %s to %s, SubSessionID from %s to %s"
+                    % (state.SESSIONID, ctx.session_id, state.SUBSESSIONID, ctx.subsession_id, ))
+        state.SESSIONID = ctx.session_id
+        state.SUBSESSIONID = ctx.subsession_id
+        logger.info('iRacing - The next events Category: %s' % (ctx.category, ))
+        logger.info("iRacing - Track: %s, %s, %s" % (ctx.track_name, ctx.track_city, ctx.track_country, ))
+        logger.info("iRacing - Start type is %s start" % (ctx.start_type, ))
+        if ctx.team_racing:
+            logger.info("teamracing is set")
+            state.IS_TEAM_SESSION = True
+            state.SEARCH_FOR_TEAM = True
+            state.SEARCH_FOR_DRIVER = False
+        else:
+            logger.info("teamracing is NOT set")
+            state.IS_TEAM_SESSION = False
+            state.SEARCH_FOR_TEAM = False
+            state.SEARCH_FOR_DRIVER = True
         state.RELOAD_CAMERAS = 1
-        # looping iracing
-
-        while not stop():
-            if not state.ir_connected:
-                try:
-                    ir.startup()
-                except Exception as e:
-                    logger.critical("cannot startup IRSDK: %s" % (e,))
-                    exit(1)
+        state.RELOAD_DRIVERS = 1
+    elif event == CAMERAS_CHANGED:
+        state.RELOAD_CAMERAS = 1
+
+
+def iRacingStep(frame):
+    # everything iRacingWorker does with one telemetry frame
+    state.last_epoch = frame.epoch
+    # what the sim really shows, so the commander knows if a command got lost or was overruled
+    camera.observe(int(frame.CamCarIdx), int(frame.CamGroupNumber))
+    if roster.drivers:
+        # every close group of cars in the field, for the best battle reward
+        if battle_index.ignore_key != roster.update:
+            battle_index.set_ignore([i for i in range(battle_index.max_cars) if not roster.is_racer(i)],
+                                    roster.update)
+        battle_index.update(frame.CarIdxLapDistPct, frame.CarIdxLap, frame.CarIdxTrackSurface,
+                            frame.lap_speed, frame.epoch)
+    # identify the current session, the driver is in
+    if state.RELOAD_CAMERAS == 1:
+        logger.critical("iRacingWorker - calling cameras")
+        cameras()
+        if len(state.CAMERAS) > 1:
+            state.RELOAD_CAMERAS = 0
+
+        logger.info("next will be the rewards")
+
+        if state.RELOAD_CAMERAS == 0:
+            reconcilerewardslater()
+
+    if state.SEARCH_FOR_DRIVER or state.SEARCH_FOR_TEAM:
+        if state.SEARCH_FOR_DRIVER:
             try:
-                check_iracing()
+                state.SEARCH_FOR_DRIVER = finddriver(config["IRACING_ID"])
             except Exception as e:
-                logger.critical("iRacingWorker - Exception while checking iracing: %s" % (e,))
-            # if we are, then process data
-            if state.ir_connected and ir["WeekendInfo"] and ir["SessionInfo"] and ir["DriverInfo"]:
-                ir.freeze_var_buffer_latest()
-                # identify the current session, the driver is in
-                if state.RELOAD_CAMERAS == 1:
-                    logger.critical("iRacingWorker - calling cameras")
-                    # cameras()
-                    state.CAMERAS = {}
-                    if ir["CameraInfo"]:
-                        logger.debug("cameras - found CameraInfo")
-                        if ir["CameraInfo"]["Groups"]:
-                            logger.debug("cameras - found CameraInfo -> Groups")
-                            for c in ir["CameraInfo"]["Groups"]:
-                                state.CAMERAS[c["GroupName"]] = c["GroupNum"]
-                                logger.info("cameras - setting %s - %s" % (c["GroupName"], c["GroupNum"],))
-                    if len(state.CAMERAS) > 1:
-                        state.RELOAD_CAMERAS = 0
-
-                    if ir['WeekendInfo']:
-                        if ir["SessionNum"] != state.SESSIONNUM\
-                                or state.SESSIONID != ir["SessionID"]\
-                                or state.SUBSESSIONID != ir['WeekendInfo']['SubSessionID']:
-                            #logger.info("Current Session is %s" % (state.SESSIONNAME,))
-                            #state.SESSIONID = ir['WeekendInfo']["SessionID"]
-                            #logger.info("sessionid %s" % (state.SESSIONID,))
-                            #state.SUBSESSIONID = ir['WeekendInfo']["SubSessionID"]
-                            #logger.info("SUBSESSIONID %s" % (state.SUBSESSIONID,))
-                            SESSIONNUM = ir["SessionNum"]
-                            #state.SESSIONNAME = ir["SessionInfo"]["Sessions"][int(SESSIONNUM)]["SessionName"]
-                            #state.SESSIONNUM = ir["SessionNum"]
-                            #logger.info("SessionNum %s" % (SESSIONNUM,))
-                            #logger.info("Current Session is %s" % (state.SESSIONNAME, ))
-                            if ir['WeekendInfo']:
-                                if ir['WeekendInfo']["TeamRacing"] == 1:
-                                    logger.info("teamracing is set")
-                                    state.IS_TEAM_SESSION = True
-                                    state.SEARCH_FOR_TEAM = True
-                                    state.SEARCH_FOR_DRIVER = False
-                                else:
-                                    logger.info("teamracing is NOT set")
-                                    state.IS_TEAM_SESSION = False
-                                    state.SEARCH_FOR_TEAM = False
-                                    state.SEARCH_FOR_DRIVER = True
-
-                    logger.info("next will be the rewards")
-
-                    if config["CAMERA_SWITCH_ENABLED"] and state.RELOAD_CAMERAS == 0:
-                        for i in config["CAMERAS"]:
-                            tmpReward = {}
-                            tmpReward["title"] = i
-                            tmpReward[
-                                "prompt"] = "Schaltet die Kamera auf " + i + ". Automatisch erstellt durch " + SCRIPTNAME
-                            tmpReward["cost"] = config["CAMERA_SWITCH_COST"]
-                            tmpReward["is_global_cooldown_enabled"] = config["CAMERA_SWITCH_COOLDOWN_ENABLED"]
-                            tmpReward["global_cooldown_seconds"] = config["CAMERA_SWITCH_COOLDOWN"]
-
-                            createreward(user_id, i, tmpReward)
-                        tmpReward["title"] = config["REWARD_TITLE_RANDOMCAM"]
-                        tmpReward[
-                            "prompt"] = "Schaltet die Kamera per Zufall. Automatisch erstellt durch " + SCRIPTNAME
-                        tmpReward["cost"] = config["CAMERA_SWITCH_COST"]
-                        tmpReward["is_global_cooldown_enabled"] = config["CAMERA_SWITCH_COOLDOWN_ENABLED"]
-                        tmpReward["global_cooldown_seconds"] = config["CAMERA_SWITCH_COOLDOWN"]
-
-                        createreward(user_id, "Zufall", tmpReward)
-                    if config["FRIENDS_SWITCH_ENABLED"] and len(state.user_friend_insession) > 0:
-                        print(state.user_friend_insession)
-                        for i in state.user_friend_insession:
-                            tmpReward = {}
-                            tmpReward["title"] = state.user_friend_dict[i]
-                            tmpReward[
-                                "prompt"] = "Schaltet die Kamera auf den Fahrer %s. Automatisch erstellt durch %s" % (state.user_friend_dict[i], SCRIPTNAME,)
-                            tmpReward["cost"] = config["FRIENDS_SWITCH_COST"]
-                            tmpReward["is_global_cooldown_enabled"] = config["FRIENDS_SWITCH_COOLDOWN_ENABLED"]
-                            tmpReward["global_cooldown_seconds"] = config["FRIENDS_SWITCH_COOLDOWN"]
-                            createreward(user_id, state.user_friend_dict[i], tmpReward)
-                        print(state.team_friend_insession)
-                        for i in state.team_friend_insession:
-                            tmpReward = {}
-                            tmpReward["title"] = state.team_friend_dict[i]
-                            tmpReward[
-                                "prompt"] = "Schaltet die Kamera auf das Team %s. Automatisch erstellt durch %s" % (state.team_friend_dict[i], SCRIPTNAME,)
-                            tmpReward["cost"] = config["FRIENDS_SWITCH_COST"]
-                            tmpReward["is_global_cooldown_enabled"] = config["FRIENDS_SWITCH_COOLDOWN_ENABLED"]
-                            tmpReward["global_cooldown_seconds"] = config["FRIENDS_SWITCH_COOLDOWN"]
-                            createreward(user_id, state.team_friend_dict[i], tmpReward)
-
-
-            if state.ir_connected:
-                if state.SEARCH_FOR_DRIVER or state.SEARCH_FOR_TEAM:
-                    if ir['WeekendInfo']:
-                        if state.SEARCH_FOR_DRIVER:
-                            try:
-                                state.SEARCH_FOR_DRIVER = finddriver(druid)
-                            except Exception as e:
-                                logger.critical("iRacingWorker - calling finddriver caused an error %s" % (e,))
-                        else:
-                            state.SEARCH_FOR_TEAM = findteam(teamid)
-                else:
-                    autocamswitcher()
-
-            ir.unfreeze_var_buffer_latest()
-            time.sleep(1)
-
-        logger.info("iRacingWorker - Thread ends")
-
+                logger.critical("iRacingWorker - calling finddriver caused an error %s" % (e,))
+        else:
+            state.SEARCH_FOR_TEAM = findteam(config["IRACING_TEAM_ID"])
+    else:
+        autocamswitcher(frame)
+
+
+def configure(cfg):
+    # everything which only depends on the config, main() and replay.py start with this
+    global config, redeems, overlay
+    config = cfg
+    redeems = RedeemQueue(config.get("REDEEM_QUEUE_ORDER", ORDER_FIFO))
+    overlay = Overlay(redeem_cam_file if config.get("OVERLAY_FILES_ENABLED", True) else None,
+                      redeem_user_file if config.get("OVERLAY_FILES_ENABLED", True) else None,
+                      config.get("OVERLAY_PORT", 17564) if config.get("OVERLAY_SERVER_ENABLED", True) else None)
+
+    # CarIdx of the car we spot, finddriver and findteam look for it
+    state.DRIVERTOSPECID = -1
+    state.TEAMTOSPECID = -1
+    applySettings()
+
+
+def applySettings():
+    # everything which is taken from the config right away, again after every reload
+    state.DEFAULT_CAMERA = config["CAMERA_DEFAULT"]
+    camera.min_dwell = config.get("CAMERA_MIN_DWELL", 0)
+    gap_engine.hysteresis = config.get("CAMERA_GAP_HYSTERESIS", 0)
+    battle_index.gap = config.get("BATTLE_GAP", BATTLE_GAP)
+
+    # check if we should also watch for friends
+    if config["FRIENDS_SWITCH_ENABLED"] == True:
+        state.user_friends = True
+        tmp_dict = {}
+        for i in config["FRIENDS"]["DRIVERS"]:
+            logger.info("id %s nickname %s" % (i, config["FRIENDS"]["DRIVERS"][i],))
+            tmp_dict[i] = config["FRIENDS"]["DRIVERS"][i]
+        state.user_friend_dict = tmp_dict
+        tmp_dict = {}
+        for i in config["FRIENDS"]["TEAMS"]:
+            logger.info("id %s team nickname %s" % (i, config["FRIENDS"]["TEAMS"][i],))
+            tmp_dict[i] = config["FRIENDS"]["TEAMS"][i]
+        state.team_friend_dict = tmp_dict
+    else:
+        state.user_friends = False
+        state.user_friend_dict = {}
+        state.team_friend_dict = {}
 
-# initialize our State class
-state = State()
-# initialize IRSDK
-try:
-    ir = irsdk.IRSDK(parse_yaml_async=True)
-except Exception as e:
-    logger.critical("cannot initialize IRSDK: %s" % (e,))
 
-file_list = os.listdir()
+def reloadConfigLater(new):
+    # the config watcher reads and validates next to the event loop, the loop applies
+    # the new config between two frames, so nobody sees half of it
+    def reload():
+        try:
+            reloadConfig(new)
+        except Exception as e:
+            logger.critical("ConfigWatcher - cannot apply the new config: %s" % (e, ))
+    runtime.loop.call_soon_threadsafe(reload)
+
+
+def reloadConfig(new):
+    # runs on the event loop with a validated new config.yaml,
+    # only what changed is applied, the rewards get exactly the differences
+    global config
+    changed = changed_keys(config, new)
+    new = dict(new)
+    if "CHANNELS" in changed and channelNames(new) != channelNames(config):
+        # other channels need their own login and pubsub
+        changed.remove("CHANNELS")
+        logger.info("ConfigWatcher - the channels in CHANNELS changed, this needs a restart of %s" % (SCRIPTNAME, ))
+        new["CHANNELS"] = config.get("CHANNELS")
+    for k in [k for k in changed if k in RESTART_KEYS]:
+        logger.info("ConfigWatcher - %s changed, this needs a restart of %s" % (k, SCRIPTNAME, ))
+        if k in config:
+            new[k] = config[k]
+        else:
+            new.pop(k, None)
+        changed.remove(k)
+    if not changed:
+        return
+    logger.info("ConfigWatcher - applying the new %s" % (", ".join(changed), ))
+    config = new
+    applySettings()
+    # the channels take everything they don't set themselves from the main config
+    for ch, profile in zip(channels, config.get("CHANNELS") or []):
+        ch.update(config, profile)
+
+    if "IRACING_ID" in changed or "IRACING_TEAM_ID" in changed:
+        # somebody else to spot, iRacingWorker looks for them with the next frame
+        if state.IS_TEAM_SESSION:
+            state.SEARCH_FOR_TEAM = True
+        else:
+            state.SEARCH_FOR_DRIVER = True
+    if "FRIENDS" in changed or "FRIENDS_SWITCH_ENABLED" in changed:
+        # friends who are already on track don't show up in DriverOrTeamsWorker again
+        state.user_friend_insession = [d["UserID"] for d in roster.drivers.values()
+                                       if d["IsSpectator"] == 0 and d["UserID"] in state.user_friend_dict]
+        state.team_friend_insession = list({d["TeamID"] for d in roster.drivers.values()
+                                            if d["IsSpectator"] == 0 and d["TeamID"] in state.team_friend_dict})
+    if any(k in REWARD_KEYS for k in changed):
+        # without a session this still deletes the rewards which are gone from the config
+        reconcilerewardslater(sessionRunning())
 
-if secrets_fn not in file_list:
-    update_twitch_secrets(twitch_secrets)
-else:
-    twitch_secrets = load_twitch_secrets()
 
-TOKEN = twitch_secrets["TOKEN"]
-REFRESH_TOKEN = twitch_secrets["REFRESH_TOKEN"]
-headers = {"content-type": "application/json"}
+# initialize our State class
+state = State()
+gap_engine = GapEngine()
+battle_index = BattleIndex()
+roster = Roster()
+car_state = CarState()
+speed_estimator = SpeedEstimator()
+# twitch status updates must never hold up a camera window, they are sent in batches
+status_batcher = StatusBatcher(sendRedeemStatus, refused=forgetRedeemStatus)
+session = SessionContext()
+# the channels reconcile their rewards next to each other
+reward_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Rewards")
+# reconciles asked for by the telemetry, in order
+reward_runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="RewardRunner")
+# the event loop of main()
+runtime = Runtime()
+# attaches the sim and notices when it is gone
+sim = SimSupervisor(connectIracing, iracingAlive, disconnectIracing)
+session.subscribe(sessionChanged)
+# the only way camera commands get to the sim
+camera = CameraCommander(sendCameraCommand)
+redeem_wait = metrics.histogram("irtcpr_redeem_wait_seconds", "time from a redemption until its camera window starts",
+                                metrics.WAIT_BUCKETS)
+
+
+def main():
+    global twitch_secrets, helix, ir, journal
+
+    logger.info("---------------------------------------------")
+    logger.info("%s" % (SCRIPTNAME, ))
+    logger.info("Version: %s" % (VERSION))
+    logger.info("---------------------------------------------")
+
+    file_list = os.listdir()
+    if CONFIG_FILE not in file_list:
+        logger.info("There is no config.yaml config file.")
+        logger.info("Please copy the config_example.yaml to config.yaml")
+        logger.info("and edit it.")
+        logger.info("--------------------------------------------------")
+        input("Press return key to end!")
+        exit(0)
+
+    # the steps which don't need each other run at the same time:
+    # sim next to the twitch login, pubsub next to the rewards, tasks as soon as the sim is there
+    startup = Startup()
+
+    def loadConfig():
+        with open(CONFIG_FILE) as fl:
+            cfg = yaml.load(fl, Loader=yaml.FullLoader)
+        errors = validate_config(cfg)
+        if not errors:
+            configure(cfg)
+        return errors
+    errors = startup.run("config", loadConfig)
+    if errors:
+        for e in errors:
+            logger.critical("config.yaml - %s" % (e, ))
+        logger.info("--------------------------------------------------")
+        input("Press return key to end!")
+        exit(0)
+
+    # initialize IRSDK
+    sdk = startup.start("sim", attachSim)
+
+    # the redemptions the last run didn't finish, before pubsub brings new ones
+    journal = RedeemJournal(config.get("REDEEM_JOURNAL_FILE", JOURNAL_FILE))
+    try:
+        unfinished = startup.run("journal", journal.open)
+    except Exception as e:
+        logger.critical("Journal - cannot open %s, redemptions are not safe from a crash: %s"
+                        % (journal.filename, e, ))
+        journal = None
+        unfinished = []
 
-twitch = Twitch(CLIENT_ID, CLIENT_SECRET)
-twitch.session = None
+    if secrets_fn not in file_list:
+        update_twitch_secrets(twitch_secrets)
+    else:
+        twitch_secrets = load_twitch_secrets()
+    login = startup.start("twitch login", loginMain)
 
-# setting up Authentication and getting your user id
-twitch.authenticate_app([])
+    # every telemetry frame can be written to a recording for replay.py
+    recorder = None
+    if config.get("TELEMETRY_RECORD_FILE"):
+        recorder = Recorder(config["TELEMETRY_RECORD_FILE"], config)
+        logger.info("Internal - recording the telemetry to %s" % (recorder.filename, ))
 
-target_scope = [
-    AuthScope.CHANNEL_READ_REDEMPTIONS,
-    AuthScope.CHANNEL_MANAGE_REDEMPTIONS
-]
+    # everything that waits for something is a task on one event loop,
+    # helix runs on it too, so start it before twitch needs it
+    runtime.start()
 
-auth = UserAuthenticator(twitch, target_scope, force_verify=True)
+    # prometheus endpoint and summary log line
+    if config.get("METRICS_PORT", metrics.METRICS_PORT):
+        runtime.spawn("Metrics", metrics.serve, config.get("METRICS_PORT", metrics.METRICS_PORT))
+    summary_log = metrics.SummaryLog(config.get("METRICS_LOG_INTERVAL", 300))
 
-if (not TOKEN) or (not REFRESH_TOKEN):
-    # this will open your default browser and prompt you with the twitch verification website
-    TOKEN, REFRESH_TOKEN = auth.authenticate()
-else:
     try:
-        TOKEN, REFRESH_TOKEN = refresh_access_token(
-            REFRESH_TOKEN, CLIENT_ID, CLIENT_SECRET
-        )
-    except InvalidRefreshTokenException:
-        TOKEN, REFRESH_TOKEN = auth.authenticate()
-
-
-twitch_secrets["TOKEN"] = TOKEN
-twitch_secrets["REFRESH_TOKEN"] = REFRESH_TOKEN
-update_twitch_secrets(twitch_secrets)
-
-twitch.set_user_authentication(TOKEN, target_scope, REFRESH_TOKEN)
-
-user_id = twitch.get_users(logins=[USERNAME])["data"][0]["id"]
-state.TWITCHUSERID = user_id
-
-state.DEFAULT_CAMERA = config["CAMERA_DEFAULT"]
-
-# check if we should also watch for friends
-if config["FRIENDS_SWITCH_ENABLED"] == True:
-    state.user_friends = True
-    tmp_dict = {}
-    for i in config["FRIENDS"]["DRIVERS"]:
-        print(i)
-        print("id %s nickname %s" % (i, config["FRIENDS"]["DRIVERS"][i],))
-        tmp_dict[i] = config["FRIENDS"]["DRIVERS"][i]
-    state.user_friend_dict = tmp_dict
-    tmp_dict = {}
-    for i in config["FRIENDS"]["TEAMS"]:
-        print(i)
-        print("id %s team nickname %s" % (i, config["FRIENDS"]["TEAMS"][i],))
-        tmp_dict[i] = config["FRIENDS"]["TEAMS"][i]
-    state.team_friend_dict = tmp_dict
-
-
-# starting up PubSub
-pubsub = PubSub(twitch)
-pubsub.start()
-
-removerewards()
-
-# you can either start listening before or after you started pubsub.
-uuid = pubsub.listen_channel_points(user_id, callback)
-
-stop_threads = False
-
-redeemMonitorThread = Thread(target=redeemListInfo, args=(redeems, lambda: stop_threads, ))
-redeemWorkThread = Thread(target=redeemFulfiller, args=(redeems, lambda: stop_threads, ))
-iRacingThread = Thread(target=iRacingWorker, args=(redeems, lambda: stop_threads, ))
-iRacingDriverThread = Thread(target=DriverOrTeamsWorker, args=(lambda: stop_threads, ))
-iRacingSessionWatcherThread = Thread(target=iRacingSessionWatcher, args=(lambda: stop_threads, ))
-
-redeemMonitorThread.start()
-redeemWorkThread.start()
-iRacingThread.start()
-iRacingDriverThread.start()
-iRacingSessionWatcherThread.start()
-
-input("any key to end\n")
-stop_threads = True
-
-redeemMonitorThread.join()
-redeemWorkThread.join()
-iRacingThread.join()
-iRacingDriverThread.join()
-iRacingSessionWatcherThread.join()
-
-pubsub.unlisten(uuid)
-pubsub.stop()
+        ir = sdk.result()
+    except Exception as e:
+        logger.critical("cannot initialize IRSDK: %s" % (e,))
+
+    # who are we interested in?
+    logger.info("iRacing - will watch out for Driver %s" % (config["IRACING_ID"], ))
+    logger.info("iRacing - will watch out for Team %s" % (config["IRACING_TEAM_ID"], ))
+    state.RELOAD_CAMERAS = 1
+    # the telemetry is read next to the loop, the drivers and the camera logic
+    # are tasks on the loop which always get the newest frame
+    telemetry = TelemetryReader(ir, config.get("TELEMETRY_RATE", 10), telemetryCheck, speed_estimator, recorder, sim)
+    telemetry.subscribe("DriverOrTeamsWorker", updateDrivers)
+    telemetry.subscribe("iRacingWorker", iRacingStep)
+    # changes of config.yaml are applied while we run
+    config_watcher = ConfigWatcher(CONFIG_FILE, reloadConfigLater,
+                                   config.get("CONFIG_RELOAD_INTERVAL", RELOAD_INTERVAL))
+
+    # the camera does not need twitch, it can start right away
+    runtime.spawn("RedeemListInfo", redeemListInfo, redeems)
+    runtime.spawn("RedeemFulfiller", redeemFulfiller, redeems)
+    runtime.spawn("RedeemScheduler", redeem_scheduler.run)
+    runtime.spawn("StatusBatcher", status_batcher.run)
+    if journal is not None:
+        runtime.spawn("Journal", journal.run, runtime.blocking)
+    runtime.spawn("Overlay", overlay.run, runtime.blocking)
+    # nothing reads the telemetry while there is no sim, the supervisor looks for it now and then
+    runtime.spawn("SimSupervisor", sim.run, runtime.blocking)
+    runtime.spawn("TelemetryReader", telemetry.run, runtime.blocking)
+    if summary_log.interval:
+        runtime.spawn("MetricsLog", summary_log.run)
+    if config_watcher.interval:
+        runtime.spawn("ConfigWatcher", config_watcher.run, runtime.blocking)
+
+    user_id = login.result()
+    state.TWITCHUSERID = user_id
+    helix = HelixClient(config["CLIENT_ID"], lambda: twitch_secrets["TOKEN"], refreshTwitchToken,
+                        config.get("TWITCH_CONCURRENCY", 8), loop=runtime.loop)
+    listening = startup.start("pubsub", startPubSub, twitch, user_id)
+    rewards = startup.start("rewards", startRewards, user_id)
+    # more channels on the same sim, each with its own login, pubsub and rewards
+    channels.extend(Channel(config, profile) for profile in config.get("CHANNELS") or [])
+    started_channels = [(ch, startup.start("channel %s" % (ch.name, ), startChannel, ch)) for ch in channels]
+    pubsub, uuid = listening.result()
+    rewards.result()
+    for ch, started in started_channels:
+        try:
+            started.result()
+            logger.info("TWITCH - %s - channel points switch the camera too" % (ch.name, ))
+        except Exception as e:
+            logger.critical("TWITCH - %s - cannot set up the channel: %s" % (ch.name, e, ))
+    if unfinished:
+        startup.run("recovery", recoverRedeems, unfinished)
+    startup.ready()
+
+    input("any key to end\n")
+    # every task stops where it waits, the status batcher sends what is left
+    runtime.cancel()
+
+    if recorder is not None:
+        recorder.close()
+    pubsub.unlisten(uuid)
+    pubsub.stop()
+    # the reconciles still waiting need helix and helix needs the loop
+    reward_runner.shutdown(wait=True)
+    reward_pool.shutdown(wait=True)
+    helix.close()
+    for ch in channels:
+        ch.close()
+    runtime.stop()
+    if journal is not None:
+        # the last statuses the batcher sent
+        journal.close()
+
+
+if __name__ == "__main__":
+    main()
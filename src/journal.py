@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import metrics
+from runtime import Wakeup
+
+logger = logging.getLogger("iRTCPR")
+
+# every redemption is written to an append-only journal before it goes into the queue,
+# one json line per event. it is done as soon as twitch knows its status
+JOURNAL_FILE = "redeem_journal.log"
+# redemptions which came in before a crash are resumed if they are not older than this,
+# older ones are refunded, the viewer has long moved on
+RESUME_MAX_AGE = 300
+# statuses which still didn't make it to twitch after this long are given up
+FORGET_AFTER = 24 * 3600
+# how many redemption ids we remember to recognize a redemption pubsub sends twice
+INDEX_SIZE = 10000
+# the writer lingers this many seconds after the first line of a commit so the lines of
+# the same burst go along, or until LINGER_LINES lines are waiting
+LINGER = 0.005
+LINGER_LINES = 64
+# what of a redemption goes into the journal, enough to put it back into the queue
+FIELDS = ("reward_broadcaster_id", "username", "reward_id", "redemption_id", "title", "cost")
+
+# the events of a redemption
+RECEIVED = "received"
+# FULFILLED or CANCELED, not yet at twitch
+DECIDED = "decided"
+# twitch knows the status
+DONE = "done"
+
+
+class RedeemJournal:
+    # the redemptions we owe the viewers, safe from a crash or a restart.
+    # appending only puts a line into a buffer, the writer task writes and fsyncs
+    # everything appended so far in one go (group commit), so a burst of redemptions
+    # costs one fsync instead of one each. a redemption goes into the queue right after
+    # the fsync of its line, the pubsub thread never waits for the disk
+
+    def __init__(self, filename=JOURNAL_FILE, index_size=INDEX_SIZE):
+        self.filename = filename
+        self.index_size = index_size
+        self._fl = None
+        self._lock = Lock()
+        self._wakeup = Wakeup()
+        self._buffer = []
+        # called after the next fsync, in the order of the appends
+        self._then = []
+        # redemption ids we already know, oldest first
+        self._index = OrderedDict()
+        self.records = 0
+        self.commits = 0
+        self.duplicates = 0
+        self.records_count = metrics.counter("irtcpr_journal_records_total", "lines written to the redemption journal")
+        self.duplicate_count = metrics.counter("irtcpr_redeems_duplicate_total", "redemptions pubsub sent twice")
+        self.commit_seconds = metrics.histogram("irtcpr_journal_commit_seconds",
+                                                "time a write and fsync of the redemption journal takes")
+        metrics.gauge("irtcpr_journal_pending", "redemption journal lines waiting for the disk",
+                      fn=lambda: len(self._buffer))
+
+    def open(self):
+        # reads what is left from the last run, rewrites the journal with only that and
+        # returns it as [(record, status)], status None if it was never decided
+        unfinished = OrderedDict()
+        if os.path.exists(self.filename):
+            with open(self.filename, "rb") as fl:
+                for line in fl:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # the last line of a crash while writing
+                        continue
+                    if event["event"] == RECEIVED:
+                        self._remember(event["redeem"]["redemption_id"])
+                        unfinished[event["redeem"]["redemption_id"]] = [event, None]
+                    elif event["event"] == DECIDED and event["id"] in unfinished:
+                        unfinished[event["id"]][1] = event["status"]
+                    elif event["event"] == DONE:
+                        for i in event["ids"]:
+                            unfinished.pop(i, None)
+        now = time.time()
+        for i in [i for i, (event, _) in unfinished.items() if now - event["time"] > FORGET_AFTER]:
+            logger.critical("Journal - giving up on redemption %s of %s, it is more than a day old"
+                            % (i, unfinished[i][0]["redeem"]["username"], ))
+            del unfinished[i]
+
+        # compaction: the new journal starts with what is still open
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as fl:
+            for i, (event, status) in unfinished.items():
+                fl.write(self._line(event))
+                if status is not None:
+                    fl.write(self._line({"event": DECIDED, "id": i, "status": status}))
+            fl.flush()
+            os.fsync(fl.fileno())
+        os.replace(tmp, self.filename)
+        self._fl = open(self.filename, "ab")
+        if unfinished:
+            logger.info("Journal - %s redemptions from the last run are not done yet" % (len(unfinished), ))
+        return [(dict(event["redeem"], channel=event.get("channel"), time=event["time"]), status)
+                for event, status in unfinished.values()]
+
+    def _line(self, event):
+        return (json.dumps(event, separators=(",", ":")) + "\n").encode()
+
+    def _remember(self, redemption_id):
+        self._index[redemption_id] = True
+        if len(self._index) > self.index_size:
+            self._index.popitem(last=False)
+
+    def _append(self, event, then=None):
+        # self._lock must be held, the writer is woken up by the first line of a new commit
+        # and once the commit is full
+        self._buffer.append(self._line(event))
+        if then is not None:
+            self._then.append(then)
+        if len(self._buffer) == 1 or len(self._buffer) == LINGER_LINES:
+            self._wakeup.set()
+
+    def received(self, redeem, channel=None, then=None):
+        # False if we know the redemption already. then() is called once it is on disk
+        redemption_id = redeem["redemption_id"]
+        with self._lock:
+            if redemption_id in self._index:
+                self.duplicates += 1
+                self.duplicate_count.inc()
+                return False
+            self._remember(redemption_id)
+            self._append({"event": RECEIVED, "time": time.time(), "channel": channel,
+                          "redeem": {k: redeem.get(k) for k in FIELDS}}, then)
+        return True
+
+    def decided(self, redemption_id, status):
+        with self._lock:
+            self._append({"event": DECIDED, "id": redemption_id, "status": status})
+
+    def done(self, redemption_ids):
+        with self._lock:
+            self._append({"event": DONE, "ids": list(redemption_ids)})
+
+    def commit(self):
+        # writes and fsyncs everything appended so far, only ever called by one thread at a time
+        with self._lock:
+            if not self._buffer:
+                return 0
+            lines, self._buffer = self._buffer, []
+            then, self._then = self._then, []
+        started = time.perf_counter()
+        if self._fl is not None:
+            try:
+                self._fl.write(b"".join(lines))
+                self._fl.flush()
+                os.fsync(self._fl.fileno())
+            except Exception as e:
+                # the redemptions still work, they are just not safe from a crash
+                logger.critical("Journal - cannot write %s: %s" % (self.filename, e, ))
+        self.commit_seconds.observe(time.perf_counter() - started)
+        self.commits += 1
+        self.records += len(lines)
+        self.records_count.inc(len(lines))
+        for fn in then:
+            fn()
+        return len(lines)
+
+    async def run(self, blocking):
+        # blocking(fn) runs fn next to the event loop, the fsync must not hold it up
+        while True:
+            with self._lock:
+                empty = not self._buffer
+            if empty:
+                await self._wakeup.wait()
+            # a wake-up left over from lines which came during the last commit doesn't end it
+            deadline = time.monotonic() + LINGER
+            while True:
+                with self._lock:
+                    full = len(self._buffer) >= LINGER_LINES
+                left = deadline - time.monotonic()
+                if full or left <= 0:
+                    break
+                await self._wakeup.wait(left)
+            await blocking(self.commit)
+
+    def close(self):
+        self.commit()
+        if self._fl is not None:
+            self._fl.close()
+            self._fl = None
+            logger.info("Journal - %s lines in %s commits written to %s"
+                        % (self.records, self.commits, self.filename, ))
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from threading import Thread
+
+import aiohttp
+import yaml
+
+import iRTCPR
+from iRTCPR import state
+from helix import HelixClient
+from rewards import RewardReconciler
+from journal import RedeemJournal
+from channels import Channel
+from standin import TwitchStandIn, CHANNEL_POINTS_TOPIC
+
+logger = logging.getLogger("iRTCPR")
+
+# fires bursts of channel point redemptions at iRTCPR through a local twitch stand-in
+# and measures how long it takes until the camera switches.
+# python loadtest.py --redeems 500 --duration 10 --switch-time 0.1
+# with --channels 2 the first half of the redemptions comes from the main channel and the
+# second half from a co-streamer, --order fair shows the channels taking turns
+
+BROADCASTER_ID = "4711"
+CAMERAS = {"TV1": 1, "Chase": 2, "Gearbox": 3, "Chopper": 4, "Far Chase": 5, "Gyro": 6, "Nose": 7,
+           "Rear Chase": 8, "Scenic": 9}
+# queue depth is sampled this often
+SAMPLE_INTERVAL = 0.25
+# the random cam costs this many times as much as a camera
+RANDOMCAM_COST_FACTOR = 2
+
+
+class CameraIR:
+    # just enough of the sim for the camera windows of the redemptions
+    def __init__(self):
+        self.switches = 0
+
+    def cam_switch_num(self, car_number="1", group=1, camera=0):
+        self.switches += 1
+
+
+class PubSubClient:
+    # listens to the channel points topic like twitchAPI.pubsub does and hands every
+    # message to the callback of iRTCPR
+
+    def __init__(self, url, broadcaster_id, callback):
+        self.url = url
+        self.topic = CHANNEL_POINTS_TOPIC + str(broadcaster_id)
+        self.callback = callback
+        self.uuid = uuid.uuid4()
+        self.loop = asyncio.new_event_loop()
+        self._ws = None
+
+    def start(self):
+        listening = asyncio.run_coroutine_threadsafe(self._connect(), self.loop)
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        listening.result(10)
+        asyncio.run_coroutine_threadsafe(self._receive(), self.loop)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _connect(self):
+        self._session = aiohttp.ClientSession()
+        self._ws = await self._session.ws_connect(self.url)
+        await self._ws.send_str(json.dumps({"type": "LISTEN", "nonce": str(self.uuid),
+                                            "data": {"topics": [self.topic]}}))
+        response = json.loads((await self._ws.receive()).data)
+        if response.get("error"):
+            raise Exception("LISTEN failed: %s" % (response["error"], ))
+
+    async def _receive(self):
+        async for msg in self._ws:
+            data = json.loads(msg.data)
+            if data.get("type") == "MESSAGE" and data["data"]["topic"] == self.topic:
+                # twitchAPI calls the callback on its socket thread too
+                self.callback(self.uuid, json.loads(data["data"]["message"]))
+
+    async def _close(self):
+        await self._ws.close()
+        await self._session.close()
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="redemption load test of %s against a local twitch stand-in"
+                                                 % (iRTCPR.SCRIPTNAME, ))
+    parser.add_argument("--redeems", type=int, default=500, help="how many redemptions (default 500)")
+    parser.add_argument("--duration", type=float, default=10, help="spread over this many seconds (default 10)")
+    parser.add_argument("--switch-time", type=float, default=0.1,
+                        help="CAMERA_SWITCH_TIME for the test, the real value makes a long test (default 0.1)")
+    parser.add_argument("--between", type=float, default=0,
+                        help="CAMERA_SWITCH_MINIMUM_BETWEEN_REDEEMS for the test (default 0)")
+    parser.add_argument("--order", default="fifo", help="REDEEM_QUEUE_ORDER, fifo, cost or fair")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="channels the redemptions come from one after the other (default 1)")
+    parser.add_argument("--helix-latency", type=float, default=0.05,
+                        help="seconds the stand-in takes per helix request (default 0.05)")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of failing helix requests (default 0)")
+    parser.add_argument("--redeliver", type=float, default=0.05,
+                        help="share of redemptions pubsub sends twice (default 0.05)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="give up after this many seconds")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the log of iRTCPR")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    rnd = random.Random(args.seed)
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_example.yaml")) as fl:
+        config = yaml.load(fl, Loader=yaml.FullLoader)
+    config["CAMERA_SWITCH_TIME"] = args.switch_time
+    config["CAMERA_SWITCH_MINIMUM_BETWEEN_REDEEMS"] = args.between
+    config["REDEEM_QUEUE_ORDER"] = args.order
+    config["OVERLAY_FILES_ENABLED"] = False
+    config["OVERLAY_SERVER_ENABLED"] = False
+    iRTCPR.configure(config)
+
+    standin = TwitchStandIn(latency=args.helix_latency, seed=args.seed)
+    standin.start()
+
+    iRTCPR.ir = CameraIR()
+    state.ir_connected = True
+    state.CAMERAS = dict(CAMERAS)
+    state.CARTOSPECNUMBER = "5"
+    state.TWITCHUSERID = BROADCASTER_ID
+    runtime = iRTCPR.runtime
+    runtime.start()
+    iRTCPR.helix = HelixClient("stand-in", lambda: "stand-in", base_url=standin.helix_url,
+                               concurrency=config.get("TWITCH_CONCURRENCY", 8), loop=runtime.loop)
+    cache_dir = tempfile.mkdtemp()
+    iRTCPR.reward_reconciler = RewardReconciler(iRTCPR.helix, BROADCASTER_ID, iRTCPR.SCRIPTNAME,
+                                                os.path.join(cache_dir, "rewards.json"))
+    iRTCPR.reconcilerewards()
+    # the journal on the real disk, that's what the fsyncs cost
+    iRTCPR.journal = RedeemJournal(os.path.join(cache_dir, "journal.log"))
+    iRTCPR.journal.open()
+    # co-streamers with their own rewards at the stand-in, the helix client is shared
+    channels = [None]
+    for k in range(1, args.channels):
+        ch = Channel(config, {"USERNAME": "costreamer%s" % (k, ), "IRACING_ID": 0, "IRACING_TEAM_ID": 0})
+        ch.user_id = str(int(BROADCASTER_ID) + k)
+        ch.helix = iRTCPR.helix
+        ch.reward_reconciler = RewardReconciler(iRTCPR.helix, ch.user_id, iRTCPR.SCRIPTNAME,
+                                                os.path.join(cache_dir, "rewards_%s.json" % (k, )))
+        ch.reconcile(iRTCPR.desiredrewards(ch.config), iRTCPR.knownrewardtitles(ch.config))
+        channels.append(ch)
+    rewards = {}
+    for k, ch in enumerate(channels):
+        user_id = BROADCASTER_ID if ch is None else ch.user_id
+        rewards[k] = [r for r in standin.rewards.values() if r["broadcaster_id"] == user_id
+                      and (r["title"] in CAMERAS or r["title"] == config["REWARD_TITLE_RANDOMCAM"])]
+        # the random cam costs more, in "cost" order its redemptions skip the waiting cameras
+        for r in rewards[k]:
+            if r["title"] == config["REWARD_TITLE_RANDOMCAM"]:
+                r["cost"] = r["cost"] * RANDOMCAM_COST_FACTOR
+    # errors only for the redemptions, the rewards must be there
+    standin.error_rate = args.error_rate
+
+    # when did the event go out, when did its camera window start
+    sent = {}
+    switched = {}
+    costs = {}
+    # the channel of every camera window in the order they started
+    window_channels = []
+    window_start = iRTCPR.redeemWindowStart
+
+    def measuredWindowStart(tmpRedeem):
+        window_start(tmpRedeem)
+        switched[tmpRedeem["redemption_id"]] = time.time()
+        window_channels.append(channels.index(tmpRedeem["channel"]))
+    iRTCPR.redeemWindowStart = measuredWindowStart
+
+    runtime.spawn("RedeemFulfiller", iRTCPR.redeemFulfiller, iRTCPR.redeems)
+    runtime.spawn("RedeemScheduler", iRTCPR.redeem_scheduler.run)
+    runtime.spawn("StatusBatcher", iRTCPR.status_batcher.run)
+    runtime.spawn("Journal", iRTCPR.journal.run, runtime.blocking)
+    stop_sampler = False
+    listeners = []
+    for ch in channels:
+        if ch is None:
+            pubsub = PubSubClient(standin.pubsub_url, BROADCASTER_ID, iRTCPR.callback)
+        else:
+            pubsub = PubSubClient(standin.pubsub_url, ch.user_id,
+                                  lambda u, d, ch=ch: iRTCPR.callback(u, d, ch))
+        pubsub.start()
+        listeners.append(pubsub)
+
+    depth = []
+    started = time.time()
+
+    def sample():
+        while not stop_sampler:
+            depth.append((round(time.time() - started, 2), len(iRTCPR.redeems), iRTCPR.redeems.booked))
+            time.sleep(SAMPLE_INTERVAL)
+    sampler = Thread(target=sample)
+    sampler.start()
+
+    # the burst: evenly spread over the duration, the channels one after the other
+    for i in range(args.redeems):
+        due = started + args.duration * i / max(1, args.redeems)
+        if due > time.time():
+            time.sleep(due - time.time())
+        k = i * len(channels) // max(1, args.redeems)
+        reward = rnd.choice(rewards[k])
+        redemption_id = "redemption-%s" % (i, )
+        sent[redemption_id] = time.time()
+        costs[redemption_id] = reward["cost"]
+        copies = 2 if rnd.random() < args.redeliver else 1
+        standin.redeem(reward["broadcaster_id"], reward, "viewer%s" % (rnd.randrange(1000), ), redemption_id, copies)
+    burst_end = time.time()
+
+    # wait for every camera window and for twitch knowing about all of them
+    while time.time() - started < args.timeout:
+        pending = sum(1 for i in sent if standin.redemptions.get(i) == "UNFULFILLED")
+        if len(switched) == len(sent) and pending == 0:
+            break
+        time.sleep(0.1)
+    stop_sampler = True
+    sampler.join()
+    stopping = time.perf_counter()
+    runtime.cancel()
+    stop_seconds = time.perf_counter() - stopping
+    for pubsub in listeners:
+        pubsub.stop()
+    iRTCPR.helix.close()
+    runtime.stop()
+    standin.stop()
+    iRTCPR.journal.close()
+    for name in os.listdir(cache_dir):
+        os.remove(os.path.join(cache_dir, name))
+    os.rmdir(cache_dir)
+
+    latencies = [switched[i] - sent[i] for i in switched if i in sent]
+    by_cost = {}
+    for i in switched:
+        if i in sent:
+            by_cost.setdefault(costs[i], []).append(switched[i] - sent[i])
+    statuses = {}
+    for i in sent:
+        status = standin.redemptions.get(i)
+        statuses[status] = statuses.get(status, 0) + 1
+    report = {
+        "redeems": args.redeems,
+        "duration": round(burst_end - started, 3),
+        "switched": len(switched),
+        "statuses": statuses,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else 0,
+        },
+        "latency_by_cost": {cost: {"count": len(v), "p50": percentile(v, 50), "max": max(v)}
+                            for cost, v in sorted(by_cost.items())},
+        "window_channels": "".join(str(k) for k in window_channels),
+        "queue_depth_max": max(d[1] for d in depth) if depth else 0,
+        "windows_booked_max": max(d[2] for d in depth) if depth else 0,
+        "queue_depth": depth,
+        "helix_calls": iRTCPR.helix.calls,
+        "helix_errors": iRTCPR.helix.errors,
+        "status_batches": iRTCPR.status_batcher.calls,
+        "journal_lines": iRTCPR.journal.records,
+        "journal_commits": iRTCPR.journal.commits,
+        "duplicates": iRTCPR.journal.duplicates,
+        "stop_seconds": round(stop_seconds, 3),
+        "api_calls": {"%s %s" % k: v for k, v in sorted(standin.calls.items())},
+    }
+
+    print("%s redeems in %.1fs, %s camera switches, twitch statuses %s"
+          % (report["redeems"], report["duration"], report["switched"], statuses, ))
+    print("redemption -> camera switch: p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs"
+          % (report["latency"]["p50"], report["latency"]["p90"], report["latency"]["p99"], report["latency"]["max"], ))
+    for cost, v in report["latency_by_cost"].items():
+        print("  reward cost %6s: %5s redemptions, p50 %.3fs, max %.3fs" % (cost, v["count"], v["p50"], v["max"], ))
+    if len(channels) > 1:
+        # 0 is the main channel, 1 the first co-streamer
+        print("channel of every camera window:")
+        for i in range(0, len(report["window_channels"]), 100):
+            print("  %s" % (report["window_channels"][i:i + 100], ))
+    print("queue depth max %s, booked camera windows max %s"
+          % (report["queue_depth_max"], report["windows_booked_max"], ))
+    for t, waiting, booked in depth[::max(1, len(depth) // 20)]:
+        print("  %7.2fs  waiting %5s  booked %5s" % (t, waiting, booked, ))
+    print("api calls: %s" % (", ".join("%s=%s" % (k, v) for k, v in report["api_calls"].items()), ))
+    print("helix requests %s, errors %s, status batches %s"
+          % (report["helix_calls"], report["helix_errors"], report["status_batches"], ))
+    print("journal lines %s in %s commits, %s redemptions sent twice were ignored"
+          % (report["journal_lines"], report["journal_commits"], report["duplicates"], ))
+    print("stopping the tasks took %.3fs" % (report["stop_seconds"], ))
+    if args.json:
+        with open(args.json, "w") as fl:
+            fl.write(json.dumps(report, indent=2))
+    if len(switched) != len(sent):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import time
+import asyncio
+import bisect
+import logging
+from threading import Lock
+
+from aiohttp import web
+
+logger = logging.getLogger("iRTCPR")
+
+METRICS_PORT = 17565
+# seconds, for everything that happens per tick or per request
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds, for viewers waiting for their camera
+WAIT_BUCKETS = (0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+_lock = Lock()
+# name -> [kind, help, {labels: metric}]
+_families = {}
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        with _lock:
+            self.value += n
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        # if set, the value is read from here whenever somebody looks
+        self.fn = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return 0
+        return self.value
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # the largest value since the last summary log line
+        self.window_max = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.window_max:
+                self.window_max = value
+
+    def since(self, started):
+        # observes the seconds since a time.perf_counter() value
+        self.observe(time.perf_counter() - started)
+
+
+def _child(kind, name, help, labels, factory):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        family = _families.get(name)
+        if family is None:
+            family = [kind, help, {}]
+            _families[name] = family
+        metric = family[2].get(key)
+        if metric is None:
+            metric = factory()
+            family[2][key] = metric
+    return metric
+
+
+def counter(name, help, **labels):
+    return _child(COUNTER, name, help, labels, Counter)
+
+
+def gauge(name, help, fn=None, **labels):
+    metric = _child(GAUGE, name, help, labels, Gauge)
+    if fn is not None:
+        metric.fn = fn
+    return metric
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return _child(HISTOGRAM, name, help, labels, lambda: Histogram(buckets))
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % (",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs), )
+
+
+def render():
+    # everything in the prometheus text format
+    lines = []
+    with _lock:
+        families = [(name, f[0], f[1], list(f[2].items())) for name, f in sorted(_families.items())]
+    for name, kind, help, children in families:
+        lines.append("# HELP %s %s" % (name, help, ))
+        lines.append("# TYPE %s %s" % (name, kind, ))
+        for key, metric in children:
+            if kind == HISTOGRAM:
+                cumulative = 0
+                for le, n in zip(metric.buckets + ("+Inf", ), metric.counts):
+                    cumulative += n
+                    lines.append("%s_bucket%s %s" % (name, _labels(key, (("le", le), )), cumulative, ))
+                lines.append("%s_sum%s %s" % (name, _labels(key), repr(metric.sum), ))
+                lines.append("%s_count%s %s" % (name, _labels(key), metric.count, ))
+            elif kind == GAUGE:
+                lines.append("%s%s %s" % (name, _labels(key), metric.get(), ))
+            else:
+                lines.append("%s%s %s" % (name, _labels(key), metric.value, ))
+    return "\n".join(lines) + "\n"
+
+
+class SummaryLog:
+    # one log line with what happened since the last line: counters per minute,
+    # histograms as count, average and max, gauges as they are right now
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = {}
+        self._last_time = time.time()
+
+    def line(self):
+        now = time.time()
+        minutes = max(now - self._last_time, 1e-9) / 60
+        self._last_time = now
+        parts = []
+        with _lock:
+            families = [(name, f[0], list(f[2].items())) for name, f in sorted(_families.items())]
+        for name, kind, children in families:
+            short = name[len("irtcpr_"):] if name.startswith("irtcpr_") else name
+            for key, metric in children:
+                label = short + ("[%s]" % (",".join(str(v) for _, v in key), ) if key else "")
+                if kind == HISTOGRAM:
+                    count, total = metric.count, metric.sum
+                    last_count, last_total = self._last.get((name, key), (0, 0.0))
+                    self._last[(name, key)] = (count, total)
+                    if count == last_count:
+                        continue
+                    window_max = metric.window_max
+                    metric.window_max = 0.0
+                    parts.append("%s n=%s avg=%.1fms max=%.1fms"
+                                 % (label, count - last_count,
+                                    (total - last_total) / (count - last_count) * 1000, window_max * 1000, ))
+                elif kind == COUNTER:
+                    last = self._last.get((name, key), 0)
+                    self._last[(name, key)] = metric.value
+                    if metric.value != last:
+                        parts.append("%s %.1f/min" % (label, (metric.value - last) / minutes, ))
+                else:
+                    parts.append("%s=%s" % (label, metric.get(), ))
+        return ", ".join(parts)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            logger.info("Metrics - %s" % (self.line(), ))
+
+
+async def serve(port=METRICS_PORT):
+    # prometheus scrapes http://127.0.0.1:<port>/metrics, as long as the task runs
+    async def handler(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        logger.info("Metrics - available at http://127.0.0.1:%s/metrics" % (port, ))
+    except Exception as e:
+        logger.critical("Metrics - cannot start metrics server on port %s: %s" % (port, e, ))
+        await runner.cleanup()
+        return
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from threading import Lock
+
+from aiohttp import web, WSMsgType
+
+from runtime import Wakeup
+
+logger = logging.getLogger("iRTCPR")
+
+OVERLAY_PORT = 17564
+# changes within this time are written and pushed together
+COALESCE = 0.05
+# a failed write is tried again after this many seconds, then twice as long every time up to RETRY_MAX
+RETRY_MIN = 0.5
+RETRY_MAX = 8
+
+OVERLAY_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+body { margin: 0; font-family: sans-serif; font-size: 32px; color: white; text-shadow: 2px 2px 4px black; }
+#overlay { display: none; }
+</style>
+</head>
+<body>
+<div id="overlay"><span id="cam"></span> - <span id="user"></span> <span id="remaining"></span></div>
+<script>
+var state = {};
+function render() {
+    var active = state.cam !== "";
+    document.getElementById("overlay").style.display = active ? "block" : "none";
+    document.getElementById("cam").textContent = state.cam;
+    document.getElementById("user").textContent = state.user;
+    var remaining = Math.max(0, Math.ceil(state.window_end - Date.now() / 1000 + state.clock_offset));
+    document.getElementById("remaining").textContent = active ? "(" + remaining + "s)" : "";
+}
+function connect() {
+    var ws = new WebSocket("ws://" + location.host + "/ws");
+    ws.onmessage = function (event) {
+        state = JSON.parse(event.data);
+        state.clock_offset = state.now - Date.now() / 1000;
+        render();
+    };
+    ws.onclose = function () { setTimeout(connect, 1000); };
+}
+setInterval(render, 250);
+connect();
+</script>
+</body>
+</html>
+"""
+
+
+def write_atomic(filename, text):
+    # OBS never sees a half written file, the rename replaces it in one go
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w+") as fl:
+        fl.write(text)
+    os.replace(tmp_file, filename)
+
+
+class Overlay:
+    # collects everything the stream overlay shows, writes the text files for OBS
+    # and pushes the state as JSON to the browser sources connected via websocket
+
+    def __init__(self, cam_file=None, user_file=None, port=OVERLAY_PORT):
+        self.cam_file = cam_file
+        self.user_file = user_file
+        self.port = port
+        self.state = {
+            "cam": "",
+            "user": "",
+            "queue": 0,
+            "spotted_car": "",
+            "window_end": 0,
+        }
+        self._lock = Lock()
+        self._wakeup = Wakeup()
+        self._dirty = False
+        self._written = {}
+        self._clients = set()
+
+    def set(self, **changes):
+        with self._lock:
+            was_dirty = self._dirty
+            for k in changes:
+                if self.state.get(k) != changes[k]:
+                    self.state[k] = changes[k]
+                    self._dirty = True
+            wake = self._dirty and not was_dirty
+        if wake:
+            self._wakeup.set()
+
+    def snapshot(self):
+        with self._lock:
+            state = dict(self.state)
+        state["now"] = time.time()
+        state["remaining"] = max(0, state["window_end"] - state["now"])
+        return state
+
+    async def run(self, blocking):
+        # blocking(fn, *args) runs fn next to the event loop, for the files
+        runner = await self._start_server() if self.port else None
+        retry = RETRY_MIN
+        try:
+            while True:
+                with self._lock:
+                    dirty = self._dirty
+                if not dirty:
+                    await self._wakeup.wait()
+                    continue
+                # give other changes of the same moment the chance to come along
+                await asyncio.sleep(COALESCE)
+                with self._lock:
+                    self._dirty = False
+                state = self.snapshot()
+                failed = False
+                try:
+                    await blocking(self._write_files, state)
+                    retry = RETRY_MIN
+                except Exception as e:
+                    logger.critical("Overlay - cannot write files, trying again in %.1fs: %s" % (retry, e, ))
+                    # OBS would keep showing the old text until the next change
+                    with self._lock:
+                        self._dirty = True
+                    failed = True
+                await self._broadcast(json.dumps(state))
+                if failed:
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, RETRY_MAX)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+
+    def _write_files(self, state):
+        for filename, key in ((self.cam_file, "cam"), (self.user_file, "user")):
+            if filename and self._written.get(key) != state[key]:
+                write_atomic(filename, state[key])
+                self._written[key] = state[key]
+
+    async def _start_server(self):
+        app = web.Application()
+        app.router.add_get("/", self._index)
+        app.router.add_get("/state", self._state)
+        app.router.add_get("/ws", self._websocket)
+        runner = web.AppRunner(app)
+        try:
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", self.port).start()
+            logger.info("Overlay - browser source available at http://127.0.0.1:%s/" % (self.port, ))
+        except Exception as e:
+            logger.critical("Overlay - cannot start overlay server on port %s: %s" % (self.port, e, ))
+            await runner.cleanup()
+            return None
+        return runner
+
+    async def _index(self, request):
+        return web.Response(text=OVERLAY_HTML, content_type="text/html")
+
+    async def _state(self, request):
+        return web.json_response(self.snapshot())
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self._clients.add(ws)
+        try:
+            await ws.send_str(json.dumps(self.snapshot()))
+            async for msg in ws:
+                if msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self._clients.discard(ws)
+        return ws
+
+    async def _broadcast(self, message):
+        for ws in list(self._clients):
+            try:
+                await ws.send_str(message)
+            except Exception:
+                self._clients.discard(ws)
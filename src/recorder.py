@@ -0,0 +1,166 @@
+import json
+import mmap
+import time
+import struct
+import logging
+
+import numpy as np
+
+from telemetry import SCALAR_VARS, CAR_VARS
+
+logger = logging.getLogger("iRTCPR")
+
+# a recording is a header followed by chunks. every chunk starts with a tag and the length
+# of its payload. FRAM chunks hold one telemetry frame as a fixed size numpy record,
+# INFO chunks the raw session info yaml whenever iRacing increments SessionInfoUpdate.
+# the file is read through mmap, frames are never copied before they are used
+MAGIC = b"IRTCPRRC"
+FORMAT_VERSION = 1
+CHUNK = struct.Struct("<4sI")
+INFO = struct.Struct("<i")
+TAG_FRAME = b"FRAM"
+TAG_INFO = b"INFO"
+# how often the file buffer goes to disk, a crash loses at most this much
+FLUSH_INTERVAL = 1.0
+# config keys which never end up in a recording
+SECRET_KEYS = ("CLIENT_ID", "CLIENT_SECRET")
+
+SCALAR_TYPES = {
+    "SessionTick": np.int32,
+    "SessionTime": np.float64,
+    "SessionNum": np.int32,
+    "CamCarIdx": np.int32,
+    "CamGroupNumber": np.int32,
+}
+
+# missing: bit n is set if SCALAR_VARS[n] was None
+FRAME_DTYPE = np.dtype([("epoch", np.float64), ("session_info_update", np.int32), ("missing", np.uint32)]
+                       + [(name, SCALAR_TYPES.get(name, np.float64)) for name in SCALAR_VARS]
+                       + [(name, dtype, (64, )) for name, dtype in CAR_VARS])
+
+
+def session_info_raw(ir):
+    # the session info yaml exactly as the sim has it in the shared memory
+    start = ir._header.session_info_offset
+    return bytes(ir._shared_mem[start:start + ir._header.session_info_len]).rstrip(b"\x00")
+
+
+class Recorder:
+    # writes the telemetry frames of TelemetryReader to disk, one chunk per frame
+
+    def __init__(self, filename, config=None):
+        # the filename may contain strftime placeholders like %Y%m%d_%H%M%S
+        self.filename = time.strftime(filename)
+        self.frames = 0
+        self.revisions = 0
+        self.session_info_update = None
+        self._record = np.zeros(1, dtype=FRAME_DTYPE)
+        self._flushed = time.time()
+        header = {
+            "version": FORMAT_VERSION,
+            "started": time.time(),
+            "dtype": FRAME_DTYPE.descr,
+            # replay.py decides with the same config as the live run
+            "config": {k: v for k, v in (config or {}).items() if k not in SECRET_KEYS},
+        }
+        header = json.dumps(header, default=str).encode()
+        self._fl = open(self.filename, "wb")
+        self._fl.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def write(self, ir, frame):
+        # called by the telemetry reader while the var buffer is still frozen
+        if self._fl is None:
+            return
+        try:
+            if frame.session_info_update != self.session_info_update:
+                info = session_info_raw(ir)
+                self._fl.write(CHUNK.pack(TAG_INFO, INFO.size + len(info)))
+                self._fl.write(INFO.pack(frame.session_info_update))
+                self._fl.write(info)
+                self.session_info_update = frame.session_info_update
+                self.revisions += 1
+
+            record = self._record[0]
+            record["epoch"] = frame.epoch
+            record["session_info_update"] = frame.session_info_update
+            missing = 0
+            for bit, name in enumerate(SCALAR_VARS):
+                value = getattr(frame, name)
+                if value is None:
+                    missing |= 1 << bit
+                    value = 0
+                record[name] = value
+            record["missing"] = missing
+            for name, _ in CAR_VARS:
+                record[name] = getattr(frame, name)
+            self._fl.write(CHUNK.pack(TAG_FRAME, FRAME_DTYPE.itemsize))
+            self._fl.write(self._record.tobytes())
+            self.frames += 1
+
+            if frame.epoch - self._flushed > FLUSH_INTERVAL:
+                self._fl.flush()
+                self._flushed = frame.epoch
+        except Exception as e:
+            # the camera must keep working, even if the disk is full
+            logger.critical("Recorder - cannot write %s, recording stopped: %s" % (self.filename, e, ))
+            self.close()
+
+    def close(self):
+        if self._fl is not None:
+            self._fl.close()
+            self._fl = None
+            logger.info("Recorder - %s frames and %s session info revisions written to %s"
+                        % (self.frames, self.revisions, self.filename, ))
+
+
+class Recording:
+    # read only view of a recording. a truncated last chunk (crash while recording) is ignored
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fl = open(filename, "rb")
+        self._mm = mmap.mmap(self._fl.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a recording" % (filename, ))
+        offset = len(MAGIC)
+        header_len, = struct.unpack_from("<I", self._mm, offset)
+        offset += 4
+        self.header = json.loads(self._mm[offset:offset + header_len])
+        offset += header_len
+        if self.header["version"] != FORMAT_VERSION:
+            raise ValueError("%s has format version %s, we read %s"
+                             % (filename, self.header["version"], FORMAT_VERSION, ))
+        self.config = self.header["config"]
+        self.dtype = np.dtype([tuple(field) for field in self.header["dtype"]])
+
+        # one pass over the chunk headers, the payloads stay where they are
+        self.chunks = []
+        self.frames = 0
+        size = len(self._mm)
+        while offset + CHUNK.size <= size:
+            tag, length = CHUNK.unpack_from(self._mm, offset)
+            offset += CHUNK.size
+            if offset + length > size:
+                break
+            self.chunks.append((tag, offset, length))
+            if tag == TAG_FRAME:
+                self.frames += 1
+            offset += length
+
+    def __len__(self):
+        return self.frames
+
+    def __iter__(self):
+        # yields (session_info_update, session info yaml, frame record) in recorded order
+        session_info_update = -1
+        session_info = b""
+        for tag, offset, length in self.chunks:
+            if tag == TAG_INFO:
+                session_info_update, = INFO.unpack_from(self._mm, offset)
+                session_info = self._mm[offset + INFO.size:offset + length]
+            elif tag == TAG_FRAME:
+                yield session_info_update, session_info, np.frombuffer(self._mm, self.dtype, 1, offset)[0]
+
+    def close(self):
+        self._mm.close()
+        self._fl.close()
@@ -0,0 +1,121 @@
+import time
+import heapq
+import itertools
+from threading import Lock
+
+import metrics
+from runtime import Wakeup
+
+# possible values for REDEEM_QUEUE_ORDER in the config
+ORDER_FIFO = "fifo"
+ORDER_COST = "cost"
+ORDER_FAIR = "fair"
+
+
+class RedeemQueue:
+    # thread safe queue for the redemptions coming in from PubSub.
+    # get() sleeps on the event loop until something arrives, so the fulfiller starts working
+    # the moment a viewer redeems. in "fifo" order viewers are served in the order they paid,
+    # in "cost" order more expensive rewards go first (and fifo among equal costs),
+    # in "fair" order the channels take turns, so a busy channel can't starve the others
+
+    def __init__(self, order=ORDER_FIFO):
+        self.order = order
+        self._lock = Lock()
+        self._ready = Wakeup()
+        # set whenever a redemption comes or goes
+        self.changed = Wakeup()
+        self._heap = []
+        self._seq = itertools.count()
+        # "fair" order: the turn of the last redemption handed out and the next turn of every channel
+        self._turn = 0
+        self._next_turn = {}
+        # camera windows the fulfiller booked which are not over yet
+        self.booked = 0
+        # counters for monitoring
+        self.total_in = 0
+        self.total_out = 0
+        self.max_depth = 0
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        metrics.gauge("irtcpr_redeem_queue_depth", "redemptions waiting for their camera window, booked ones included",
+                      fn=self.backlog)
+        self.in_count = metrics.counter("irtcpr_redeems_total", "redemptions received")
+        self.wait_seconds = metrics.histogram("irtcpr_redeem_queue_wait_seconds",
+                                              "time a redemption waited in the queue", metrics.WAIT_BUCKETS)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def backlog(self):
+        with self._lock:
+            return len(self._heap) + self.booked
+
+    def book(self):
+        # a redemption which left the queue got its camera window
+        with self._lock:
+            self.booked += 1
+
+    def release(self):
+        # its camera window is over
+        with self._lock:
+            self.booked -= 1
+
+    def _priority(self, redeem):
+        if self.order == ORDER_COST:
+            return -redeem.get("cost", 0)
+        if self.order == ORDER_FAIR:
+            # the n-th waiting redemption of a channel waits for the n-th turn,
+            # a channel which was quiet starts at the current turn
+            channel = redeem.get("reward_broadcaster_id")
+            turn = max(self._turn, self._next_turn.get(channel, 0))
+            self._next_turn[channel] = turn + 1
+            return turn
+        return 0
+
+    def put(self, redeem):
+        redeem["enqueued"] = time.time()
+        with self._lock:
+            heapq.heappush(self._heap, (self._priority(redeem), next(self._seq), redeem))
+            self.total_in += 1
+            self.in_count.inc()
+            if len(self._heap) > self.max_depth:
+                self.max_depth = len(self._heap)
+        self._ready.set()
+        self.changed.set()
+
+    async def get(self):
+        # waits for the next redemption
+        while True:
+            redeem = self.pop()
+            if redeem is not None:
+                return redeem
+            await self._ready.wait()
+
+    def pop(self):
+        # the next redemption, None if nobody is waiting
+        with self._lock:
+            if not self._heap:
+                return None
+            priority, _, redeem = heapq.heappop(self._heap)
+            if self.order == ORDER_FAIR:
+                self._turn = priority
+            self.total_out += 1
+            self.last_wait = time.time() - redeem["enqueued"]
+            self.total_wait += self.last_wait
+            self.wait_seconds.observe(self.last_wait)
+        self.changed.set()
+        return redeem
+
+    def oldest_age(self):
+        # seconds the longest waiting redemption is already waiting
+        with self._lock:
+            if not self._heap:
+                return 0.0
+            return time.time() - min(r["enqueued"] for _, _, r in self._heap)
+
+    def average_wait(self):
+        if self.total_out == 0:
+            return 0.0
+        return self.total_wait / self.total_out
@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import hashlib
+import logging
+import argparse
+
+import irsdk
+import yaml
+
+import iRTCPR
+from recorder import Recording
+from telemetry import SCALAR_VARS, read_frame
+
+logger = logging.getLogger("iRTCPR")
+
+UTF8_SIGN = b"---\nWeekendInfo:\n Encoding: UTF8"
+
+
+class ReplayHeader:
+    # the part of the irsdk header the session info parser looks at
+    session_info_update = 0
+
+
+class ReplayIRSDK(irsdk.IRSDK):
+    # stands in for the sim: serves the recorded frames one after the other through the
+    # IRSDK interface and keeps every camera command instead of sending it.
+    # the session info yaml goes through the parser of pyirsdk, just like live.
+    # once we commanded a camera, the sim shows that one instead of the recorded camera
+
+    def __init__(self):
+        super().__init__(parse_yaml_async=False)
+        self.index = -1
+        self.record = None
+        self.session_info = b""
+        self.switches = []
+        # CamCarIdx, CamGroupNumber of the last camera command
+        self.camera = None
+        self._replay_header = ReplayHeader()
+        self._names = ()
+
+    def advance(self, session_info_update, session_info, record):
+        # record None means the sim went away
+        self.index += 1
+        self.record = record
+        if record is not None:
+            self._names = record.dtype.names
+        self.session_info = session_info
+        self._replay_header.session_info_update = session_info_update
+        self._header = self._replay_header
+
+    def startup(self, test_file=None, dump_to=None):
+        self.is_initialized = self.record is not None
+        return self.is_initialized
+
+    @property
+    def is_connected(self):
+        return self.record is not None
+
+    @property
+    def session_info_update(self):
+        return self._replay_header.session_info_update
+
+    @property
+    def is_session_info_utf8(self):
+        return self.session_info[:len(UTF8_SIGN)] == UTF8_SIGN
+
+    def __getitem__(self, key):
+        if self.camera is not None and key in ("CamCarIdx", "CamGroupNumber"):
+            return self.camera[key == "CamGroupNumber"]
+        if key in self._names:
+            if key in SCALAR_VARS and self.record["missing"] & (1 << SCALAR_VARS.index(key)):
+                return None
+            value = self.record[key]
+            return value.item() if value.ndim == 0 else value
+        if key in SCALAR_VARS:
+            # not in this recording
+            return None
+        return self._get_session_info(key)
+
+    def _get_session_info_binary(self, key):
+        # same search as pyirsdk does in the shared memory
+        start = self.session_info.find(b"\n%s:\n" % (key.encode(), ))
+        if start == -1:
+            return None
+        end = self.session_info.find(b"\n\n", start + 1)
+        if end == -1:
+            return None
+        return self.session_info[start + 1:end]
+
+    def freeze_var_buffer_latest(self):
+        pass
+
+    def unfreeze_var_buffer_latest(self):
+        pass
+
+    def _wait_valid_data_event(self):
+        return True
+
+    def cam_switch_num(self, car_number="1", group=1, camera=0):
+        session_time = None if self.record is None else float(self.record["SessionTime"])
+        self.switches.append((self.index, session_time, str(car_number), int(group), int(camera)))
+        car_idx = -1
+        for d in (self["DriverInfo"] or {}).get("Drivers", []):
+            if str(d["CarNumber"]) == str(car_number):
+                car_idx = d["CarIdx"]
+        self.camera = (car_idx, int(group))
+
+
+def replay(recording, config):
+    # runs the recording through the same code as the telemetry threads of iRTCPR.py,
+    # one frame after the other and as fast as possible. returns the camera commands
+    iRTCPR.configure(config)
+    ir = ReplayIRSDK()
+    iRTCPR.ir = ir
+    # the recording is the sim, every frame it is there or not. no probe and no backoff
+    iRTCPR.sim.probe = None
+    seq = 0
+    for session_info_update, session_info, record in recording:
+        ir.advance(session_info_update, session_info, record)
+        if not iRTCPR.sim.connect() or not iRTCPR.telemetryCheck():
+            continue
+        seq += 1
+        frame = read_frame(ir, seq, iRTCPR.speed_estimator, float(record["epoch"]))
+        iRTCPR.updateDrivers(frame)
+        iRTCPR.iRacingStep(frame)
+    ir.advance(-1, b"", None)
+    iRTCPR.telemetryCheck()
+    return ir.switches
+
+
+def format_switches(switches):
+    lines = ["frame,session_time,car_number,group,camera"]
+    for index, session_time, car_number, group, camera in switches:
+        lines.append("%s,%s,%s,%s,%s" % (index, "" if session_time is None else "%.4f" % (session_time, ),
+                                         car_number, group, camera, ))
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replays a telemetry recording of %s without the sim"
+                                                 % (iRTCPR.SCRIPTNAME, ))
+    parser.add_argument("recording", help="file written with TELEMETRY_RECORD_FILE")
+    parser.add_argument("--config", help="use this config.yaml instead of the one stored in the recording")
+    parser.add_argument("--out", help="write the camera commands as csv to this file")
+    parser.add_argument("--expect", help="compare the camera commands with this csv, exit code 1 if they differ")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the camera logic")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    recording = Recording(args.recording)
+    config = recording.config
+    if args.config:
+        with open(args.config) as fl:
+            config = yaml.load(fl, Loader=yaml.FullLoader)
+
+    started = time.perf_counter()
+    switches = replay(recording, config)
+    elapsed = time.perf_counter() - started
+
+    result = format_switches(switches)
+    print("%s frames, %s camera commands in %.2fs (%.0f frames/s)"
+          % (len(recording), len(switches), elapsed, len(recording) / elapsed if elapsed else 0, ))
+    print("sha256 of the camera commands: %s" % (hashlib.sha256(result.encode()).hexdigest(), ))
+    if args.out:
+        with open(args.out, "w") as fl:
+            fl.write(result)
+
+    if args.expect:
+        with open(args.expect) as fl:
+            expected = fl.read()
+        if expected != result:
+            expected = expected.splitlines()
+            got = result.splitlines()
+            for i in range(max(len(expected), len(got))):
+                a = expected[i] if i < len(expected) else "<nothing>"
+                b = got[i] if i < len(got) else "<nothing>"
+                if a != b:
+                    print("camera commands differ at line %s: expected %s, got %s" % (i + 1, a, b, ))
+                    break
+            sys.exit(1)
+        print("camera commands are the same as in %s" % (os.path.basename(args.expect), ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import json
+import logging
+
+from helix import HelixError
+
+logger = logging.getLogger("iRTCPR")
+
+REWARD_CACHE_FILE = "twitch_rewards.json"
+# the fields of a reward we set up ourselves and compare against twitch
+REWARD_FIELDS = ("prompt", "cost", "is_global_cooldown_enabled", "global_cooldown_seconds", "is_paused")
+
+
+def reward_settings(reward):
+    # helix reports the cooldown as a nested dict, we send it flat
+    settings = {}
+    for k in REWARD_FIELDS:
+        if k in reward:
+            settings[k] = reward[k]
+    cooldown = reward.get("global_cooldown_setting")
+    if cooldown:
+        settings["is_global_cooldown_enabled"] = cooldown["is_enabled"]
+        settings["global_cooldown_seconds"] = cooldown["global_cooldown_seconds"]
+    return settings
+
+
+class RewardReconciler:
+    # compares the rewards we want with the rewards twitch has and only sends the differences.
+    # title -> reward is kept on disk, so after a restart we don't even have to ask twitch
+
+    def __init__(self, helix, broadcaster_id, marker, cache_file=REWARD_CACHE_FILE):
+        self.helix = helix
+        self.broadcaster_id = str(broadcaster_id)
+        # only rewards with this in their prompt belong to us
+        self.marker = marker
+        self.cache_file = cache_file
+        # title -> {"id": ..., settings}
+        self.rewards = None
+        # the cache differs from the file
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as fl:
+                    cache = json.loads(fl.read())
+                if cache.get("broadcaster_id") == self.broadcaster_id:
+                    self.rewards = cache["rewards"]
+            except Exception as e:
+                logger.critical("TWITCH - cannot read %s: %s" % (self.cache_file, e, ))
+
+    def save(self):
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w+") as fl:
+            fl.write(json.dumps({"broadcaster_id": self.broadcaster_id, "rewards": self.rewards}))
+        os.replace(tmp_file, self.cache_file)
+
+    def fetch(self):
+        # one listing of everything twitch knows about our rewards
+        rewards = {}
+        existing = self.helix.run(self.helix.get_rewards(self.broadcaster_id))
+        for k in existing["data"]:
+            if self.marker in k["prompt"]:
+                tmp = reward_settings(k)
+                tmp["id"] = k["id"]
+                rewards[k["title"]] = tmp
+        if rewards != self.rewards:
+            self.changed = True
+        self.rewards = rewards
+
+    def reconcile(self, desired, keep=()):
+        # desired: list of reward dicts with title and settings
+        # keep: titles which are not wanted right now, but will come back. those are paused,
+        # everything else of ours which is not desired gets deleted
+        fresh = self.rewards is None
+        if fresh:
+            self.fetch()
+        try:
+            failed = self._apply(desired, keep)
+        except HelixError as e:
+            failed = [e]
+        if failed and not fresh:
+            # maybe somebody changed the rewards behind our back and our cache is wrong
+            logger.info("TWITCH - reward cache might be outdated, asking twitch")
+            self.fetch()
+            failed = self._apply(desired, keep)
+        if self.changed:
+            # nothing to write when nothing was created, updated, paused or deleted
+            self.save()
+            self.changed = False
+        return failed
+
+    def _apply(self, desired, keep):
+        creates = []
+        updates = []
+        deletes = []
+        wanted = set()
+        for reward in desired:
+            title = reward["title"]
+            wanted.add(title)
+            settings = reward_settings(reward)
+            settings["is_paused"] = False
+            current = self.rewards.get(title)
+            if current is None:
+                creates.append((title, reward, settings))
+                continue
+            changes = {}
+            for k in settings:
+                if current.get(k) != settings[k]:
+                    changes[k] = settings[k]
+            if changes:
+                updates.append((title, changes))
+
+        for title in list(self.rewards):
+            if title in wanted:
+                continue
+            if title in keep:
+                if not self.rewards[title].get("is_paused"):
+                    updates.append((title, {"is_paused": True}))
+            else:
+                deletes.append(title)
+
+        helix = self.helix
+        coros = []
+        for title, reward, settings in creates:
+            body = {"title": title}
+            body.update(settings)
+            coros.append(helix.create_reward(self.broadcaster_id, body))
+        for title, changes in updates:
+            coros.append(helix.update_reward(self.broadcaster_id, self.rewards[title]["id"], changes))
+        for title in deletes:
+            coros.append(helix.delete_reward(self.broadcaster_id, self.rewards[title]["id"]))
+        if not coros:
+            return []
+        results = helix.run(helix.gather(coros))
+
+        failed = []
+        results = iter(results)
+        for title, reward, settings in creates:
+            result = next(results)
+            if isinstance(result, Exception):
+                logger.critical("TWITCH - cannot create reward %s: %s" % (title, result, ))
+                failed.append(result)
+            else:
+                tmp = reward_settings(result["data"][0])
+                tmp["id"] = result["data"][0]["id"]
+                self.rewards[title] = tmp
+                self.changed = True
+                logger.info("TWITCH - setting up reward %s" % (title, ))
+        for title, changes in updates:
+            result = next(results)
+            if isinstance(result, Exception):
+                logger.critical("TWITCH - cannot update reward %s: %s" % (title, result, ))
+                failed.append(result)
+            else:
+                self.rewards[title].update(changes)
+                self.changed = True
+                logger.info("TWITCH - updating reward %s: %s" % (title, ", ".join(changes), ))
+        for title in deletes:
+            result = next(results)
+            if isinstance(result, Exception):
+                logger.critical("TWITCH - cannot remove reward %s: %s" % (title, result, ))
+                failed.append(result)
+            else:
+                del self.rewards[title]
+                self.changed = True
+                logger.info("TWITCH - removing reward %s" % (title, ))
+        return failed
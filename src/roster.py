@@ -0,0 +1,69 @@
+from threading import Lock
+
+# the static part of a driver entry in DriverInfo -> Drivers, everything else changes every tick
+DRIVER_FIELDS = ("CarIdx", "CarNumber", "UserName", "UserID", "TeamID", "TeamName",
+                 "CarScreenName", "IRating", "LicString", "IsSpectator")
+
+
+class Roster:
+    # indexed copy of DriverInfo -> Drivers
+    # it is only rebuilt when iRacing increments SessionInfoUpdate, so the per tick work
+    # never has to walk the parsed session info yaml
+
+    def __init__(self):
+        self.update = -1
+        self.drivers = {}
+        self.by_user_id = {}
+        self.by_team_id = {}
+        self.by_car_number = {}
+        self._lock = Lock()
+
+    def clear(self):
+        with self._lock:
+            self.update = -1
+            self.drivers = {}
+            self.by_user_id = {}
+            self.by_team_id = {}
+            self.by_car_number = {}
+
+    def refresh(self, ir):
+        # returns True if there are drivers we can work with
+        session_info_update = ir.session_info_update
+        if session_info_update != self.update:
+            with self._lock:
+                if session_info_update != self.update:
+                    self._rebuild(ir, session_info_update)
+        return len(self.drivers) > 0
+
+    def _rebuild(self, ir, session_info_update):
+        drivers = {}
+        by_user_id = {}
+        by_team_id = {}
+        by_car_number = {}
+        driver_info = ir["DriverInfo"]
+        if not driver_info or not driver_info["Drivers"]:
+            # the new session info is still being parsed, the old roster stays until
+            # the next tick tries again
+            return
+        for d in driver_info["Drivers"]:
+            record = {}
+            for k in DRIVER_FIELDS:
+                record[k] = d.get(k)
+            car_idx = record["CarIdx"]
+            drivers[car_idx] = record
+            if record["UserID"] is not None and record["UserID"] != -1:
+                by_user_id.setdefault(record["UserID"], car_idx)
+            if record["TeamID"]:
+                by_team_id.setdefault(record["TeamID"], car_idx)
+            by_car_number.setdefault(record["CarNumber"], car_idx)
+
+        self.drivers = drivers
+        self.by_user_id = by_user_id
+        self.by_team_id = by_team_id
+        self.by_car_number = by_car_number
+        self.update = session_info_update
+
+    def is_racer(self, car_idx):
+        # real cars, no spectators and no pace car
+        d = self.drivers.get(car_idx)
+        return d is not None and d["IsSpectator"] == 0 and d["UserID"] != -1
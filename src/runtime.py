@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import traceback
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("iRTCPR")
+
+# threads for whatever would block the event loop: the sim, fsync, file writes
+WORKERS = 3
+# how long stop() waits for the tasks to finish what they are doing
+STOP_TIMEOUT = 5
+
+
+class Wakeup:
+    # an asyncio.Event any thread may set. the loop is the one of the first wait(),
+    # a set() before that is not lost
+
+    def __init__(self):
+        self._lock = Lock()
+        self._loop = None
+        self._event = None
+        self._pending = False
+
+    def set(self):
+        with self._lock:
+            if self._loop is None:
+                self._pending = True
+                return
+            loop = self._loop
+        loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout=None):
+        # True if set() was called, False after timeout seconds
+        if self._loop is None:
+            with self._lock:
+                self._loop = asyncio.get_running_loop()
+                self._event = asyncio.Event()
+                if self._pending:
+                    self._pending = False
+                    return True
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+class Runtime:
+    # the one event loop of iRTCPR. telemetry, redemptions, camera windows, helix requests
+    # and the overlay are tasks on it which sleep until there is something to do, stop()
+    # cancels them right where they wait. whatever blocks runs on a small executor next to it
+
+    def __init__(self, workers=WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Blocking")
+        self.tasks = []
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="Runtime", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def spawn(self, name, fn, *args):
+        # runs the coroutine fn(*args) as a task, from any thread
+        self.loop.call_soon_threadsafe(self._spawn, name, fn, args)
+
+    def _spawn(self, name, fn, args):
+        self.tasks.append(self.loop.create_task(self._guard(name, fn, args), name=name))
+
+    async def _guard(self, name, fn, args):
+        logger.info("%s - Task starts" % (name, ))
+        try:
+            await fn(*args)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.critical("%s - Task failed: %s"
+                            % (name, "".join(traceback.TracebackException.from_exception(e).format()), ))
+        logger.info("%s - Task ends" % (name, ))
+
+    async def blocking(self, fn, *args):
+        # fn(*args) on the executor, the loop goes on in the meantime
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def soon(self, fn, *args):
+        # fn(*args) on the loop between two steps of the tasks, from any thread.
+        # without a running loop (replay) it is called right away
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(fn, *args)
+        else:
+            fn(*args)
+
+    def call(self, coro, timeout=None):
+        # runs a coroutine on the loop and waits for its result, never from the loop itself
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def _cancel(self):
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel(self, timeout=STOP_TIMEOUT):
+        # cancels every task, they clean up in their finally blocks. the loop keeps running
+        # for whatever still has to be closed on it
+        try:
+            self.call(self._cancel(), timeout)
+        except Exception as e:
+            logger.critical("Runtime - not every task ended within %ss: %s" % (timeout, e, ))
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        if self.tasks:
+            self.cancel(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,68 @@
+import time
+import heapq
+import itertools
+import logging
+from threading import Lock
+
+import metrics
+from runtime import Wakeup
+
+logger = logging.getLogger("iRTCPR")
+
+
+class Scheduler:
+    # a timer heap worked off by a task on the event loop.
+    # jobs run at their deadline, nobody has to sleep through a camera window anymore.
+    # jobs must be short and must not block, they run on the loop itself
+
+    def __init__(self, name="Scheduler"):
+        self.name = name
+        self._lock = Lock()
+        # an earlier deadline than the one we sleep for
+        self._wakeup = Wakeup()
+        self._heap = []
+        self._seq = itertools.count()
+        metrics.gauge("irtcpr_scheduler_jobs", "jobs waiting for their deadline", fn=self.__len__, scheduler=name)
+        self.late_seconds = metrics.histogram("irtcpr_scheduler_late_seconds",
+                                              "how late the jobs ran after their deadline", scheduler=name)
+        self.work_seconds = metrics.histogram("irtcpr_loop_work_seconds",
+                                              "time a loop spends working per tick", loop=name)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def call_at(self, deadline, fn, *args):
+        # deadline is a time.time() epoch
+        seq = next(self._seq)
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, seq, fn, args))
+            first = self._heap[0][1] == seq
+        # only a new first job changes how long the loop has to sleep
+        if first:
+            self._wakeup.set()
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(time.time() + delay, fn, *args)
+
+    async def run(self):
+        while True:
+            with self._lock:
+                deadline = self._heap[0][0] if self._heap else None
+                now = time.time()
+                if deadline is None or deadline > now:
+                    job = None
+                else:
+                    job = heapq.heappop(self._heap)
+            if job is None:
+                # sleep until the deadline or until an earlier job comes in
+                await self._wakeup.wait(None if deadline is None else deadline - now)
+                continue
+            _, _, fn, args = job
+            self.late_seconds.observe(now - deadline)
+            started = time.perf_counter()
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.critical("%s - job %s failed: %s" % (self.name, getattr(fn, "__name__", fn), e, ))
+            self.work_seconds.since(started)
@@ -0,0 +1,112 @@
+import re
+import logging
+
+logger = logging.getLogger("iRTCPR")
+
+# events published by SessionContext
+SESSION_NUM_CHANGED = "session_num_changed"    # e.g. practice -> qualify -> race, same server
+SESSION_CHANGED = "session_changed"            # SessionID or SubSessionID changed, new server
+CAMERAS_CHANGED = "cameras_changed"
+
+TRACK_LENGTH_RE = re.compile(r'([\d\.]+?)\ km.*$')
+
+
+def parse_track_length(tracklength):
+    # "5.79 km" -> 5790.0
+    try:
+        return float(TRACK_LENGTH_RE.search(tracklength).group(1)) * 1000
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+class SessionContext:
+    # everything which only changes with the session info yaml is computed once per
+    # SessionInfoUpdate, so the telemetry loops never have to touch the yaml or run regexes.
+    # interested code subscribes and gets called the moment something changes.
+
+    def __init__(self):
+        self._listeners = []
+        self.clear()
+
+    def clear(self):
+        self.update = -1
+        self.session_num = -1
+        self.session_id = -1
+        self.subsession_id = -1
+        self.session_name = "NO_SESSION"
+        self.session_type = ""
+        self.sessions = []
+        self.track_length = 0
+        self.track_name = ""
+        self.track_city = ""
+        self.track_country = ""
+        self.category = ""
+        self.team_racing = False
+        self.start_type = "rolling"
+        self.cameras = {}
+
+    def subscribe(self, listener):
+        # listener(event, context)
+        self._listeners.append(listener)
+
+    def _publish(self, event):
+        for listener in self._listeners:
+            try:
+                listener(event, self)
+            except Exception as e:
+                logger.critical("SessionContext - listener for %s failed: %s" % (event, e, ))
+
+    def refresh(self, ir):
+        # returns True as soon as we have a usable session
+        session_info_update = ir.session_info_update
+        if session_info_update != self.update:
+            self._reload(ir, session_info_update)
+
+        session_num = ir["SessionNum"]
+        if session_num is not None and session_num != self.session_num and self.update != -1:
+            self.session_num = session_num
+            if 0 <= session_num < len(self.sessions):
+                self.session_name, self.session_type = self.sessions[session_num]
+            self._publish(SESSION_NUM_CHANGED)
+
+        return self.update != -1
+
+    def _reload(self, ir, session_info_update):
+        weekend = ir["WeekendInfo"]
+        session_info = ir["SessionInfo"]
+        camera_info = ir["CameraInfo"]
+        if not weekend or not session_info or not camera_info or not camera_info["Groups"]:
+            # the new session info is still being parsed, the next tick tries again
+            return
+
+        self.update = session_info_update
+        self.track_length = parse_track_length(weekend["TrackLength"])
+        self.track_name = weekend["TrackDisplayName"]
+        self.track_city = weekend["TrackCity"]
+        self.track_country = weekend["TrackCountry"]
+        self.category = weekend["Category"]
+        self.team_racing = weekend["TeamRacing"] == 1
+        if weekend["WeekendOptions"]["StandingStart"] == 1:
+            self.start_type = "standing"
+        else:
+            self.start_type = "rolling"
+
+        self.sessions = [(s["SessionName"], s["SessionType"]) for s in session_info["Sessions"]]
+        if 0 <= self.session_num < len(self.sessions):
+            self.session_name, self.session_type = self.sessions[self.session_num]
+
+        cameras = {}
+        for c in camera_info["Groups"]:
+            cameras[c["GroupName"]] = c["GroupNum"]
+
+        session_changed = self.session_id != weekend["SessionID"] \
+            or self.subsession_id != weekend["SubSessionID"]
+        self.session_id = weekend["SessionID"]
+        self.subsession_id = weekend["SubSessionID"]
+        cameras_changed = cameras != self.cameras
+        self.cameras = cameras
+
+        if session_changed:
+            self._publish(SESSION_CHANGED)
+        elif cameras_changed:
+            self._publish(CAMERAS_CHANGED)
@@ -0,0 +1,220 @@
+import json
+import zlib
+import time
+import uuid
+import random
+import asyncio
+import logging
+from threading import Thread, Event
+from collections import Counter
+
+from aiohttp import web, WSMsgType
+
+logger = logging.getLogger("iRTCPR")
+
+# redemption status updates take up to 50 ids per call, like helix
+MAX_REDEMPTION_IDS = 50
+CHANNEL_POINTS_TOPIC = "channel-points-channel-v1."
+
+
+class TwitchStandIn:
+    # local replacement for the parts of twitch we talk to: the helix custom reward and
+    # redemption status endpoints, and the channel points topic of pubsub.
+    # HelixClient works against it with base_url=standin.helix_url, pubsub clients connect
+    # to standin.pubsub_url. everything runs on its own event loop thread
+
+    def __init__(self, port=0, latency=0, error_rate=0, seed=None):
+        self.port = port
+        # every helix request takes this long and fails with a 500 at this rate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.rewards = {}
+        # redemption id -> status
+        self.redemptions = {}
+        self.calls = Counter()
+        self.loop = asyncio.new_event_loop()
+        self._topics = {}
+        self._runner = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % (self.port, )
+
+    @property
+    def helix_url(self):
+        return self.url + "/helix"
+
+    @property
+    def pubsub_url(self):
+        return "ws://127.0.0.1:%s/pubsub" % (self.port, )
+
+    def start(self):
+        started = Event()
+        app = web.Application()
+        app.router.add_route("*", "/helix/channel_points/custom_rewards", self._custom_rewards)
+        app.router.add_patch("/helix/channel_points/custom_rewards/redemptions", self._redemptions)
+        app.router.add_get("/pubsub", self._pubsub)
+        self._runner = web.AppRunner(app)
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+            self.loop.run_until_complete(site.start())
+            # port 0 means any free port
+            self.port = self._runner.addresses[0][1]
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self._runner.cleanup())
+
+        self._thread = Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info("TwitchStandIn - listening on %s" % (self.url, ))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def redeem(self, broadcaster_id, reward, user_login, redemption_id=None, copies=1):
+        # publishes a reward-redeemed event like twitch does, from any thread.
+        # copies > 1 sends it more than once, like pubsub does now and then. returns the redemption id
+        redemption_id = redemption_id or str(uuid.uuid4())
+        self.redemptions[redemption_id] = "UNFULFILLED"
+        message = {
+            "type": "reward-redeemed",
+            "data": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "redemption": {
+                    "id": redemption_id,
+                    "user": {"id": str(zlib.crc32(user_login.encode())), "login": user_login, "display_name": user_login},
+                    "channel_id": str(broadcaster_id),
+                    "redeemed_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "reward": dict(reward, channel_id=str(broadcaster_id)),
+                    "status": "UNFULFILLED",
+                },
+            },
+        }
+        topic = CHANNEL_POINTS_TOPIC + str(broadcaster_id)
+        for _ in range(copies):
+            asyncio.run_coroutine_threadsafe(self._publish(topic, message), self.loop)
+        return redemption_id
+
+    async def _publish(self, topic, message):
+        data = json.dumps({"type": "MESSAGE", "data": {"topic": topic, "message": json.dumps(message)}})
+        for ws in list(self._topics.get(topic, ())):
+            try:
+                await ws.send_str(data)
+            except Exception:
+                self._topics[topic].discard(ws)
+
+    async def _helix(self, request):
+        # common part of every helix request, returns an error response or None
+        self.calls[(request.method, request.path)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not request.headers.get("Authorization", "").startswith("Bearer ") \
+                or not request.headers.get("Client-ID"):
+            return web.json_response({"status": 401, "message": "invalid oauth token"}, status=401)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.json_response({"status": 500, "message": "stand-in error"}, status=500)
+        return None
+
+    async def _custom_rewards(self, request):
+        error = await self._helix(request)
+        if error is not None:
+            return error
+        query = request.query
+        broadcaster_id = query.get("broadcaster_id")
+        if request.method == "GET":
+            rewards = [r for r in self.rewards.values() if r["broadcaster_id"] == broadcaster_id]
+            return web.json_response({"data": rewards})
+        if request.method == "POST":
+            body = await request.json()
+            if any(r["title"] == body["title"] and r["broadcaster_id"] == broadcaster_id
+                   for r in self.rewards.values()):
+                return web.json_response({"status": 400, "message": "CREATE_CUSTOM_REWARD_DUPLICATE_REWARD"},
+                                         status=400)
+            reward = {
+                "broadcaster_id": broadcaster_id,
+                "id": str(uuid.uuid4()),
+                "title": body["title"],
+                "prompt": body.get("prompt", ""),
+                "cost": body.get("cost", 1),
+                "is_paused": body.get("is_paused", False),
+                "is_enabled": True,
+                "global_cooldown_setting": {
+                    "is_enabled": body.get("is_global_cooldown_enabled", False),
+                    "global_cooldown_seconds": body.get("global_cooldown_seconds", 0),
+                },
+            }
+            self.rewards[reward["id"]] = reward
+            return web.json_response({"data": [reward]})
+
+        reward = self.rewards.get(query.get("id"))
+        if reward is None or reward["broadcaster_id"] != broadcaster_id:
+            return web.json_response({"status": 404, "message": "not found"}, status=404)
+        if request.method == "PATCH":
+            body = await request.json()
+            for k in body:
+                if k == "is_global_cooldown_enabled":
+                    reward["global_cooldown_setting"]["is_enabled"] = body[k]
+                elif k == "global_cooldown_seconds":
+                    reward["global_cooldown_setting"]["global_cooldown_seconds"] = body[k]
+                else:
+                    reward[k] = body[k]
+            return web.json_response({"data": [reward]})
+        if request.method == "DELETE":
+            del self.rewards[reward["id"]]
+            return web.Response(status=204)
+        return web.json_response({"status": 405, "message": "method not allowed"}, status=405)
+
+    async def _redemptions(self, request):
+        error = await self._helix(request)
+        if error is not None:
+            return error
+        ids = request.query.getall("id", [])
+        if not ids or len(ids) > MAX_REDEMPTION_IDS:
+            return web.json_response({"status": 400, "message": "between 1 and 50 ids"}, status=400)
+        if request.query.get("reward_id") not in self.rewards:
+            return web.json_response({"status": 404, "message": "reward not found"}, status=404)
+        status = (await request.json()).get("status")
+        if status not in ("FULFILLED", "CANCELED"):
+            return web.json_response({"status": 400, "message": "invalid status"}, status=400)
+        data = []
+        for i in ids:
+            if self.redemptions.get(i) == "UNFULFILLED":
+                self.redemptions[i] = status
+                data.append({"id": i, "status": status})
+        if not data:
+            return web.json_response({"status": 404, "message": "no unfulfilled redemptions"}, status=404)
+        return web.json_response({"data": data})
+
+    async def _pubsub(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        listening = set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    if msg.type == WSMsgType.ERROR:
+                        break
+                    continue
+                data = json.loads(msg.data)
+                if data.get("type") == "PING":
+                    await ws.send_str(json.dumps({"type": "PONG"}))
+                elif data.get("type") in ("LISTEN", "UNLISTEN"):
+                    for topic in data["data"]["topics"]:
+                        if data["type"] == "LISTEN":
+                            self._topics.setdefault(topic, set()).add(ws)
+                            listening.add(topic)
+                        else:
+                            self._topics.get(topic, set()).discard(ws)
+                            listening.discard(topic)
+                    await ws.send_str(json.dumps({"type": "RESPONSE", "nonce": data.get("nonce"), "error": ""}))
+        finally:
+            for topic in listening:
+                self._topics.get(topic, set()).discard(ws)
+        return ws
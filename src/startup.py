@@ -0,0 +1,43 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger("iRTCPR")
+
+
+class Startup:
+    # runs the steps of the startup and remembers how long each one took.
+    # run() does a step right away, start() runs it next to everything else and
+    # hands out a future, so steps which don't need each other overlap
+
+    def __init__(self, workers=4):
+        self.started = time.perf_counter()
+        self.timings = []
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Startup")
+
+    def _timed(self, name, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            seconds = time.perf_counter() - started
+            self.timings.append((name, seconds))
+            metrics.gauge("irtcpr_startup_seconds", "how long a step of the startup took", phase=name).set(seconds)
+            logger.info("Startup - %s took %.0fms" % (name, seconds * 1000, ))
+
+    def run(self, name, fn, *args):
+        return self._timed(name, fn, args)
+
+    def start(self, name, fn, *args):
+        return self._pool.submit(self._timed, name, fn, args)
+
+    def ready(self):
+        # everything is up, one line with all steps for the log
+        total = time.perf_counter() - self.started
+        metrics.gauge("irtcpr_startup_seconds", "how long a step of the startup took", phase="total").set(total)
+        logger.info("Startup - ready after %.2fs (%s)"
+                    % (total, ", ".join("%s %.0fms" % (name, seconds * 1000) for name, seconds in self.timings), ))
+        self._pool.shutdown(wait=False)
+        return total
@@ -0,0 +1,134 @@
+import time
+import asyncio
+import logging
+from threading import Lock
+
+import metrics
+from helix import HelixError
+from runtime import Wakeup
+
+logger = logging.getLogger("iRTCPR")
+
+# helix takes up to 50 redemption ids per update_redemption_status call
+MAX_BATCH = 50
+# how long we wait for more redemptions of the same reward before we send
+LINGER = 0.5
+RETRIES = 5
+BACKOFF = 1.0
+BACKOFF_MAX = 30.0
+
+
+class StatusBatcher:
+    # collects fulfilled/canceled redemptions per (reward_id, status) and sends them to
+    # twitch in as few calls as possible. a batch goes out when it is full or when its
+    # oldest redemption waited LINGER seconds, all due batches at the same time.
+    # failed batches are retried with backoff, unless twitch refused them for good
+
+    def __init__(self, send, max_batch=MAX_BATCH, linger=LINGER, retries=RETRIES, refused=None):
+        # the coroutine send(reward_id, redemption_ids, status) must raise on failure
+        self.send = send
+        # refused(redemption_ids) gets the ids twitch will never take
+        self.refused = refused
+        self.max_batch = max_batch
+        self.linger = linger
+        self.retries = retries
+        self._lock = Lock()
+        self._wakeup = Wakeup()
+        # (reward_id, status) -> [first_added, [redemption_ids]]
+        self._batches = {}
+        # batches waiting for a retry: [due, attempt, reward_id, status, redemption_ids]
+        self._retry = []
+        self.calls = 0
+        self.sent = 0
+        self.failed = 0
+        self.refused_ids = 0
+        self.sent_count = metrics.counter("irtcpr_redeem_status_total", "redemption status updates", result="sent")
+        self.failed_count = metrics.counter("irtcpr_redeem_status_total", "redemption status updates",
+                                            result="failed")
+        self.refused_count = metrics.counter("irtcpr_redeem_status_total", "redemption status updates",
+                                             result="refused")
+
+    def add(self, reward_id, redemption_id, status):
+        with self._lock:
+            batch = self._batches.get((reward_id, status))
+            new = batch is None
+            if new:
+                batch = [time.time(), []]
+                self._batches[(reward_id, status)] = batch
+            batch[1].append(redemption_id)
+            full = len(batch[1]) >= self.max_batch
+        # a new batch needs a timer for its linger time, a full one goes out right away
+        if new or full:
+            self._wakeup.set()
+
+    def _due(self, now, flush_all):
+        # takes everything which should be sent now out of the pending batches
+        due = []
+        with self._lock:
+            for key in list(self._batches):
+                first_added, ids = self._batches[key]
+                if flush_all or len(ids) >= self.max_batch or now - first_added >= self.linger:
+                    del self._batches[key]
+                    for i in range(0, len(ids), self.max_batch):
+                        due.append([0, 0, key[0], key[1], ids[i:i + self.max_batch]])
+            for r in list(self._retry):
+                if flush_all or r[0] <= now:
+                    self._retry.remove(r)
+                    due.append(r)
+        return due
+
+    def _next_due(self, now):
+        # seconds until the next batch is due, None if there is nothing to send
+        with self._lock:
+            due = [first_added + self.linger for first_added, _ in self._batches.values()]
+            due += [r[0] for r in self._retry]
+        if not due:
+            return None
+        return max(0, min(due) - now)
+
+    async def _send(self, batch):
+        _, attempt, reward_id, status, ids = batch
+        self.calls += 1
+        try:
+            await self.send(reward_id, ids, status)
+            self.sent += len(ids)
+            self.sent_count.inc(len(ids))
+            return True
+        except Exception as e:
+            if isinstance(e, HelixError) and 400 <= e.status < 500 and e.status != 429:
+                # already fulfilled, canceled or unknown, asking again gets the same answer
+                self.refused_ids += len(ids)
+                self.refused_count.inc(len(ids))
+                logger.critical("TWITCH - twitch refused the update of %s redeems of reward %s, dropping them: %s"
+                                % (len(ids), reward_id, e, ))
+                if self.refused is not None:
+                    self.refused(ids)
+                return True
+            attempt += 1
+            if attempt > self.retries:
+                self.failed += len(ids)
+                self.failed_count.inc(len(ids))
+                logger.critical("TWITCH - giving up on updating %s redeems of reward %s: %s"
+                                % (len(ids), reward_id, e, ))
+                return True
+            delay = min(BACKOFF * 2 ** (attempt - 1), BACKOFF_MAX)
+            logger.critical("TWITCH - updating %s redeems failed, retry %s in %.0fs: %s"
+                            % (len(ids), attempt, delay, e, ))
+            with self._lock:
+                self._retry.append([time.time() + delay, attempt, reward_id, status, ids])
+            return False
+
+    async def flush(self):
+        # sends everything right now, retries included, without waiting for backoff
+        await asyncio.gather(*(self._send(batch) for batch in self._due(time.time(), True)))
+
+    async def run(self):
+        try:
+            while True:
+                due = self._due(time.time(), False)
+                if due:
+                    await asyncio.gather(*(self._send(batch) for batch in due))
+                await self._wakeup.wait(self._next_due(time.time()))
+        finally:
+            # what is left goes out before we stop
+            await self.flush()
@@ -0,0 +1,106 @@
+import ctypes
+import asyncio
+import logging
+
+from irsdk import DATAVALIDEVENTNAME
+
+import metrics
+from runtime import Wakeup
+
+logger = logging.getLogger("iRTCPR")
+
+# without a sim we look for it after this many seconds, then twice as long every time up to BACKOFF_MAX
+BACKOFF_MIN = 1
+BACKOFF_MAX = 8
+# access right to wait for an event, enough to see if it exists
+SYNCHRONIZE = 0x00100000
+
+kernel32 = ctypes.windll.kernel32 if hasattr(ctypes, "windll") else None
+
+
+def sim_running():
+    # the sim creates its data-valid event when it starts and drops it when it ends.
+    # opening it costs next to nothing, ir.startup() asks the sim's web server and maps
+    # the shared memory. without windows there is no such test, ir.startup() has to tell
+    if kernel32 is None:
+        return True
+    handle = kernel32.OpenEventW(SYNCHRONIZE, False, DATAVALIDEVENTNAME)
+    if not handle:
+        return False
+    kernel32.CloseHandle(handle)
+    return True
+
+
+class SimSupervisor:
+    # owns the connection to the sim. while there is none, run() probes for the sim with a
+    # pause that doubles up to BACKOFF_MAX and the telemetry reader sleeps in wait(),
+    # nothing else wakes up for the sim. the moment it is attached the reader goes on.
+    # connect() attaches and returns True if it worked, alive() tells if the sim is still
+    # there and disconnect() cleans up after it went away. all of them block
+
+    def __init__(self, connect, alive, disconnect, probe=sim_running, backoff=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self._connect = connect
+        self._alive = alive
+        self._disconnect = disconnect
+        self.probe = probe
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.connected = False
+        # the probe found the sim, but it didn't let us attach yet
+        self.starting = False
+        self._attached = Wakeup()
+        self._lost = Wakeup()
+        self.probe_count = metrics.counter("irtcpr_sim_probes_total", "times we looked for the sim")
+        self.attach_count = metrics.counter("irtcpr_sim_attaches_total", "times the sim was attached")
+        metrics.gauge("irtcpr_sim_connected", "1 while the sim is attached", fn=lambda: int(self.connected))
+
+    def connect(self):
+        # True if the sim is attached now, blocks
+        if self.connected:
+            return True
+        self.probe_count.inc()
+        self.starting = self.probe is None or self.probe()
+        if not self.starting:
+            return False
+        try:
+            if not self._connect():
+                return False
+        except Exception as e:
+            logger.critical("SimSupervisor - cannot attach to the sim: %s" % (e, ))
+            return False
+        self.connected = True
+        self.starting = False
+        self.attach_count.inc()
+        self._attached.set()
+        return True
+
+    def check(self):
+        # once per frame before reading, False once the sim went away, blocks
+        if self.connected and not self._alive():
+            self.connected = False
+            try:
+                self._disconnect()
+            finally:
+                self._lost.set()
+        return self.connected
+
+    async def wait(self):
+        # until the sim is attached
+        while not self.connected:
+            await self._attached.wait()
+
+    async def run(self, blocking):
+        # blocking(fn) runs fn next to the event loop
+        delay = self.backoff
+        logger.info("SimSupervisor - looking for the sim")
+        while True:
+            if self.connected:
+                await self._lost.wait()
+                delay = self.backoff
+                logger.info("SimSupervisor - the sim is gone, looking for it again")
+                continue
+            if await blocking(self.connect):
+                continue
+            await asyncio.sleep(delay)
+            # a sim which is starting gets another look soon, no sim a longer and longer pause
+            delay = self.backoff if self.starting else min(delay * 2, self.backoff_max)
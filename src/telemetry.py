@@ -0,0 +1,168 @@
+import time
+import asyncio
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+import metrics
+from ticker import TickLoop
+
+logger = logging.getLogger("iRTCPR")
+
+# scalar telemetry variables we copy into every frame
+SCALAR_VARS = ("SessionTick", "SessionTime", "SessionNum", "CamCarIdx", "CamGroupNumber")
+# per car telemetry variables (64 CarIdx slots each) and their numpy types
+CAR_VARS = (
+    ("CarIdxLapDistPct", np.float32),
+    ("CarIdxLap", np.int32),
+    ("CarIdxTrackSurface", np.int32),
+    ("CarIdxEstTime", np.float32),
+)
+
+TelemetryFrame = namedtuple("TelemetryFrame",
+                            ("seq", "epoch", "session_info_update")
+                            + SCALAR_VARS
+                            + tuple(name for name, _ in CAR_VARS)
+                            # smoothed speed of every car in laps per second, see estimator.py
+                            + ("lap_speed", ))
+
+
+def read_frame(ir, seq, estimator=None, epoch=None):
+    # one consistent snapshot of everything we need, taken from a frozen var buffer.
+    # a replay passes the recorded epoch instead of the wall clock
+    values = [seq, time.time() if epoch is None else epoch, ir.session_info_update]
+    for name in SCALAR_VARS:
+        values.append(ir[name])
+    for name, dtype in CAR_VARS:
+        raw = ir[name]
+        if raw is None:
+            arr = np.full(64, -1, dtype=dtype)
+        else:
+            arr = np.array(raw, dtype=dtype)
+        # frames are shared between threads, nobody is allowed to change them
+        arr.flags.writeable = False
+        values.append(arr)
+
+    frame = TelemetryFrame(*values, None)
+    if estimator is not None and frame.SessionTime is not None:
+        lap_speed = estimator.push(frame.SessionTime, frame.CarIdxLap, frame.CarIdxLapDistPct).copy()
+        lap_speed.flags.writeable = False
+        frame = frame._replace(lap_speed=lap_speed)
+    return frame
+
+
+class FrameChannel:
+    # bounded to exactly one frame: a slow consumer only ever sees the newest frame
+    # and the reader never has to wait for anybody. only used on the event loop
+
+    def __init__(self, name=""):
+        self._frame = None
+        self._ready = asyncio.Event()
+        self.dropped = 0
+        self.dropped_count = metrics.counter("irtcpr_frames_dropped_total",
+                                             "frames a consumer was too slow for", consumer=name)
+
+    def publish(self, frame):
+        if self._frame is not None:
+            self.dropped += 1
+            self.dropped_count.inc()
+        self._frame = frame
+        self._ready.set()
+
+    async def get(self):
+        # the newest frame, waits for one if there is none
+        while self._frame is None:
+            self._ready.clear()
+            await self._ready.wait()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+class TelemetryReader:
+    # the only code that reads the telemetry from the shared memory. once per tick it
+    # snapshots a frame next to the event loop and publishes it to every subscriber.
+    # each consumer is a task of its own on the loop which takes the newest frame
+    # whenever it is done with the one before, so it never holds up the reader
+
+    def __init__(self, ir, rate=0, check=None, estimator=None, recorder=None, sim=None):
+        self.ir = ir
+        # the sim supervisor, without a sim the reader sleeps until it is attached again
+        self.sim = sim
+        self.estimator = estimator
+        # writes every frame to a recording, see recorder.py
+        self.recorder = recorder
+        self.rate = rate
+        # called once per tick before reading, returns True if the sim is connected
+        self.check = check
+        self.seq = 0
+        # time.monotonic() the data-valid event woke up the last read, None without the event
+        self.ticked = None
+        self.consumers = []
+        self.read_seconds = metrics.histogram("irtcpr_telemetry_read_seconds",
+                                              "time to snapshot one telemetry frame from the sim")
+
+    def subscribe(self, name, fn):
+        # fn(frame) runs on the event loop, it must not block
+        channel = FrameChannel(name)
+        self.consumers.append((name, fn, channel))
+        return channel
+
+    async def _consume(self, name, fn, channel):
+        work_seconds = metrics.histogram("irtcpr_loop_work_seconds", "time a loop spends working per tick",
+                                         loop=name)
+        frame_age = metrics.histogram("irtcpr_frame_age_seconds",
+                                      "age of a telemetry frame when a worker is done with it", loop=name)
+        while True:
+            frame = await channel.get()
+            started = time.perf_counter()
+            try:
+                fn(frame)
+            except Exception as e:
+                logger.critical("%s - an exception occured %s" % (name, e, ))
+            work_seconds.since(started)
+            frame_age.observe(time.time() - frame.epoch)
+
+    def read(self):
+        # the next frame, None while the sim is not connected. blocks, runs next to the loop
+        self.ticked = None
+        if not self.check():
+            return None
+        # waits for the sim's data-valid event (windows only, max 32ms), the one wait per tick
+        self.ir.freeze_var_buffer_latest()
+        self.ticked = time.monotonic() if getattr(self.ir, "_data_valid_event", None) else None
+        started = time.perf_counter()
+        try:
+            self.seq += 1
+            frame = read_frame(self.ir, self.seq, self.estimator)
+            self.read_seconds.since(started)
+            if self.recorder is not None:
+                self.recorder.write(self.ir, frame)
+        finally:
+            self.ir.unfreeze_var_buffer_latest()
+        return frame
+
+    async def run(self, blocking):
+        # blocking(fn) runs fn next to the event loop
+        tick = TickLoop("TelemetryReader", self.rate)
+        consumers = [asyncio.create_task(self._consume(name, fn, channel), name=name)
+                     for name, fn, channel in self.consumers]
+        try:
+            while True:
+                frame = None
+                try:
+                    frame = await blocking(self.read)
+                except Exception as e:
+                    logger.critical("TelemetryReader - Exception while reading telemetry: %s" % (e,))
+                if frame is not None:
+                    for _, _, channel in self.consumers:
+                        channel.publish(frame)
+                if frame is None and self.sim is not None and not self.sim.connected:
+                    await self.sim.wait()
+                    tick.resume()
+                else:
+                    await tick.wait(frame is not None, self.ticked)
+        finally:
+            for task in consumers:
+                task.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
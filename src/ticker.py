@@ -0,0 +1,99 @@
+import time
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger("iRTCPR")
+
+# iRacing writes a new telemetry sample 60 times a second
+SIM_TICK_RATE = 60
+# while the sim has no session there is nothing to hurry for
+IDLE_INTERVAL = 1
+# how often the loops log their timing statistics
+STATS_INTERVAL = 60
+
+
+class TickLoop:
+    # paces a task on the event loop
+    # rate 0 follows the sim's data-valid event (every telemetry tick), the reader waits for
+    # it when it freezes the newest buffer and the loop doesn't wait a second time.
+    # any other rate wakes up on a fixed schedule of that many Hz.
+    # it measures how late every wake-up was, so we can see if the streaming PC keeps up
+
+    def __init__(self, name, rate=0):
+        self.name = name
+        self.sync_to_sim = rate == 0
+        if self.sync_to_sim:
+            rate = SIM_TICK_RATE
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self.next_tick = time.monotonic()
+        self.last_tick = self.next_tick
+        self._reset_stats(self.next_tick)
+        self.work_seconds = metrics.histogram("irtcpr_loop_work_seconds",
+                                              "time a loop spends working per tick", loop=name)
+        self.jitter_seconds = metrics.histogram("irtcpr_loop_jitter_seconds",
+                                                "how late a loop woke up for its tick", loop=name)
+        self.overrun_count = metrics.counter("irtcpr_loop_overruns_total",
+                                             "ticks a loop was more than a whole tick behind", loop=name)
+
+    def _reset_stats(self, now):
+        self.stats_start = now
+        self.ticks = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.overruns = 0
+
+    async def wait(self, connected=True, ticked=None):
+        # sleep until the next tick is due, returns the seconds since the last tick.
+        # ticked is the time.monotonic() the data-valid event woke the reader up for this tick
+        if not connected:
+            await asyncio.sleep(IDLE_INTERVAL)
+            now = time.monotonic()
+            elapsed = now - self.last_tick
+            self.last_tick = now
+            self.next_tick = now
+            return elapsed
+
+        if self.sync_to_sim and ticked is not None:
+            # the sim paced us already, the tick is when its sample came in
+            self.work_seconds.observe(time.monotonic() - ticked)
+            now = ticked
+            self.next_tick = now
+            jitter = abs((now - self.last_tick) - self.interval)
+        else:
+            self.work_seconds.observe(time.monotonic() - self.last_tick)
+            self.next_tick += self.interval
+            now = time.monotonic()
+            if self.next_tick > now:
+                await asyncio.sleep(self.next_tick - now)
+                now = time.monotonic()
+            elif now - self.next_tick > self.interval:
+                # we are more than a whole tick behind, don't try to catch up
+                self.overruns += 1
+                self.overrun_count.inc()
+                self.next_tick = now
+            jitter = now - self.next_tick
+
+        elapsed = now - self.last_tick
+        self.last_tick = now
+        self._record(now, jitter)
+        return elapsed
+
+    def resume(self):
+        # after a pause the next tick is due right away, the pause is no overrun
+        self.last_tick = self.next_tick = time.monotonic()
+
+    def _record(self, now, jitter):
+        self.ticks += 1
+        self.jitter_seconds.observe(jitter)
+        self.jitter_sum += jitter
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+        if now - self.stats_start >= STATS_INTERVAL:
+            logger.info("%s - %s ticks in %.0fs (%.1f Hz), jitter avg %.2fms max %.2fms, overruns %s"
+                        % (self.name, self.ticks, now - self.stats_start,
+                           self.ticks / (now - self.stats_start),
+                           self.jitter_sum / self.ticks * 1000, self.jitter_max * 1000, self.overruns, ))
+            self._reset_stats(now)